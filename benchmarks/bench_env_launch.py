@@ -0,0 +1,38 @@
+# Benchmark of the launch latency of a python process in the modeller conda environment:
+# activating the environment in a shell for each call vs executing its resolved interpreter directly
+#
+#     Usage:   scipion3 python benchmarks/bench_env_launch.py [nCalls]
+
+import sys, time, statistics, subprocess
+
+from pwchemModeller import Plugin
+from pwchemModeller.constants import MODELLER_DIC
+
+def timeCalls(cline, env, nCalls):
+    times = []
+    for _ in range(nCalls):
+        iniTime = time.perf_counter()
+        subprocess.check_call(cline, shell=True, executable='/bin/bash', env=env)
+        times.append(time.perf_counter() - iniTime)
+    return times
+
+def report(label, times):
+    print('{:<22} mean {:8.1f} ms   median {:8.1f} ms   min {:8.1f} ms'.format(
+        label, 1000 * statistics.mean(times), 1000 * statistics.median(times), 1000 * min(times)))
+
+if __name__ == '__main__':
+    nCalls = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    activated = '%s && python -c pass' % Plugin.getEnvActivationCommand(MODELLER_DIC)
+
+    iniTime = time.perf_counter()
+    python, environ = Plugin.getEnvProgram(MODELLER_DIC, 'python'), dict(Plugin.getEnvEnviron(MODELLER_DIC))
+    print('Environment resolution (first call, cached afterwards): {:.1f} ms'.format(
+        1000 * (time.perf_counter() - iniTime)))
+
+    actTimes = timeCalls(activated, dict(Plugin.getEnviron()), nCalls)
+    dirTimes = timeCalls('%s -c pass' % python, environ, nCalls)
+    report('Activation per call', actTimes)
+    report('Resolved interpreter', dirTimes)
+    print('Launch latency drop: {:.1f} ms per call ({:.1f}x faster)'.format(
+        1000 * (statistics.mean(actTimes) - statistics.mean(dirTimes)),
+        statistics.mean(actTimes) / statistics.mean(dirTimes)))
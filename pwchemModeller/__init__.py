@@ -25,19 +25,21 @@
 # **************************************************************************
 
 # General imports
-import os, subprocess
+import os, json, shutil, subprocess
 
 # Scipion em imports
-from pyworkflow.utils import yellowStr
+from pyworkflow.utils import yellowStr, Environ
 import pwchem
 from scipion.install.funcs import InstallHelper
 
 # Plugin imports
-from .constants import MODELLER_DIC
+from .constants import MODELLER_DIC, MODELLER_CACHE
 
 _version_ = '0.1'
 _logo = "modeller_logo.png"
 _references = ['Webb2016']
+# Variables set by the shell running the activation, not by the activation itself
+SHELL_VARS = ['_', 'SHLVL', 'PWD', 'OLDPWD']
 
 class Plugin(pwchem.Plugin):
 	_supportedVersions = [MODELLER_DIC['version']]
@@ -46,6 +48,7 @@ class Plugin(pwchem.Plugin):
 	def _defineVariables(cls):
 		""" Return and write a variable in the config file. """
 		cls._defineEmVar(MODELLER_DIC['home'], '{}-{}'.format(MODELLER_DIC['name'], MODELLER_DIC['version']))
+		cls._defineEmVar(MODELLER_CACHE, 'modeller-cache')
 
 	@classmethod
 	def defineBinaries(cls, env):
@@ -71,13 +74,109 @@ class Plugin(pwchem.Plugin):
 
 	@classmethod
 	def runScript(cls, protocol, scriptName, args, envDic, cwd=None, popen=False):
-		""" Run modeller command from a given protocol. """
+		""" Run modeller command from a given protocol. The interpreter of the environment is executed directly,
+		with the environment variables resolved once for the conda environment (see getResolvedEnv). """
 		scriptName = cls.getScriptsDir(scriptName)
-		fullProgram = '%s && %s %s' % (cls.getEnvActivationCommand(envDic), 'python', scriptName)
+		args = args if isinstance(args, str) else ' '.join(map(str, args))
+		try:
+			program, environ = cls.getEnvProgram(envDic, 'python'), cls.getEnvEnviron(envDic)
+		except (subprocess.CalledProcessError, OSError) as e:
+			protocol.warning('Could not resolve the {} environment ({}), activating it instead'.format(envDic['name'], e))
+			program, environ = '%s && %s' % (cls.getEnvActivationCommand(envDic), 'python'), cls.getEnviron()
+
 		if not popen:
-			protocol.runJob(fullProgram, args, env=cls.getEnviron(), cwd=cwd)
+			protocol.runJob(program, '%s %s' % (scriptName, args), env=environ, cwd=cwd)
 		else:
-			subprocess.check_call(fullProgram + args, cwd=cwd, shell=True)
+			subprocess.check_call('%s %s %s' % (program, scriptName, args), cwd=cwd, shell=True, env=environ)
+
+	# ---------------------------------- Environment resolution  -----------------------
+	_resolvedEnvs = {}
+
+	@classmethod
+	def _getEnvStamp(cls, envDic):
+		""" Stamp of the state of a conda environment: it changes whenever packages are installed or removed
+		(conda-meta/history is updated) or the activation command changes """
+		historyFile = cls.getEnvPath(packageDictionary=envDic, innerPath=os.path.join('conda-meta', 'history'))
+		mTime = os.path.getmtime(historyFile) if os.path.exists(historyFile) else 0
+		return '{}|{}'.format(mTime, cls.getEnvActivationCommand(envDic))
+
+	@classmethod
+	def _resolveEnv(cls, envDic):
+		""" Activates the conda environment once and returns the changes the activation makes to the current
+		environment: {'set': {var: value}, 'prepend': {var: prefix}, 'unset': [var]}. Path-like variables
+		extended by the activation (i.e: PATH) only keep the prefix added, so the rest of their value is
+		taken from the current environment whenever the changes are applied """
+		baseEnv = cls.getEnviron()
+		cline = '%s && env -0' % cls.getEnvActivationCommand(envDic)
+		output = subprocess.check_output(cline, shell=True, executable='/bin/bash', env=baseEnv)
+		envVars = {}
+		for varStr in output.decode().split('\0'):
+			if '=' in varStr:
+				key, value = varStr.split('=', 1)
+				envVars[key.strip()] = value
+
+		changes = {'set': {}, 'prepend': {}, 'unset': [key for key in baseEnv if key not in envVars]}
+		for key, value in envVars.items():
+			baseValue = baseEnv.get(key)
+			if value == baseValue or key in SHELL_VARS:
+				continue
+			if baseValue and value.endswith(os.pathsep + baseValue):
+				changes['prepend'][key] = value[:-len(baseValue)]
+			else:
+				changes['set'][key] = value
+		return changes
+
+	@classmethod
+	def _applyEnvChanges(cls, changes):
+		""" Applies the changes of a conda activation onto the current environment """
+		environ = cls.getEnviron()
+		for key in changes['unset']:
+			environ.pop(key, None)
+		environ.update(changes['set'])
+		for key, prefix in changes['prepend'].items():
+			environ[key] = prefix + environ[key] if environ.get(key) else prefix.rstrip(os.pathsep)
+		return environ
+
+	@classmethod
+	def getResolvedEnv(cls, envDic):
+		""" Returns the environment variables of a conda environment: the changes made by its activation, resolved
+		only once, applied onto the current environment. The changes are cached in memory and on disk, and
+		invalidated when the environment changes """
+		stamp = cls._getEnvStamp(envDic)
+		envName = cls.getEnvName(envDic)
+		if envName in cls._resolvedEnvs and cls._resolvedEnvs[envName]['stamp'] == stamp:
+			return cls._applyEnvChanges(cls._resolvedEnvs[envName]['changes'])
+
+		cacheFile = os.path.join(cls.getCacheDir('envs'), '{}.json'.format(envName))
+		resolved = None
+		if os.path.exists(cacheFile):
+			try:
+				with open(cacheFile) as f:
+					resolved = json.load(f)
+			except ValueError:
+				resolved = None
+		if not resolved or resolved.get('stamp') != stamp or 'changes' not in resolved:
+			resolved = {'stamp': stamp, 'changes': cls._resolveEnv(envDic)}
+			tmpFile = '{}.{}.tmp'.format(cacheFile, os.getpid())
+			with open(tmpFile, 'w') as f:
+				json.dump(resolved, f)
+			os.replace(tmpFile, cacheFile)
+
+		cls._resolvedEnvs[envName] = resolved
+		return cls._applyEnvChanges(resolved['changes'])
+
+	@classmethod
+	def getEnvEnviron(cls, envDic):
+		""" Returns the resolved environment of a conda environment as a pyworkflow Environ """
+		return Environ(cls.getResolvedEnv(envDic))
+
+	@classmethod
+	def getEnvProgram(cls, envDic, program):
+		""" Returns the full path of a program (e.g. python, mafft) inside the resolved conda environment """
+		progPath = shutil.which(program, path=cls.getResolvedEnv(envDic).get('PATH', ''))
+		if not progPath:
+			raise FileNotFoundError('{} not found in the {} environment'.format(program, envDic['name']))
+		return progPath
 
 	# ---------------------------------- Utils functions  -----------------------
 
@@ -91,6 +190,14 @@ class Plugin(pwchem.Plugin):
 	def getScriptsDir(cls, scriptName=''):
 		return cls.getPluginHome('scripts/%s' % scriptName)
 
+	@classmethod
+	def getCacheDir(cls, subDir='', create=True):
+		""" Returns (and creates, unless create is False) the directory where the plugin caches reusable files """
+		cacheDir = os.path.join(cls.getVar(MODELLER_CACHE), subDir)
+		if create:
+			os.makedirs(cacheDir, exist_ok=True)
+		return cacheDir
+
 	@classmethod
 	def getDependencies(cls):
 		# try to get CONDA activation command
@@ -31,4 +31,13 @@ AA_LIST = ['ALA', 'ARG', 'ASN', 'ASP', 'CYS', 'GLN', 'GLU', 'GLY',
            'THR', 'TRP', 'TYR', 'VAL']
 
 # Package & conda env dictionaries
-MODELLER_DIC = {'name': 'modeller', 'version': '10.4', 'home': 'MODELLER_HOME'}
\ No newline at end of file
+MODELLER_DIC = {'name': 'modeller', 'version': '10.4', 'home': 'MODELLER_HOME'}
+
+# Plugin variable with the directory where modeller inputs and results are cached
+MODELLER_CACHE = 'MODELLER_CACHE'
+
+# Output formats of the models and their file extensions
+OUTPUT_FORMATS = {'PDB': '.pdb', 'PDB (gzip)': '.pdb.gz', 'mmCIF (gzip)': '.cif.gz'}
+
+# Verbosity levels of the modeller log
+LOG_VERBOSITIES = ['None', 'Minimal', 'Verbose']
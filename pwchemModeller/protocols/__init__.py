@@ -6,3 +6,4 @@
 
 from .protocol_mutate_residue import ModellerMutateResidue
 from .protocol_comparative_modelling import ProtModellerComparativeModelling
+from .protocol_score_structures import ProtModellerScoreStructures
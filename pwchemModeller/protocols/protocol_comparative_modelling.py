@@ -32,24 +32,43 @@ alignable known structures
 
 """
 
-import os, json, shutil, glob, string
+import os, re, json, time, shutil, glob, string, contextlib
+import numpy as np
 from pyworkflow.protocol import params
 from pyworkflow.utils import Message
 from pwem.protocols import EMProtocol
-from pwem.objects.data import AtomStruct
-import pwem.convert as emconv
+import pyworkflow.object as pwobj
+from pwem.objects.data import AtomStruct, SetOfAtomStructs
 
-from pwchem import Plugin as pwchemPlugin
-from pwchem.utils.utilsFasta import parseAlnFile, parseFasta
-from pwchem.utils import getBaseName
 from pwchem.constants import BIOCONDA_DIC
 
 from pwchemModeller import Plugin
-from pwchemModeller.constants import MODELLER_DIC
+from pwchemModeller.constants import MODELLER_DIC, OUTPUT_FORMATS, LOG_VERBOSITIES
+from pwchemModeller.utils import TemplateManifest, prepareTemplates, rewritePIRAtomFiles, getNumberOfWorkers, \
+    MemoryEstimator, getAvailableMemory, getTotalMemory, loadCACoordinates, pairwiseRMSD, clusterByRMSD, \
+    collapseTemplates, \
+    AlignmentCache, readFasta, writeFasta, getAddAlignmentCommand, Alignment, \
+    checkAlignmentTemplates, ScratchDir, getScratchBaseDir, RETENTION_POLICIES, SYM_TOPOLOGIES, parseSymmetryGroups, \
+    getSymmetryPairs, parseResidueRanges, buildSymmetricOligomer, getInterfaceResidues, getFileHash, normalizeArgs, \
+    ResultStore, getAssemblyChains, getLongChainIds
+from pwchemModeller.utils.utilsAlignment import FULL, SUBSET, ADD
 
 AUTOMODELLER, CLUSTALO, MUSCLE, MAFFT, CUSTOM = 'AutoModeller', 'Clustal_Omega', 'Muscle', 'Mafft', 'Custom'
 chainAlph = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
 scoreChoices = ['DOPE', 'DOPE-HR', 'Normalized_DOPE', 'GA341']
+# Models output by modeller: <seq>.B9999NNNN.pdb, maybe as mmCIF and gzip compressed. NNNN is the model number
+MODEL_FILE_RE = re.compile(r'\.B9999(\d{4,})\.(pdb|cif)(\.gz)?$')
+# Result files of the modelling script staged back from the scratch directories
+STAGED_FILES = ['scores.txt', 'memory.json']
+
+# Options of the modelling script which do not change its results
+EXECUTION_ARGS = ['-i', '-af', '-pf', '-pd', '-pg', '-nj', '-v', '-mPath', '-s', '-rs']
+
+def isStagedFile(fileName):
+    return bool(MODEL_FILE_RE.search(fileName)) or fileName in STAGED_FILES or fileName.endswith('.log')
+
+def isStoredFile(fileName):
+    return bool(MODEL_FILE_RE.search(fileName)) or fileName == 'scores.txt'
 
 class ProtModellerComparativeModelling(EMProtocol):
     """
@@ -106,12 +125,21 @@ class ProtModellerComparativeModelling(EMProtocol):
                            'target sequences of each of the chains selected from the templates '
                            '(and in the same order!).\nYou can build this set of sequences using the '
                            '"define set of sequences" protocol')
+        group.addParam('batchMode', params.BooleanParam, default=False,
+                       label="Batch of targets: ", condition='not multiChain',
+                       help='Model a set of independent target sequences against the same set of templates. '
+                            'Templates are prepared once, each target is aligned to them and every '
+                            '(target, model) pair is run as an independent task in a shared pool of workers.')
         group.addParam('inputSequence', params.PointerParam,
                        pointerClass='Sequence', allowsNull=True,
-                       label="Input sequence to predict: ", condition='not multiChain',
+                       label="Input sequence to predict: ", condition='not multiChain and not batchMode',
                        help='Select the sequence whose atomic structure will be predicted')
+        group.addParam('inputBatchSequences', params.PointerParam,
+                       pointerClass='SetOfSequences', allowsNull=True,
+                       label="Input target sequences: ", condition='not multiChain and batchMode',
+                       help='Select the independent sequences whose atomic structures will be predicted')
         group.addParam('inSeqPositions', params.StringParam,
-                       label='Input sequence positions: ', condition='not multiChain',
+                       label='Input sequence positions: ', condition='not multiChain and not batchMode',
                        help='Specify the positions of the input sequence to use in the alignment. '
                             'If None, modeller will use the whole sequence')
         group.addParam('inputSequences', params.PointerParam,
@@ -134,6 +162,76 @@ class ProtModellerComparativeModelling(EMProtocol):
         group.addParam('modelH', params.BooleanParam, default=False,
                        label="Build model hydrogens: ",
                        help='Build also model hydrogens')
+        group.addParam('hydrogensMode', params.EnumParam, default=0, condition='modelH and not batchMode',
+                       label="Hydrogens on: ", choices=['All models', 'Top models'],
+                       help='All models: every model is built and optimized with all its hydrogens, which roughly '
+                            'doubles the number of atoms and the modelling time.\n'
+                            'Top models: the models are built with heavy atoms only and the hydrogens are added '
+                            'afterwards, only to the best scored models, optimizing only the hydrogens')
+        group.addParam('hydrogensTopK', params.IntParam, default=1,
+                       condition='modelH and not batchMode and hydrogensMode==1',
+                       label="Number of top models: ",
+                       help='Number of best scored output models (DOPE score, if computed) which get hydrogens')
+        group.addParam('outputFormat', params.EnumParam, default=0,
+                       label="Output format: ", choices=list(OUTPUT_FORMATS.keys()),
+                       help='Format of the output models. The gzip compressed formats reduce the storage and I/O '
+                            'when many models are generated')
+        group.addParam('clusterModels', params.BooleanParam, default=False,
+                       label="Cluster output models: ", condition='not batchMode',
+                       help='Cluster the output models by their C-alpha RMSD and output only one representative per '
+                            'cluster (the one with the lowest DOPE score, if computed), to avoid redundant models.')
+        group.addParam('clusterRMSD', params.FloatParam, default=2.0,
+                       label="Clustering RMSD threshold (A): ", condition='clusterModels and not batchMode',
+                       help='Maximum C-alpha RMSD (after superposition) between a cluster representative and its '
+                            'members')
+
+        group = form.addGroup('Homo-oligomer', condition='not multiChain and not batchMode')
+        group.addParam('buildOligomer', params.BooleanParam, default=False,
+                       label="Build homo-oligomer from protomer: ",
+                       help='Model a single protomer and build the homo-oligomer placing copies of it with the '
+                            'symmetry operators of a multi-chain template. Large cyclic or dihedral assemblies then '
+                            'cost about the modelling of one chain')
+        group.addParam('oligomerTemplate', params.PointerParam, pointerClass='AtomStruct', allowsNull=True,
+                       label="Assembly template: ", condition='buildOligomer',
+                       help='Multi-chain structure whose chains define the symmetry operators of the assembly')
+        group.addParam('oligomerChains', params.StringParam, default='',
+                       label="Assembly chains: ", condition='buildOligomer',
+                       help='Comma separated chains of the assembly template to place the protomer copies on. The '
+                            'protomer is fitted on the first one. Blank uses all the chains of the template')
+        group.addParam('refineInterface', params.BooleanParam, default=True,
+                       label="Refine interface: ", condition='buildOligomer',
+                       help='Run a short optimization of the residues in the interfaces between the copies')
+        group.addParam('interfaceCutoff', params.FloatParam, default=6.0, expertLevel=params.LEVEL_ADVANCED,
+                       label="Interface distance (A): ", condition='buildOligomer and refineInterface',
+                       help='Residues with atoms closer than this distance to another chain are refined')
+        group.addParam('refineIterations', params.IntParam, default=200, expertLevel=params.LEVEL_ADVANCED,
+                       label="Refinement iterations: ", condition='buildOligomer and refineInterface',
+                       help='Maximum number of conjugate gradients iterations of the interface refinement')
+
+        group = form.addGroup('Template search', condition='not multiChain and not batchMode')
+        group.addParam('searchIndexDir', params.PathParam, default='',
+                       label='Template index directory: ',
+                       help='Directory of the local k-mer index of template chains used by the "Search templates" '
+                            'wizard. It is created if it does not exist')
+        group.addParam('searchSource', params.PathParam, default='', expertLevel=params.LEVEL_ADVANCED,
+                       label='Index structures from: ',
+                       help='Directory of PDB/mmCIF files (maybe gzip compressed, searched recursively) or SEQRES '
+                            'dump (pdb_seqres.txt format) to index. Only new or modified files are parsed when the '
+                            'index is updated. Blank only searches the existing index')
+        group.addParam('searchMaxHits', params.IntParam, default=5,
+                       label='Maximum templates to add: ',
+                       help='Maximum number of template chains added to the list of templates, ranked by sequence '
+                            'identity x coverage of the target')
+        group.addParam('searchMinIdentity', params.FloatParam, default=0.3, expertLevel=params.LEVEL_ADVANCED,
+                       label='Minimum sequence identity: ',
+                       help='Minimum sequence identity (0-1) of the local alignment of a template chain with the '
+                            'target')
+        group.addParam('searchTemplates', params.LabelParam,
+                       label='Search templates',
+                       help='Search the local template index with the target sequence (updating it first from the '
+                            'indexed source, if any) and add the best chains and ranges found to the list of '
+                            'templates. Chains found in a SEQRES dump are located in the local PDB mirror or '
+                            'downloaded')
 
         group = form.addGroup('Structure templates')
         group.addParam('templateOrigin', params.EnumParam, default=0,
@@ -143,6 +241,31 @@ class ProtModellerComparativeModelling(EMProtocol):
         group.addParam('templateList', params.TextParam, width=100,
                        default='', label='List of templates: ',
                        help='The list of templates to use for the comparative modelling.')
+        group.addParam('templatesMirror', params.PathParam, default='', expertLevel=params.LEVEL_ADVANCED,
+                       label='Local PDB mirror: ',
+                       help='Local directory where the structures of the templates defined by PDB code are looked '
+                            'for before trying to download them (flat or divided PDB archive layout, '
+                            'compressed or not).')
+        group.addParam('trimTemplates', params.BooleanParam, default=False, expertLevel=params.LEVEL_ADVANCED,
+                       label='Trim templates: ',
+                       help='Write template structures containing only the chains and ranges used in the alignment, '
+                            'so modeller does not need to read the whole (maybe huge) template files. '
+                            'Trimmed templates are cached and reused between runs.')
+        group.addParam('collapseTemplates', params.BooleanParam, default=False,
+                       label='Collapse redundant templates: ',
+                       help='Cluster the templates by sequence identity and, after superposition, by C-alpha RMSD, '
+                            'and keep only the best template of each cluster. Redundant templates add modelling time '
+                            'but little information. The dropped templates are reported in the summary')
+        group.addParam('collapseIdentity', params.FloatParam, default=0.95, condition='collapseTemplates',
+                       expertLevel=params.LEVEL_ADVANCED, label='Minimum sequence identity: ',
+                       help='Minimum sequence identity (0-1) of two templates to be considered redundant')
+        group.addParam('collapseRMSD', params.FloatParam, default=1.0, condition='collapseTemplates',
+                       expertLevel=params.LEVEL_ADVANCED, label='Maximum C-alpha RMSD (A): ',
+                       help='Maximum C-alpha RMSD of two superposed templates to be considered redundant')
+        group.addParam('collapseKeep', params.EnumParam, default=0, condition='collapseTemplates',
+                       label='Keep the template with: ', choices=['Best resolution', 'Most complete'],
+                       help='Template kept in each cluster of redundant templates: the one with best resolution '
+                            'or the one with most resolved residues. The other criterion breaks the ties')
 
         group = form.addGroup('Alignment')
         group.addParam('alignMethod', params.EnumParam,
@@ -168,6 +291,36 @@ class ProtModellerComparativeModelling(EMProtocol):
 
 
         form.addSection(label='Other parameters')
+        group = form.addGroup('Logging', expertLevel=params.LEVEL_ADVANCED)
+        group.addParam('logVerbosity', params.EnumParam, default=1,
+                       label='Modeller log verbosity: ', choices=LOG_VERBOSITIES,
+                       help='Verbosity of the modeller log. The verbose log grows by megabytes per model. The '
+                            'progress of the models is always reported in the summary')
+        group = form.addGroup('Scratch', expertLevel=params.LEVEL_ADVANCED)
+        group.addParam('useScratch', params.BooleanParam, default=False,
+                       label='Run in node-local scratch: ',
+                       help='Run modeller in a node-local scratch directory instead of the project directory, so its '
+                            'many intermediate files (.ini, .rsr, .sch, .D000*, .V999*) are not written to shared '
+                            'storage. Only the models, scores and logs are copied back')
+        group.addParam('scratchDir', params.StringParam, default='', condition='useScratch',
+                       label='Scratch directory: ',
+                       help='Node-local directory where the scratch working directories are created '
+                            '(e.g: /dev/shm). Blank uses $TMPDIR or the system temporary directory')
+        group.addParam('keepIntermediates', params.EnumParam, default=1, condition='useScratch',
+                       label='Keep intermediate files: ', choices=RETENTION_POLICIES,
+                       help='When to copy the modeller intermediate files from the scratch directory to the '
+                            '"intermediates" folder of the job. The scratch directory is always removed, '
+                            'also when the job fails')
+        group = form.addGroup('Result store', expertLevel=params.LEVEL_ADVANCED)
+        group.addParam('useResultStore', params.BooleanParam, default=False,
+                       label='Reuse stored results: ',
+                       help='Look for the results of each modelling run in a store shared by all the projects, '
+                            'keyed by the hash of its inputs (templates, alignment, target, options and seed). '
+                            'Runs with identical inputs reuse the stored models and scores instead of running '
+                            'modeller again, and new results are added to the store')
+        group.addParam('resultStoreSize', params.FloatParam, default=10.0, condition='useResultStore',
+                       label='Maximum store size (GB): ',
+                       help='When the store grows over this size, the least recently used results are removed')
         group = form.addGroup('Renaming', expertLevel=params.LEVEL_ADVANCED)
         group.addParam('renumberResidues', params.StringParam, default='', label="Renumber residues: ",
                        help='Renumber residues so each chain first residue index is the one specified.'
@@ -179,11 +332,30 @@ class ProtModellerComparativeModelling(EMProtocol):
                             'names to refer to the chains. Blank will not rename.')
 
         group = form.addGroup('Symmetry', condition='multiChain')
+        group.addParam('symMode', params.EnumParam, default=0,
+                       label='Symmetry definition: ', condition='multiChain', choices=['Chain pairs', 'Chain groups'],
+                       help='Define the symmetry restraints by explicit chain pairs or by groups of equivalent chains '
+                            '(recommended for large homo-oligomers)')
         group.addParam('symChains', params.StringParam, default='',
-                       label='Symmetry chains: ', condition='multiChain',
+                       label='Symmetry chains: ', condition='multiChain and symMode==0',
                        help='Specify the chains to model with symmetry. Comma separated chain pairs, in alphabetic '
                             'order corresponding to the input sequences. \ni.e: symmetry for chains first and third;'
                             ' second and fourth (hemoglobin), parameter must be: *A-C, B-D*')
+        group.addParam('symGroups', params.StringParam, default='',
+                       label='Symmetry groups: ', condition='multiChain and symMode==1',
+                       help='Groups of equivalent chains, comma separated chains and semicolon separated groups.\n'
+                            'i.e: a homo-tetramer and a homo-dimer in the same complex: *A,B,C,D; E,F*')
+        group.addParam('symTopology', params.EnumParam, default=0,
+                       label='Groups topology: ', condition='multiChain and symMode==1', choices=SYM_TOPOLOGIES,
+                       help='Chain pairs of each group restrained by symmetry:\n'
+                            'Reference: every chain with the first one of the group (n-1 restraints)\n'
+                            'Ring: every chain with the next one, closing the ring (n restraints)\n'
+                            'All pairs: every pair of chains of the group (n(n-1)/2 restraints, expensive for large '
+                            'groups)')
+        group.addParam('symRanges', params.StringParam, default='',
+                       label='Symmetry residue ranges: ', condition='multiChain',
+                       help='Restrict the symmetry restraints to these residue ranges of the chains (i.e: the '
+                            'structured core), comma separated. i.e: *10-120, 150-200*. Blank uses the whole chains')
         group.addParam('symAtom', params.StringParam, default='CA',
                        label='Symmetry atoms: ', condition='multiChain',
                        help='In order to accelerate the symmetry calculation, the symmetry distances will be '
@@ -196,7 +368,16 @@ class ProtModellerComparativeModelling(EMProtocol):
                           label=f"Report {scoreName} score: ")
 
         group = form.addGroup('Optimization')
-        group.addParam('opt', params.EnumParam,
+        group.addParam('stagedRefinement', params.BooleanParam, default=False, condition='not batchMode',
+                       label='Coarse-to-fine generation: ',
+                       help='Generate the models with the Low-Fast optimization (randomized) and refine only the best '
+                            'scored ones (DOPE score) with the High-Slow optimization, starting from their '
+                            'coordinates. High-Slow quality on the best candidates at a fraction of the cost')
+        group.addParam('refineTopK', params.IntParam, default=1, condition='stagedRefinement and not batchMode',
+                       label='Number of models to refine: ',
+                       help='Number of best scored coarse models refined with the High-Slow optimization. Only '
+                            'these refined models are output')
+        group.addParam('opt', params.EnumParam, condition='not stagedRefinement or batchMode',
                        label='Optimization quality: ', default=1,
                        choices=['Low-Fast', 'Default', 'High-Slow'],
                        help="Modeller allows to modify how fast the optimization will be performed. Fast optimizations"
@@ -204,41 +385,317 @@ class ProtModellerComparativeModelling(EMProtocol):
         group.addParam('nReps', params.IntParam, default=1,
                        label="Number of optimization cycles: ",
                        help='Number of optimization cycles, including the energy optimization and Molecular Dynamics')
+        group.addParam('seed', params.IntParam, default=-8123, expertLevel=params.LEVEL_ADVANCED,
+                       label='Random seed: ', help='Random seed for modeller')
         form.addParallelSection(threads=4, mpi=1)
 
     # --------------------------- STEPS functions ------------------------------
     def _insertAllSteps(self):
         # Insert processing steps
+        self._insertFunctionStep('compileTemplatesStep')
+        prepId = self._insertFunctionStep('prepareTemplatesStep')
+        if self.collapseTemplates.get():
+            prepId = self._insertFunctionStep('collapseTemplatesStep')
+        if self.isBatch():
+            self._insertBatchSteps(prepId)
+            return
+
         self._insertFunctionStep('alignStep')
-        self._insertFunctionStep('modellerStep')
+        self._insertFunctionStep('preflightStep')
+        modelId = self._insertFunctionStep('modellerStep')
+        if self.isStaged():
+            refineIds = [self._insertFunctionStep('refineStep', rank, prerequisites=[modelId])
+                         for rank in range(self.getNumberOfRefinedModels())]
+            self._insertFunctionStep('collectRefinedStep', prerequisites=refineIds)
+        if self.clusterModels.get():
+            self._insertFunctionStep('clusterStep')
+        if self.isOligomerMode():
+            self._insertFunctionStep('oligomerStep')
+        if self.isTopHydrogens():
+            self._insertFunctionStep('hydrogensStep')
         self._insertFunctionStep('createOutputStep')
 
+    def _insertBatchSteps(self, prepId):
+        alignIds, modelIds = [], []
+        for seqObj in self.inputBatchSequences.get():
+            targetId = self.getTargetID(seqObj)
+            alignIds.append(self._insertFunctionStep('alignBatchStep', targetId, prerequisites=[prepId]))
+
+        # All the alignments are checked before launching any modeller process
+        preflightId = self._insertFunctionStep('preflightStep', prerequisites=alignIds)
+        # The initial model and restraints of each target are built once and shared by all its models
+        restraintsIds = [self._insertFunctionStep('restraintsBatchStep', self.getTargetID(seqObj),
+                                                  prerequisites=[preflightId])
+                         for seqObj in self.inputBatchSequences.get()]
+        # The models are distributed among warm modeller workers, each building its models in a single process
+        for workerIdx in range(self.getNumberOfBatchWorkers()):
+            modelIds.append(self._insertFunctionStep('modellerBatchStep', workerIdx, prerequisites=restraintsIds))
+        self._insertFunctionStep('createBatchOutputStep', prerequisites=modelIds)
+
+    def compileTemplatesStep(self):
+        manifest = TemplateManifest.fromTemplateList(self.templateList.get())
+        manifest.write(self.getTemplateManifestFile())
+
+    def prepareTemplatesStep(self):
+        pdbsFile = self.buildPDBsFile()
+
+    def collapseTemplatesStep(self):
+        manifest = self.getTemplateManifest()
+        keepBest = 'completeness' if self.collapseKeep.get() == 1 else 'resolution'
+        keptEntries, dropped = collapseTemplates(manifest, self.collapseIdentity.get(), self.collapseRMSD.get(),
+                                                 keepBest=keepBest)
+        with open(self.getCollapsedFile(), 'w') as f:
+            json.dump(dropped, f, indent=2)
+
+        manifest = TemplateManifest(keptEntries)
+        self.writePDBsFile(manifest)
+        manifest.write(self.getTemplateManifestFile())
+
     def alignStep(self):
         alignFile = self.buildAlignFile()
 
+    def preflightStep(self):
+        if self.isBatch():
+            alignFiles = [self.getAlignmentFile(self.getTargetID(seqObj)) for seqObj in self.inputBatchSequences.get()]
+        else:
+            alignFiles = [self.getAlignmentFile()]
+
+        errors = []
+        for alignFile in alignFiles:
+            errors += checkAlignmentTemplates(alignFile, [self._getPath(), self._getExtraPath()])
+        if errors:
+            raise Exception('The alignment does not match the template structures:\n' + '\n'.join(errors))
+
     def modellerStep(self):
-        pdbsFile = self.buildPDBsFile()
-        Plugin.runScript(self, 'comparative_modelling.py', args=self._getModellerArgs(),
-                         envDic=MODELLER_DIC, cwd=self._getPath())
+        self.runModeller(self._getModellerArgs(), self._getPath())
+        self.recordPeakMemory(self._getPath('memory.json'))
+
+    def refineStep(self, rank):
+        modelFiles = self.getModelFiles()
+        outIds = self.getTopModelIds(list(modelFiles), self.getNumberOfRefinedModels())
+        if rank < len(outIds):
+            outId = outIds[rank]
+            refineDir = self.getRefineDir(outId)
+            os.makedirs(refineDir, exist_ok=True)
+            self.runModeller(self._getModellerArgs(modelIdx=outId, refineFile=modelFiles[outId]), refineDir)
+
+    def collectRefinedStep(self):
+        # The coarse models are kept apart and replaced by the refined ones, with their scores
+        coarseDir = self._getExtraPath('coarse')
+        os.makedirs(coarseDir, exist_ok=True)
+        for modelFile in self.getModelFiles().values():
+            shutil.move(modelFile, os.path.join(coarseDir, os.path.basename(modelFile)))
+        if os.path.exists(self._getPath('scores.txt')):
+            shutil.move(self._getPath('scores.txt'), os.path.join(coarseDir, 'scores.txt'))
+
+        scoresStr = ''
+        for refineDir in sorted(glob.glob(self.getRefineDir('*'))):
+            for file in os.listdir(refineDir):
+                if MODEL_FILE_RE.search(file):
+                    shutil.move(os.path.join(refineDir, file), self._getPath(file))
+            if os.path.exists(os.path.join(refineDir, 'scores.txt')):
+                with open(os.path.join(refineDir, 'scores.txt')) as f:
+                    scoresStr += f.read()
+        if scoresStr:
+            with open(self._getPath('scores.txt'), 'w') as f:
+                f.write(scoresStr)
+
+    def oligomerStep(self):
+        templateFile = os.path.abspath(self.oligomerTemplate.get().getFileName())
+        chains = self.getOligomerChains()
+        os.makedirs(self._getExtraPath('oligomers'), exist_ok=True)
+
+        for outId, modelFile in self.getOutputModelFiles().items():
+            oligomerFile = self.getOligomerFile(outId)
+            if not self.refineInterface.get():
+                buildSymmetricOligomer(modelFile, templateFile, chains, oligomerFile)
+                continue
+
+            rawFile = self.getOligomerFile(outId, suffix='_raw')
+            oligomer = buildSymmetricOligomer(modelFile, templateFile, chains, rawFile)
+            residuesFile = self._getExtraPath('oligomers', 'interface_{}.txt'.format(outId))
+            with open(residuesFile, 'w') as f:
+                for resNumber, chain in getInterfaceResidues(oligomer, self.interfaceCutoff.get()):
+                    f.write('{}:{}\n'.format(resNumber, chain))
+
+            args = ['-i', rawFile, '-r', os.path.abspath(residuesFile), '-o', oligomerFile,
+                    '-n', self.refineIterations.get(), '-v', self.getEnumText('logVerbosity').lower()]
+            Plugin.runScript(self, 'refine_interface.py', args=args, envDic=MODELLER_DIC,
+                             cwd=self._getExtraPath('oligomers'))
+            os.remove(rawFile)
+
+    def hydrogensStep(self):
+        outFiles = self.getOutputStructFiles()
+        os.makedirs(self._getExtraPath('hydrogens'), exist_ok=True)
+        with open(self.getHydrogensListFile(), 'w') as f:
+            for outId in self.getTopModelIds(list(outFiles), self.hydrogensTopK.get()):
+                f.write('{} {}\n'.format(outFiles[outId], self.getHydrogensFile(outId)))
+
+        args = ['-i', os.path.abspath(self.getHydrogensListFile()), '-v', self.getEnumText('logVerbosity').lower()]
+        Plugin.runScript(self, 'add_hydrogens.py', args=args, envDic=MODELLER_DIC,
+                         cwd=self._getExtraPath('hydrogens'))
+
+    def clusterStep(self):
+        modelFiles = self.getModelFiles()
+        outIds = sorted(modelFiles)
+        scoresDic = self.parseScoresFile()
+        scores = None
+        if all(['DOPE score' in scoresDic.get(outId, {}) for outId in outIds]):
+            scores = np.array([scoresDic[outId]['DOPE score'] for outId in outIds])
+
+        rmsd = pairwiseRMSD(loadCACoordinates([modelFiles[outId] for outId in outIds]))
+        clusters = clusterByRMSD(rmsd, scores, threshold=self.clusterRMSD.get())
+        for cluster in clusters:
+            cluster['representative'] = outIds[cluster['representative']]
+            cluster['members'] = [outIds[idx] for idx in cluster['members']]
+
+        with open(self.getClustersFile(), 'w') as f:
+            json.dump(clusters, f, indent=2)
+
+    def alignBatchStep(self, targetId):
+        alignFile = self.buildAlignFile(self.getBatchSequence(targetId), self.getAlignmentFile(targetId))
+
+    def restraintsBatchStep(self, targetId):
+        restraintsDir = self.getBatchRestraintsDir(targetId)
+        os.makedirs(restraintsDir, exist_ok=True)
+        args = self._getModellerArgs(targetId, 1) + ['--restraintsOnly']
+        self.runWarmWorker([{'name': '{}_restraints'.format(targetId), 'workDir': restraintsDir, 'argv': args}],
+                           os.path.join(restraintsDir, 'jobs.jsonl'))
+
+    def modellerBatchStep(self, workerIdx):
+        """ Builds the batch models assigned to a worker in a single warm modeller worker process. The models found
+        in the result store are restored instead """
+        jobs, ranTasks = [], {}
+        with contextlib.ExitStack() as scratchDirs:
+            for targetId, modelIdx in self.getBatchWorkerTasks(workerIdx):
+                taskDir = self.getBatchTaskDir(targetId, modelIdx)
+                os.makedirs(taskDir, exist_ok=True)
+                args = self._getModellerArgs(targetId, modelIdx) + ['-rs', self.getBatchRestraintsDir(targetId)]
+                if self.restoreModelling(args, taskDir):
+                    continue
+
+                workDir = scratchDirs.enter_context(self.getScratchDir(taskDir)).path if self.useScratch.get() \
+                    else taskDir
+                jobs.append({'name': os.path.basename(taskDir), 'workDir': workDir, 'argv': args})
+                ranTasks[workDir] = (targetId, taskDir, args)
+
+            if jobs:
+                self.runWarmWorker(jobs, self._getExtraPath('batch', 'worker_{}_jobs.jsonl'.format(workerIdx)))
+
+        for targetId, taskDir, args in ranTasks.values():
+            self.storeModelling(args, taskDir)
+            self.recordPeakMemory(os.path.join(taskDir, 'memory.json'), self.getBatchSequence(targetId))
+
+    def runWarmWorker(self, jobs, jobsFile):
+        """ Runs the jobs in order in a single warm modeller worker process, which keeps modeller loaded between
+        them while running each job as a fresh process would. Raises an exception if any job failed """
+        resultsFile = jobsFile.replace('.jsonl', '_results.jsonl')
+        with open(jobsFile, 'w') as f:
+            for job in jobs:
+                f.write(json.dumps(dict(job, type='comparative', argv=[str(arg) for arg in job['argv']])) + '\n')
+        if os.path.exists(resultsFile):
+            os.remove(resultsFile)
+
+        Plugin.runScript(self, 'modeller_worker.py', args=['-i', jobsFile, '-o', resultsFile], envDic=MODELLER_DIC)
+        with open(resultsFile) as f:
+            results = [json.loads(line) for line in f if line.strip()]
+        errors = ['{}: {}'.format(res['name'], res['error']) for res in results if res['status'] != 'ok']
+        if len(results) < len(jobs):
+            errors.append('{} of {} jobs did not finish'.format(len(jobs) - len(results), len(jobs)))
+        if errors:
+            raise Exception('Modeller worker jobs failed:\n' + '\n'.join(errors))
+        return results
+
+    def getNumberOfBatchWorkers(self):
+        nTasks = len(self.inputBatchSequences.get()) * self.getNumberOfModels()
+        return max(1, min(self.numberOfThreads.get(), nTasks))
+
+    def getBatchWorkerTasks(self, workerIdx):
+        """ (targetId, modelIdx) of the batch models built by a worker """
+        tasks = [(self.getTargetID(seqObj), modelIdx) for seqObj in self.inputBatchSequences.get()
+                 for modelIdx in range(1, self.getNumberOfModels() + 1)]
+        return tasks[workerIdx::self.getNumberOfBatchWorkers()]
+
+    def createBatchOutputStep(self):
+        outASs = SetOfAtomStructs.create(self._getPath())
+        for seqObj in self.inputBatchSequences.get():
+            targetId = self.getTargetID(seqObj)
+            for modelIdx in range(1, self.getNumberOfModels() + 1):
+                taskDir = self.getBatchTaskDir(targetId, modelIdx)
+                for file in os.listdir(taskDir):
+                    if MODEL_FILE_RE.search(file):
+                        outFile = self._getPath('{}_model_{}{}'.format(targetId, modelIdx, self.getOutputExtension()))
+                        shutil.move(os.path.join(taskDir, file), outFile)
+
+                        modellerAS = AtomStruct(outFile)
+                        modellerAS._targetId = pwobj.String(targetId)
+                        modellerAS._targetName = pwobj.String(seqObj.getSeqName())
+                        modellerAS._modelIdx = pwobj.Integer(modelIdx)
+                        outASs.append(modellerAS)
+
+        self._defineOutputs(outputAtomStructs=outASs)
 
     def createOutputStep(self):
-        for file in os.listdir(self._getPath()):
-            if file.endswith('.pdb'):
-                outFile = self._getPath(file)
-                outId = int(os.path.splitext(outFile)[0][-2:])
-
-                modellerAS = AtomStruct(outFile)
-                self._defineOutputs(**{'outputAtomStruct_{}'.format(outId): modellerAS})
+        clusterSizes = None
+        if os.path.exists(self.getClustersFile()):
+            with open(self.getClustersFile()) as f:
+                clusterSizes = {cluster['representative']: cluster['size'] for cluster in json.load(f)}
+
+        structFiles = self.getOutputStructFiles()
+        for outId, outFile in self.getOutputModelFiles().items():
+            hydrogensFile = self.getHydrogensFile(outId)
+            modellerAS = AtomStruct(hydrogensFile if os.path.exists(hydrogensFile) else structFiles[outId])
+            if self.isOligomerMode():
+                modellerAS._protomerFile = pwobj.String(outFile)
+            if self.isTopHydrogens():
+                modellerAS._hydrogens = pwobj.Boolean(os.path.exists(hydrogensFile))
+            if clusterSizes is not None:
+                modellerAS._clusterSize = pwobj.Integer(clusterSizes[outId])
+            self._defineOutputs(**{'outputAtomStruct_{}'.format(outId): modellerAS})
 
     # --------------------------- INFO functions -----------------------------------
     def _summary(self):
         summary = []
+        finished, total, eta = self.getProgress()
+        if 0 < finished < total:
+            etaStr = ', ETA {}'.format(time.strftime('%H:%M:%S', time.gmtime(eta))) if eta is not None else ''
+            summary.append('Progress: {}/{} models ({:.0f}%){}'.format(finished, total, 100 * finished / total, etaStr))
         scoresFile = self._getPath('scores.txt')
-        if os.path.exists(scoresFile):
+        if self.isBatch():
+            for taskDir in sorted(glob.glob(self._getExtraPath('batch', '*'))):
+                taskScoresFile = os.path.join(taskDir, 'scores.txt')
+                if os.path.exists(taskScoresFile):
+                    with open(taskScoresFile) as fSc:
+                        summary.append('{}: {}'.format(os.path.basename(taskDir), fSc.read().strip()))
+        elif os.path.exists(scoresFile):
             summary.append('GA341 score ranges from 0 to 1, the higher the better\n')
             summary.append('Rest of scores for the generated models are energy-like, the lower the better)\n')
             with open(scoresFile) as fSc:
               summary.append(fSc.read())
+
+        if self.isStaged() and os.path.exists(self._getExtraPath('coarse')):
+            summary.append('Coarse-to-fine: the {} best of {} Low-Fast models were refined with the High-Slow '
+                           'optimization (coarse models and scores in extra/coarse)'.
+                           format(self.getNumberOfRefinedModels(), self.getNumberOfModels()))
+
+        if os.path.exists(self.getCollapsedFile()):
+            with open(self.getCollapsedFile()) as f:
+                dropped = json.load(f)
+            summary.append('{} redundant templates dropped{}'.format(len(dropped), ':' if dropped else ''))
+            for drop in dropped:
+                summary.append('{} (resolution {}, completeness {:.0f}%): redundant with {} (identity {:.0f}%, '
+                               'RMSD {:.2f} A)'.format(drop['code'], drop['resolution'] or 'unknown',
+                                                       100 * drop['completeness'], drop['representative'],
+                                                       100 * drop['identity'], drop['rmsd']))
+
+        if os.path.exists(self.getClustersFile()):
+            with open(self.getClustersFile()) as f:
+                clusters = json.load(f)
+            summary.append('{} clusters of models (RMSD threshold {} A):'.format(len(clusters), self.clusterRMSD.get()))
+            for cluster in clusters:
+                summary.append('Representative outputAtomStruct_{}: {} models (mean RMSD {:.2f} A, max {:.2f} A)'.
+                               format(cluster['representative'], cluster['size'], cluster['meanRMSD'],
+                                      cluster['maxRMSD']))
         return summary
 
     def _methods(self):
@@ -249,10 +706,62 @@ class ProtModellerComparativeModelling(EMProtocol):
         errors = []
         if self.adIni and not self.iniModel.get():
             errors.append('You have not specified the initial model')
+        if not errors and self.hasTargetInput():
+            estMemory, totalMemory = self.estimateWorkerMemory(), getTotalMemory()
+            if estMemory > totalMemory:
+                errors.append('The estimated peak memory of a single modeller worker ({:.1f} GB) is larger than the '
+                              'total memory of this node ({:.1f} GB). Reduce the size of the target, the number of '
+                              'templates or disable the hydrogens or symmetry restraints'.
+                              format(estMemory / 2**30, totalMemory / 2**30))
+        if self.isStaged() and self.refineTopK.get() < 1:
+            errors.append('The number of coarse models to refine must be at least 1')
+        if self.isTopHydrogens() and self.hydrogensTopK.get() < 1:
+            errors.append('The number of top models getting hydrogens must be at least 1')
+        if self.collapseTemplates.get() and self.getEnumText('alignMethod') == CUSTOM:
+            errors.append('Redundant templates cannot be collapsed with a custom alignment, which must contain '
+                          'all the templates')
+        if self.isOligomerMode() and not self.oligomerTemplate.get():
+            errors.append('You have not specified the assembly template to build the homo-oligomer')
+        elif self.isOligomerMode() and not self.getOutputExtension().startswith('.cif'):
+            longChains = getLongChainIds(getAssemblyChains(self.oligomerTemplate.get().getFileName(),
+                                                           self.getOligomerChains()))
+            if longChains:
+                errors.append('The assembly chains {} have more than one character and do not fit in the PDB format. '
+                              'Choose the mmCIF output format'.format(', '.join(longChains)))
+        if self.multiChain.get() and self.symMode.get() == 1:
+            groups = parseSymmetryGroups(self.symGroups.get() or '')
+            if not groups:
+                errors.append('You have not specified any symmetry group')
+            for group in groups:
+                if len(group) < 2:
+                    errors.append('Symmetry group {} must contain at least two chains'.format(','.join(group)))
+        if self.multiChain.get() and self.symRanges.get() and self.symRanges.get().strip():
+            try:
+                parseResidueRanges(self.symRanges.get())
+            except ValueError:
+                errors.append('Symmetry residue ranges must be comma separated ranges, i.e: 10-120, 150-200')
+        if self.isBatch():
+            if not self.inputBatchSequences.get():
+                errors.append('You have not specified the set of target sequences')
+            if self.getEnumText('alignMethod') == CUSTOM:
+                errors.append('Custom alignments cannot be used with a batch of targets')
+            if self.adIni:
+                errors.append('Initial models cannot be used with a batch of targets')
         return errors
 
     def _warnings(self):
         warns = []
+        if self.hasTargetInput():
+            estMemory, availMemory = self.estimateWorkerMemory(), getAvailableMemory()
+            nThreads = min(self.numberOfThreads.get(), self.getNumberOfModels())
+            if estMemory > availMemory:
+                warns.append('The estimated peak memory of a modeller worker ({:.1f} GB) is larger than the memory '
+                             'currently available ({:.1f} GB). The run may run out of memory'.
+                             format(estMemory / 2**30, availMemory / 2**30))
+            elif estMemory * nThreads > availMemory:
+                warns.append('The available memory ({:.1f} GB) only allows {} modeller workers of {:.1f} GB estimated '
+                             'peak memory, so the number of workers will be reduced from {}'.
+                             format(availMemory / 2**30, int(availMemory // estMemory), estMemory / 2**30, nThreads))
         if self.getEnumText('alignMethod') == CUSTOM:
             warns.append('The custom input alignment must be conformed by the same sequences and positions defined in '
                          'this formulary, including the target and template sequences. You can build such a set of '
@@ -261,6 +770,159 @@ class ProtModellerComparativeModelling(EMProtocol):
         return warns
     
     # --------------------------- UTILS functions ------------------------
+    def isBatch(self):
+        return self.batchMode.get() and not self.multiChain.get()
+
+    def getBatchSequence(self, targetId):
+        for seqObj in self.inputBatchSequences.get():
+            if self.getTargetID(seqObj) == targetId:
+                return seqObj.clone()
+
+    def getBatchTaskDir(self, targetId, modelIdx):
+        return os.path.abspath(self._getExtraPath('batch', '{}_{}'.format(targetId, modelIdx)))
+
+    def getBatchRestraintsDir(self, targetId):
+        return os.path.abspath(self._getExtraPath('batch', '{}_restraints'.format(targetId)))
+
+    def getTargetLength(self):
+        if self.multiChain.get():
+            return sum([len(self.getTargetSequence(seqObj)) for seqObj in self.inputSequences.get()])
+        elif self.isBatch():
+            return max([len(seqObj.getSequence()) for seqObj in self.inputBatchSequences.get()])
+        return len(self.getTargetSequence())
+
+    def getNumberOfTemplates(self):
+        """ Number of templates used: once collapsed, only the templates kept in the manifest """
+        if os.path.exists(self.getCollapsedFile()):
+            return len(self.getTemplateManifest())
+        return len([tempLine for tempLine in self.templateList.get().split('\n') if tempLine.strip()])
+
+    def hasTargetInput(self):
+        if self.multiChain.get():
+            return self.inputSequences.get() is not None
+        elif self.isBatch():
+            return self.inputBatchSequences.get() is not None
+        return self.inputSequence.get() is not None
+
+    def getSymmetryPairs(self):
+        """ Chain pairs restrained by symmetry, explicit or derived from the symmetry groups and topology """
+        if not self.multiChain.get():
+            return []
+        if self.symMode.get() == 1:
+            groups = parseSymmetryGroups(self.symGroups.get() or '')
+            return getSymmetryPairs(groups, self.getEnumText('symTopology'))
+
+        symStr = self.symChains.get()
+        if symStr and symStr.strip():
+            return [tuple(cPair.strip().split('-')) for cPair in symStr.replace(' ', '').split(',')]
+        return []
+
+    def getNumberOfSymPairs(self):
+        return len(self.getSymmetryPairs())
+
+    def getMemoryFeatures(self, seqObj=None):
+        """ Features of the target used to estimate the peak memory of the modeller workers """
+        nResidues = len(seqObj.getSequence()) if seqObj else self.getTargetLength()
+        nChains = len(self.inputSequences.get()) if self.multiChain.get() else 1
+        return {'nResidues': nResidues, 'nTemplates': self.getNumberOfTemplates(),
+                'modelH': self.modelH.get() and not self.isTopHydrogens(), 'nChains': nChains,
+                'nSymPairs': self.getNumberOfSymPairs(), 'symAtom': self.symAtom.get()}
+
+    def getMemoryEstimator(self, create=True):
+        """ Estimator calibrated with the memory records of previous runs. If not create, the cache is only read
+        (i.e: when validating) and no records are used if its directory does not exist """
+        memoryDir = Plugin.getCacheDir('memory', create=create)
+        return MemoryEstimator(os.path.join(memoryDir, 'records.jsonl') if os.path.isdir(memoryDir) else None)
+
+    def estimateWorkerMemory(self):
+        return self.getMemoryEstimator(create=False).estimate(**self.getMemoryFeatures())
+
+    def runModeller(self, args, workDir):
+        """ Runs the comparative modelling script in workDir, unless its results are found in the result store """
+        if not self.restoreModelling(args, workDir):
+            self.runModellerScript(args, workDir)
+            self.storeModelling(args, workDir)
+
+    def restoreModelling(self, args, workDir):
+        """ Restores the results of a modelling run into workDir if found in the result store. Returns whether
+        they were restored """
+        store = self.getResultStore()
+        key = self.getModellingKey(args) if store else None
+        restoredFiles = store.restore(key, workDir) if store else None
+        if restoredFiles is not None:
+            self.info('Modelling results restored from the result store ({})'.format(key))
+            self.recordRestoredRun(args, restoredFiles)
+        return restoredFiles is not None
+
+    def storeModelling(self, args, workDir):
+        """ Adds the results of a modelling run in workDir to the result store, if used """
+        store = self.getResultStore()
+        if store:
+            store.put(self.getModellingKey(args),
+                      {file: os.path.join(workDir, file) for file in os.listdir(workDir) if isStoredFile(file)},
+                      metadata={'protocol': self.getClassName(), 'target': args[args.index('-i') + 1]})
+
+    def recordRestoredRun(self, args, restoredFiles):
+        """ Writes the run_finished progress event of a run restored from the result store, so its models are
+        counted as finished """
+        args = [str(arg) for arg in args]
+        nOk = len([file for file in restoredFiles if MODEL_FILE_RE.search(file)])
+        with open(args[args.index('-pg') + 1], 'a') as f:
+            f.write(json.dumps({'time': time.time(), 'event': 'run_finished', 'pid': os.getpid(),
+                                'nOk': nOk, 'nFailed': 0, 'restored': True}) + '\n')
+
+    def runModellerScript(self, args, workDir):
+        """ Runs the comparative modelling script in workDir or, if chosen, in a node-local scratch directory from
+        where only the models, scores and logs are staged back to workDir """
+        if not self.useScratch.get():
+            Plugin.runScript(self, 'comparative_modelling.py', args=args, envDic=MODELLER_DIC, cwd=workDir)
+            return
+
+        with self.getScratchDir(workDir) as scratch:
+            self.info('Running modeller in scratch directory {}'.format(scratch.path))
+            Plugin.runScript(self, 'comparative_modelling.py', args=args, envDic=MODELLER_DIC, cwd=scratch.path)
+
+    def getScratchDir(self, workDir):
+        """ Scratch directory from where the models, scores and logs are staged back to workDir """
+        return ScratchDir(getScratchBaseDir(self.scratchDir.get().strip()), workDir, isStagedFile,
+                          keepDir=os.path.join(workDir, 'intermediates'),
+                          retention=self.getEnumText('keepIntermediates'))
+
+    def getResultStore(self):
+        if self.useResultStore.get():
+            return ResultStore(Plugin.getCacheDir('results'), maxSize=self.resultStoreSize.get() * 2**30)
+
+    def getModellingKey(self, args):
+        """ Result store key of a modelling run from its script arguments """
+        args = [str(arg) for arg in args]
+        return ResultStore.getKey(type='comparative', templates=self.getTemplateManifest().getKey(),
+                                  alignment=getFileHash(args[args.index('-af') + 1]),
+                                  target=args[args.index('-i') + 1],
+                                  options=normalizeArgs(args, ignore=EXECUTION_ARGS), seed=self.seed.get())
+
+    def recordPeakMemory(self, memoryFile, seqObj=None):
+        """ Stores the peak memory measured by the modeller script to calibrate future estimations """
+        if os.path.exists(memoryFile):
+            with open(memoryFile) as f:
+                peakMemory = json.load(f)['peakMemory']
+            self.getMemoryEstimator().addRecord(self.getMemoryFeatures(seqObj), peakMemory)
+
+    def getNumberOfWorkers(self):
+        """ Number of modeller workers to use, depending on the models to build, the cores and memory available
+        and the estimated memory per worker """
+        memPerWorker = self.estimateWorkerMemory()
+        nWorkers, reasons = getNumberOfWorkers(self.getNumberOfModels(), self.numberOfThreads.get(), memPerWorker)
+        self.info('Number of modeller workers: ' + '\n\t'.join(reasons))
+        return nWorkers
+
+    def getNumberOfModels(self):
+        if self.opt.get() != 0 or self.isStaged():
+            return self.nModels.get()
+        else:
+            print('With {} optimization, the initial model is not randomized so every output model is the same.\n'
+                  'Therefore, only one model is output'.format(self.getEnumText('opt')))
+            return 1
+
     def getTargetID(self, seqObj=None):
         if not seqObj:
             if not self.multiChain:
@@ -278,36 +940,55 @@ class ProtModellerComparativeModelling(EMProtocol):
             seqObj = self.inputSequence.get()
         return seqObj.getSequence()
 
-    def _getModellerArgs(self):
+    def isStaged(self):
+        return self.stagedRefinement.get() and not self.isBatch()
+
+    def getNumberOfRefinedModels(self):
+        return max(1, min(self.refineTopK.get(), self.getNumberOfModels()))
+
+    def getRefineDir(self, outId):
+        return os.path.abspath(self._getExtraPath('refine', 'model_{}'.format(outId)))
+
+    def _getModellerArgs(self, targetId=None, modelIdx=None, refineFile=None):
+        """ Arguments of the modelling script. With refineFile, the arguments to refine that coarse model (High-Slow
+        optimization from its coordinates) as the model modelIdx """
         args = ''
-        args += '-i {} '.format(self.getTargetID())
-        args += '-af {} '.format(os.path.abspath(self.getAlignmentFile()))
+        args += '-i {} '.format(targetId if targetId is not None else self.getTargetID())
+        args += '-af {} '.format(os.path.abspath(self.getAlignmentFile(targetId)))
         args += '-pf {} '.format(os.path.abspath(self.getPDBsFile()))
         args += '-pd {} '.format(os.path.abspath(self._getExtraPath()))
-        if self.opt.get() != 0:
-            args += '-n {} '.format(self.nModels.get())
+        if modelIdx is not None:
+            args += '-n 1 -sm {} '.format(modelIdx)
         else:
-            args += '-n 1 '
-            print('With {} optimization, the initial model is not randomized so every output model is the same.\n'
-                  'Therefore, only one model is output'.format(self.getEnumText('opt')))
+            args += '-n {} '.format(self.getNumberOfModels())
         if self.getEnumText('alignMethod') == AUTOMODELLER:
             args += '--align '
 
-        if self.adIni:
+        if refineFile:
+            args += '-im {} -rm none '.format(os.path.abspath(refineFile))
+        elif self.adIni:
             args += '-im {} '.format(os.path.abspath(self.iniModel.get().getFileName()))
-        if self.modelH:
+        if self.modelH and not self.isTopHydrogens():
             args += '--modelH '
 
         doScore = []
         for scoreName in scoreChoices:
             if getattr(self, f'score{scoreName}'):
                 doScore.append(scoreName)
+        if self.isStaged() and not doScore:
+            # The coarse models are ranked by their DOPE score
+            doScore = ['DOPE']
         if len(doScore) > 0:
             args += '-sc {} '.format(','.join(doScore))
 
-        if self.opt.get() != 1:
+        if refineFile:
+            args += '-opt High-Slow '
+        elif self.isStaged():
+            args += '-opt Low-Fast -rm xyz '
+        elif self.opt.get() != 1:
             args += '-opt {} '.format(self.getEnumText('opt'))
         args += '-nr {} '.format(self.nReps.get())
+        args += '-s {} '.format(self.seed.get())
 
         nChains = 1 if not self.multiChain.get() else len(self.inputSequences.get())
 
@@ -325,185 +1006,335 @@ class ProtModellerComparativeModelling(EMProtocol):
                 args += '-renam {} '.format(','.join(list(string.ascii_uppercase)[:nChains]))
 
 
-        if self.symChains.get() and self.symChains.get().strip():
-            symChains = self.symChains.get().replace(' ', '')
-            args += '-sym {} '.format(symChains)
+        symPairs = self.getSymmetryPairs()
+        if symPairs:
+            args += '-sym {} '.format(','.join(['-'.join(pair) for pair in symPairs]))
             args += '-symAtom {} '.format(self.symAtom.get())
-
-        args += '-nj {} '.format(self.numberOfThreads.get())
+            if self.symRanges.get() and self.symRanges.get().strip():
+                args += '-symRanges {} '.format(self.symRanges.get().replace(' ', ''))
+
+        args += '-nj {} '.format(self.getNumberOfWorkers() if modelIdx is None else 1)
+        args += '-of {} '.format(self.getOutputExtension())
+        args += '-v {} '.format(self.getEnumText('logVerbosity').lower())
+        progressFile = os.path.join(self.getRefineDir(modelIdx), 'progress.jsonl') if refineFile else \
+            self.getProgressFile(targetId, modelIdx)
+        args += '-pg {} '.format(progressFile)
         args += '-mPath {} '.format(Plugin.getPluginHome())
 
         return args.split()
         
+    def getTemplateManifestFile(self):
+        return self._getExtraPath('templateManifest.json')
+
+    def getTemplateManifest(self):
+        return TemplateManifest.load(self.getTemplateManifestFile())
+
+    def getModelFiles(self):
+        """ Returns a dictionary {outId: modelFile} with the models output by modeller """
+        modelFiles = {}
+        for file in os.listdir(self._getPath()):
+            match = MODEL_FILE_RE.search(file)
+            if match:
+                modelFiles[int(match.group(1))] = self._getPath(file)
+        return modelFiles
+
+    def getProgressFile(self, targetId=None, modelIdx=None):
+        if targetId is not None:
+            return os.path.abspath(os.path.join(self.getBatchTaskDir(targetId, modelIdx), 'progress.jsonl'))
+        return os.path.abspath(self._getPath('progress.jsonl'))
+
+    def getProgress(self):
+        """ Returns the models finished, the total models and the estimated remaining seconds (None if unknown),
+        from the progress events written by the modelling runs. With staged refinement, the refined models are
+        counted as models of a second stage """
+        progressFiles = glob.glob(self._getPath('progress.jsonl')) + \
+                        glob.glob(self._getExtraPath('batch', '*', 'progress.jsonl')) + \
+                        glob.glob(os.path.join(self.getRefineDir('*'), 'progress.jsonl'))
+        nTargets = len(self.inputBatchSequences.get()) if self.isBatch() else 1
+        total, finished, iniTimes = self.getNumberOfModels() * nTargets, 0, []
+        if self.isStaged():
+            total += self.getNumberOfRefinedModels()
+        for progressFile in progressFiles:
+            with open(progressFile) as f:
+                events = [json.loads(line) for line in f if line.strip()]
+            runEnds = [ev for ev in events if ev['event'] == 'run_finished']
+            if runEnds:
+                finished += runEnds[-1]['nOk'] + runEnds[-1]['nFailed']
+            else:
+                finished += len(set([ev['model'] for ev in events if ev['event'] == 'model_finished']))
+            iniTimes += [ev['time'] for ev in events if ev['event'] == 'run_started']
+
+        eta = None
+        if 0 < finished < total and iniTimes:
+            eta = (time.time() - min(iniTimes)) / finished * (total - finished)
+        return finished, total, eta
+
+    def getOutputModelFiles(self):
+        """ Model files to output: all the models or, if clustered, the cluster representatives """
+        modelFiles = self.getModelFiles()
+        if os.path.exists(self.getClustersFile()):
+            with open(self.getClustersFile()) as f:
+                repIds = [cluster['representative'] for cluster in json.load(f)]
+            modelFiles = {outId: modelFile for outId, modelFile in modelFiles.items() if outId in repIds}
+        return modelFiles
+
+    def getOutputStructFiles(self):
+        """ Structure files of the outputs: the models or, in homo-oligomer mode, the oligomers built from them """
+        modelFiles = self.getOutputModelFiles()
+        if self.isOligomerMode():
+            return {outId: self.getOligomerFile(outId) for outId in modelFiles}
+        return modelFiles
+
+    def getTopModelIds(self, outIds, k):
+        """ Ids of the k best models by the first score computed for all of them (DOPE preferred), or the first
+        k ids if they were not scored """
+        scoresDic = self.parseScoresFile()
+        for scoreKey in ['DOPE score', 'DOPE-HR score', 'Normalized DOPE score', 'GA341 score']:
+            if outIds and all([scoreKey in scoresDic.get(outId, {}) for outId in outIds]):
+                sign = -1 if scoreKey == 'GA341 score' else 1
+                return sorted(outIds, key=lambda outId: sign * scoresDic[outId][scoreKey])[:k]
+        return sorted(outIds)[:k]
+
+    def isTopHydrogens(self):
+        return self.modelH.get() and not self.isBatch() and self.hydrogensMode.get() == 1
+
+    def getHydrogensListFile(self):
+        return self._getExtraPath('hydrogens', 'models.txt')
+
+    def getHydrogensFile(self, outId):
+        return os.path.abspath(self._getExtraPath('hydrogens', 'model_{}_H{}'.format(outId, self.getOutputExtension())))
+
+    def isOligomerMode(self):
+        return not self.multiChain.get() and not self.isBatch() and self.buildOligomer.get()
+
+    def getOligomerChains(self):
+        """ Chains of the assembly template selected for the oligomer, None to use all of them """
+        if self.oligomerChains.get():
+            return [chain.strip() for chain in self.oligomerChains.get().split(',') if chain.strip()]
+
+    def getOligomerFile(self, outId, suffix=''):
+        return os.path.abspath(self._getExtraPath('oligomers', 'oligomer_{}{}{}'.
+                                                  format(outId, suffix, self.getOutputExtension())))
+
+    def getOutputExtension(self):
+        return OUTPUT_FORMATS[self.getEnumText('outputFormat')]
+
+    def parseScoresFile(self, scoresFile=None):
+        """ Parses the scores file written by the modelling script into a dictionary {outId: {scoreName: value}} """
+        scoresFile = scoresFile if scoresFile else self._getPath('scores.txt')
+        scoresDic = {}
+        if os.path.exists(scoresFile):
+            with open(scoresFile) as f:
+                for line in f:
+                    outIdMatch = re.search(r'outputAtomStruct_(\d+)', line)
+                    if outIdMatch:
+                        scoresDic[int(outIdMatch.group(1))] = {name: float(value) for name, value in
+                                                               re.findall(r'\(([^()]+?) (-?[\d.]+)\)', line)}
+        return scoresDic
+
+    def getClustersFile(self):
+        return self._getExtraPath('clusters.json')
+
+    def getCollapsedFile(self):
+        return self._getExtraPath('collapsedTemplates.json')
+
     def getPDBsFile(self):
         return self._getExtraPath('templatePDBs.txt')
 
-    def getAlignmentFile(self):
+    def getAlignmentFile(self, targetId=None):
+        if targetId is not None:
+            return os.path.abspath(self._getExtraPath('alignment_{}.pir'.format(targetId)))
         return os.path.abspath(self._getPath('alignment.pir'))
 
     def buildPDBsFile(self):
         pdbsFile = self.getPDBsFile()
-        with open(pdbsFile, 'w') as f:
-            for tempLine in self.templateList.get().split('\n'):
-              if tempLine.strip():
-                tempJson = json.loads(tempLine.split(')')[1].strip())
-                pdbCode = tempJson['pdbName']
-                if 'pdbFile' in tempJson:
-                    shutil.copy(tempJson['pdbFile'], self._getExtraPath(os.path.basename(tempJson['pdbFile']).lower()))
-                else:
-                    aSH = emconv.AtomicStructHandler()
-                    aSH.readFromPDBDatabase(pdbCode, type='mmCif', dir=self._getExtraPath())
-
-                f.write(pdbCode + '\n')
+        manifest = self.getTemplateManifest()
+        errors = prepareTemplates(manifest, self._getExtraPath(), self.templatesMirror.get(),
+                                  nThreads=self.numberOfThreads.get(), trim=self.trimTemplates.get(),
+                                  cacheDir=Plugin.getCacheDir('templates'))
+        if errors:
+            raise Exception('The following templates could not be prepared:\n' +
+                            '\n'.join(['{}: {}'.format(code, err) for code, err in errors.items()]))
+
+        self.writePDBsFile(manifest)
+        manifest.write(self.getTemplateManifestFile())
         return pdbsFile
 
-    def buildAlignFile(self):
-        alignFile = self.getAlignmentFile()
+    def writePDBsFile(self, manifest):
+        with open(self.getPDBsFile(), 'w') as f:
+            for entry in manifest:
+                f.write(entry.code + '\n')
+        return self.getPDBsFile()
+
+    def buildAlignFile(self, seqObj=None, alignFile=None):
+        alignFile = alignFile if alignFile else self.getAlignmentFile()
         programName = self.getEnumText('alignMethod')
 
         if not self.multiChain:
             if programName == CUSTOM:
                 if not self.fromFile.get():
-                    seqDic = self.parseInputAlignment()
+                    alignment = self.parseInputAlignment()
                 else:
                   shutil.copy(self.inputAlignFile.get(), alignFile)
-                  return alignFile
+                  return rewritePIRAtomFiles(alignFile, self.getTemplateManifest())
 
             elif programName in [CLUSTALO, MUSCLE, MAFFT]:
-                seqDic = self.makeScipionAlignment(programName)
+                alignment = self.makeScipionAlignment(programName, seqObj)
 
             else:
                 # todo: automatic alignment, meanwhile use mafft
-                seqDic = self.makeScipionAlignment(MAFFT)
-
-            with open(alignFile, 'w') as f:
-                targetSeq = self.getTargetSequence()
-                if self.getTargetID() in seqDic:
-                    targetSeq = seqDic[self.getTargetID()]
+                alignment = self.makeScipionAlignment(MAFFT, seqObj)
 
-                f.write('>P1;{}\nsequence:::A:::{}:::\n{}*\n'.
-                        format(self.getTargetID(), self.inputSequence.get().getSeqName(), targetSeq))
+            targetID = self.getTargetID(seqObj)
+            seqName = seqObj.getSeqName() if seqObj else self.inputSequence.get().getSeqName()
+            names = [targetID]
+            seqs = [alignment.getSequence(targetID) if targetID in alignment else self.getTargetSequence(seqObj)]
+            headers = {targetID: 'sequence:::A:::{}:::'.format(seqName)}
 
-                for tempLine in self.templateList.get().split('\n'):
-                  if tempLine.strip():
-                      tempJson = json.loads(tempLine.split(')')[1].strip())
-                      pdbCode, chain = tempJson['pdbName'], tempJson['chain']
-                      faName = getBaseName(tempJson['seqFile'])
-                      idxs = tempJson['index'].split('-')
-
-                      tempSeq = seqDic[faName]
-                      f.write('>P1;{}\nstructureX:{}:{}:{}:{}:{}:{}:::\n{}*\n'.
-                              format(pdbCode, pdbCode, idxs[0], chain, idxs[1], chain, pdbCode, tempSeq))
+            for entry in self.getTemplateManifest():
+                pdbCode, chain, idxs = entry.code, entry.chains[0], entry.ranges[0]
+                names.append(pdbCode), seqs.append(alignment.getSequence(self.getTemplateSeqNames(entry)[0]))
+                headers[pdbCode] = 'structureX:{}:{}:{}:{}:{}:{}:::'.\
+                    format(entry.atomFile, idxs[0], chain, idxs[1], chain, pdbCode)
 
         else:
           if programName == CUSTOM:
               shutil.copy(self.inputAlignFile.get(), alignFile)
-              return alignFile
+              return rewritePIRAtomFiles(alignFile, self.getTemplateManifest())
 
           elif programName in [CLUSTALO, MUSCLE, MAFFT]:
-              seqDic = self.makeScipionAlignment(programName)
+              alignments = self.makeScipionAlignment(programName)
 
           else:
               # todo: automatic alignment, meanwhile use mafft
-              seqDic = self.makeScipionAlignment(MAFFT)
-
-          with open(alignFile, 'w') as f:
-              seqStr = ''
-              for i, targetSeqObj in enumerate(self.inputSequences.get()):
-                  targetSeq = self.getTargetSequence(targetSeqObj).strip()
-                  seqStr += '{}/'.format(targetSeq)
-
-                  targetID = self.getTargetID(targetSeqObj)
-                  if targetID in seqDic:
-                    seqDic.pop(targetID)
-
-              f.write('>P1;{}\nsequence:::A::{}:{}:::\n{}*\n'.
-                      format(targetID, chainAlph[i], targetID, seqStr[:-1]))
-
-              for tempLine in self.templateList.get().split('\n'):
-                if tempLine.strip():
-                  tempJson = json.loads(tempLine.split(')')[1].strip())
-                  pdbCode = tempJson['pdbName']
-
-                  allChains = tempJson['chains'].split(',')
-                  chains = [allChains[0].split('-')[1], allChains[-1].split('-')[1]]
-
-                  chainsSeqs = '/'.join(seqDic.values())
-
-                  f.write('>P1;{}\nstructureX:{}::{}::{}:{}:::\n{}*\n'.
-                          format(pdbCode, pdbCode, chains[0], chains[1], pdbCode, chainsSeqs))
-
+              alignments = self.makeScipionAlignment(MAFFT)
+
+          # Chains are joined with chain breaks, using the alignment of each chain with the templates chains
+          targets = [(self.getTargetID(tSeqObj), self.getTargetSequence(tSeqObj).strip())
+                     for tSeqObj in self.inputSequences.get()]
+          targetID = targets[-1][0]
+          names = [targetID]
+          seqs = ['/'.join([aln.getSequence(tID) if tID in aln else tSeq
+                            for aln, (tID, tSeq) in zip(alignments, targets)])]
+          headers = {targetID: 'sequence:::A::{}:{}:::'.format(chainAlph[len(targets) - 1], targetID)}
+
+          for entry in self.getTemplateManifest():
+              pdbCode = entry.code
+              names.append(pdbCode)
+              seqs.append('/'.join([aln.getSequence(seqName)
+                                    for aln, seqName in zip(alignments, self.getTemplateSeqNames(entry))]))
+              headers[pdbCode] = 'structureX:{}::{}::{}:{}:::'.\
+                  format(entry.atomFile, entry.chains[0], entry.chains[-1], pdbCode)
+
+        Alignment(names, seqs, headers).writePIR(alignFile)
         return alignFile
 
+    def getTemplateSeqNames(self, entry):
+        """ Names of the sequences of the template chains in the alignment: the headers of their fasta files """
+        return [list(readFasta(seqFile))[0] for seqFile in entry.seqFiles]
+
     def getScipionAlignFile(self, idx=''):
         return os.path.abspath(self._getExtraPath('alignment{}.aln'.format(idx)))
 
     def parseInputAlignment(self):
-        seqDic = {}
-        for seq in self.inputAlign.get():
-            seqDic[seq.getId()] = seq.getSequence()
-        return seqDic
+        seqs = [(seq.getId(), seq.getSequence()) for seq in self.inputAlign.get()]
+        return Alignment([name for name, _ in seqs], [seq for _, seq in seqs])
 
-    def makeScipionAlignment(self, programName):
+    def makeScipionAlignment(self, programName, seqObj=None):
+        """ Aligns the target and the templates sequences. Returns the Alignment or, with multiple chains, the list
+        of the Alignments of each chain """
         if not self.multiChain:
-            inpSeqsFile = self._getTmpPath('inputSeqs.fa')
+            idx = '' if seqObj is None else '_{}'.format(self.getTargetID(seqObj))
+            inpSeqsFile = self._getTmpPath('inputSeqs{}.fa'.format(idx))
             with open(inpSeqsFile, 'w') as f:
                 f.write('>{}\n{}\n'.
-                        format(self.getTargetID(), self.getTargetSequence()))
+                        format(self.getTargetID(seqObj), self.getTargetSequence(seqObj)))
 
-                for tempLine in self.templateList.get().split('\n'):
-                  if tempLine.strip():
-                      tempJson = json.loads(tempLine.split(')')[1].strip())
-                      seqFile = tempJson['seqFile']
-                      with open(seqFile) as fIn:
-                        f.write(fIn.read().strip() + '\n')
+                for entry in self.getTemplateManifest():
+                    with open(entry.seqFiles[0]) as fIn:
+                      f.write(fIn.read().strip() + '\n')
 
-            seqDic = self.performAlignment(inpSeqsFile, programName)
-            return seqDic
+            return self.performAlignment(inpSeqsFile, programName, idx=idx)
 
         else:
-            seqDic = {}
+            alignments = []
+            manifest = self.getTemplateManifest()
             for i, inSeq in enumerate(self.inputSequences.get()):
                 inpSeqsFile = self._getTmpPath('inputSeqs_{}.fa'.format(i))
                 with open(inpSeqsFile, 'w') as f:
                     f.write('>{}\n{}\n'.format(self.getTargetID(inSeq), self.getTargetSequence(inSeq)))
 
-                    for tempLine in self.templateList.get().split('\n'):
-                        if tempLine.strip():
-                          tempJson = json.loads(tempLine.split(')')[1].strip())
-                          seqFileTemplate = tempJson['seqFiles']
-                          chainId = tempJson['chains'].split(',')[i].strip().split('-')[1]
-                          seqFileTemplate = seqFileTemplate.replace('_*_*', '_{}_*'.format(chainId))
-                          seqFile = glob.glob(seqFileTemplate)[0]
-                          with open(seqFile) as fIn:
-                            f.write(fIn.read().strip() + '\n')
+                    for entry in manifest:
+                        with open(entry.seqFiles[i]) as fIn:
+                          f.write(fIn.read().strip() + '\n')
 
-                iSeqDic = self.performAlignment(inpSeqsFile, programName, idx=str(i))
-                seqDic.update(iSeqDic)
+                alignments.append(self.performAlignment(inpSeqsFile, programName, idx=str(i)))
 
-            return seqDic
+            return alignments
 
 
-    def performAlignment(self, inpFile, programName, idx=''):
-        alignFile = self.getScipionAlignFile(idx)
-        cline = '%s && ' % (pwchemPlugin.getEnvActivationCommand(BIOCONDA_DIC))
+    def getFullAlignmentCommand(self, programName, inpFile, alignFile):
         if programName == CLUSTALO:
-          cline += 'clustalo -i {} --auto -o {} --outfmt=clu'.format(inpFile, alignFile)
+          return 'clustalo', '-i {} --auto -o {} --outfmt=clu'.format(inpFile, alignFile)
         elif programName == MUSCLE:
-          alignFile = alignFile.replace('.aln', '.fa')
-          cline += 'muscle -align {} -output {}'.format(inpFile, alignFile)
+          return 'muscle', '-align {} -output {}'.format(inpFile, alignFile)
         elif programName == MAFFT:
-          cline += 'mafft --auto --clustalout {} > {}'.format(inpFile, alignFile)
-        self.runJob(cline, '')
+          return 'mafft', '--auto --clustalout {} > {}'.format(inpFile, alignFile)
 
-        seqIds = list(parseFasta(inpFile).keys())
+    def performAlignment(self, inpFile, programName, idx=''):
+        """ Aligns the sequences of inpFile. If a previous run aligned the same target with the same program, its
+        alignment is reused and only the new sequences are added to it. Any other change realigns everything """
+        seqDic = readFasta(inpFile)
+        cache = AlignmentCache(Plugin.getCacheDir('alignments'))
+        key = cache.getKey(programName, self.getFullAlignmentCommand(programName, '', '')[1],
+                           list(seqDic.values())[0])
+        cached = cache.load(key)
+        mode, newNames = cache.getUpdateMode(cached, seqDic)
+
+        alignment = None
+        if mode == SUBSET:
+            alignment = cached['alignment']
+        elif mode == ADD:
+            alignment = self.addToAlignment(programName, cached['alignment'], seqDic, newNames, idx)
+            if alignment is not None:
+                cache.save(key, {**cached['sequences'], **seqDic}, alignment)
+
+        if alignment is None:
+            mode, alignment = FULL, self.runFullAlignment(inpFile, programName, idx)
+            cache.save(key, seqDic, alignment)
+
+        self.info('Alignment {}: {} ({} new sequences)'.format(idx, mode, len(newNames) if mode == ADD else
+                                                                len(seqDic)))
+        # Only the sequences of this run, without the columns that were only used by other sequences
+        return alignment.subset(list(seqDic))
+
+    def runFullAlignment(self, inpFile, programName, idx=''):
+        alignFile = self.getScipionAlignFile(idx)
         if programName == MUSCLE:
-          seqDic = parseFasta(alignFile)
-        else:
-          seqDic = parseAlnFile(alignFile)
-
-        nSeqDic = {}
-        for i, old_key in enumerate(seqDic):
-            nSeqDic[seqIds[i]] = seqDic[old_key]
-
-        return nSeqDic
+          alignFile = alignFile.replace('.aln', '.fa')
+        program, args = self.getFullAlignmentCommand(programName, inpFile, alignFile)
+        self.runJob(Plugin.getEnvProgram(BIOCONDA_DIC, program), args, env=Plugin.getEnvEnviron(BIOCONDA_DIC))
+
+        # The alignment programs may modify the names, so the sequences are renamed in the order of the input
+        alignment = Alignment.read(alignFile, 'fasta' if programName == MUSCLE else 'clustal')
+        return alignment.rename(list(readFasta(inpFile)))
+
+    def addToAlignment(self, programName, alignment, seqDic, newNames, idx=''):
+        """ Adds the newNames sequences to the Alignment by profile alignment. Returns the extended Alignment
+        or None if the alignment program cannot add sequences to an existing alignment """
+        profileFile = self._getTmpPath('profile{}.fa'.format(idx))
+        newFile = self._getTmpPath('newSeqs{}.fa'.format(idx))
+        outFile = os.path.abspath(self._getExtraPath('alignment{}_added.fa'.format(idx)))
+        command = getAddAlignmentCommand(programName, os.path.abspath(profileFile), os.path.abspath(newFile), outFile)
+        if command is None:
+            return None
+
+        # Plain ids, so the names are not modified by the alignment programs
+        names = alignment.names + newNames
+        alignment.rename(['s{}'.format(i) for i in range(len(alignment))]).write(profileFile, 'fasta')
+        writeFasta({'s{}'.format(len(alignment) + i): seqDic[name] for i, name in enumerate(newNames)}, newFile)
+        program, args = command
+        self.runJob(Plugin.getEnvProgram(BIOCONDA_DIC, program), args, env=Plugin.getEnvEnviron(BIOCONDA_DIC))
+
+        outAlignment = Alignment.read(outFile, 'fasta')
+        return outAlignment.subset(['s{}'.format(i) for i in range(len(names))], removeGaps=False).rename(names).upper()
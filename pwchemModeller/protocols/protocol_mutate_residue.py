@@ -32,14 +32,15 @@ A energy optimization is performed over the mutated residue and its surroundings
 
 """
 
-import os, json
+import os, json, shutil
 from pyworkflow.protocol import params
 from pyworkflow.utils import Message
 from pwem.protocols import EMProtocol
 from pwem.objects.data import AtomStruct
 
 from pwchemModeller import Plugin
-from pwchemModeller.constants import AA_LIST, MODELLER_DIC
+from pwchemModeller.constants import AA_LIST, MODELLER_DIC, OUTPUT_FORMATS, LOG_VERBOSITIES
+from pwchemModeller.utils import getFileHash, normalizeArgs, ResultStore
 
 class ModellerMutateResidue(EMProtocol):
     """
@@ -82,8 +83,22 @@ class ModellerMutateResidue(EMProtocol):
                       label='Clear mutation list',
                       help='Clear mutations list')
 
+        form.addParam('outputFormat', params.EnumParam, default=0,
+                      label="Output format: ", choices=list(OUTPUT_FORMATS.keys()),
+                      help='Format of the output mutant structure')
+        form.addParam('logVerbosity', params.EnumParam, default=1, expertLevel=params.LEVEL_ADVANCED,
+                      label='Modeller log verbosity: ', choices=LOG_VERBOSITIES,
+                      help='Verbosity of the modeller log')
         form.addParam('seed', params.IntParam, label='Random seed', expertLevel=params.LEVEL_ADVANCED,
                       default=-49837, help='Random seed for modeller')
+        form.addParam('useResultStore', params.BooleanParam, default=False, expertLevel=params.LEVEL_ADVANCED,
+                      label='Reuse stored results: ',
+                      help='Look for each mutant in a store shared by all the projects, keyed by the hash of its '
+                           'inputs (input structure, mutation, energy parameters and seed). Mutations with identical '
+                           'inputs reuse the stored structure instead of running modeller again')
+        form.addParam('resultStoreSize', params.FloatParam, default=10.0, expertLevel=params.LEVEL_ADVANCED,
+                      condition='useResultStore', label='Maximum store size (GB): ',
+                      help='When the store grows over this size, the least recently used results are removed')
 
         form.addSection(label='Energy objective functions')
         group = form.addGroup('Distance parameters')
@@ -155,8 +170,19 @@ class ModellerMutateResidue(EMProtocol):
         self._insertFunctionStep('createOutputStep', mutIdx)
 
     def modellerStep(self, i, mutation):
-        Plugin.runScript(self, 'mutate_residue.py', args=self._getModellerArgs(i, mutation),
-                         envDic=MODELLER_DIC, cwd=self._getExtraPath())
+        args = self._getModellerArgs(i, mutation)
+        outFile, storedName = self.getOutputFile(i), 'mutant' + self.getOutputExtension()
+        store = self.getResultStore()
+        key = self.getMutationKey(args, mutation) if store else None
+        storedFiles = store.fetch(key) if store else None
+        if storedFiles is not None:
+            self.info('Mutant restored from the result store ({})'.format(key))
+            shutil.copy(storedFiles[storedName], outFile)
+            return
+
+        Plugin.runScript(self, 'mutate_residue.py', args=args, envDic=MODELLER_DIC, cwd=self._getExtraPath())
+        if store:
+            store.put(key, {storedName: outFile}, metadata={'protocol': self.getClassName(), 'mutation': mutation})
 
     def createOutputStep(self, i):
         mutatedAS = AtomStruct(self.getOutputFile(i))
@@ -186,16 +212,15 @@ class ModellerMutateResidue(EMProtocol):
 
     def _getModellerArgs(self, i, mutation):
       ASFile = self._getFileInputStruct()
-      modelbase, ext = os.path.splitext(ASFile.split('/')[-1])
       outputFile = os.path.abspath(self.getOutputFile(i))
 
       chain, respos, restype = mutation
 
       if i > 0:
-          ASFile = os.path.abspath(self._getPath('{}_mutant_{}.pdb'.format(modelbase, i)))
+          ASFile = os.path.abspath(self.getOutputFile(i - 1))
 
       args = ['-i', ASFile, '-p', respos, '-r', restype, '-c', chain, '-s', self.seed.get(),
-              '-o', outputFile]
+              '-o', outputFile, '-v', self.getEnumText('logVerbosity').lower()]
 
       args += ['-contactShell', self.contactShell.get(), '-updateDynamic', self.updateDynamic.get()]
       if self.dynamicSphere.get():
@@ -210,6 +235,21 @@ class ModellerMutateResidue(EMProtocol):
 
       return args
 
+    def getResultStore(self):
+      if self.useResultStore.get():
+          return ResultStore(Plugin.getCacheDir('results'), maxSize=self.resultStoreSize.get() * 2**30)
+
+    def getMutationKey(self, args, mutation):
+      """ Result store key of a mutation: input structure, mutation, energy parameters and seed """
+      args = [str(arg) for arg in args]
+      energyParams = normalizeArgs(args, ignore=['-i', '-p', '-r', '-c', '-s', '-o', '-v'])
+      energyParams['format'] = self.getOutputExtension()
+      return ResultStore.getKey(type='mutation', structure=getFileHash(args[args.index('-i') + 1]),
+                                mutation=list(mutation), energy=energyParams, seed=self.seed.get())
+
+    def getOutputExtension(self):
+      return OUTPUT_FORMATS[self.getEnumText('outputFormat')]
+
     def _getScriptsFolder(self, path=''):
       from pwchemModeller import Plugin as modPlugin
       return modPlugin.getPluginHome('scripts/' + path)
@@ -220,8 +260,9 @@ class ModellerMutateResidue(EMProtocol):
 
     def getOutputFile(self, i):
       ASFile = self._getFileInputStruct()
-      modelbase, ext = os.path.splitext(ASFile.split('/')[-1])
-      return  self._getPath('{}_mutant_{}.pdb'.format(modelbase, i+1))
+      baseName = os.path.basename(ASFile)
+      modelbase = os.path.splitext(baseName[:-3] if baseName.endswith('.gz') else baseName)[0]
+      return  self._getPath('{}_mutant_{}{}'.format(modelbase, i+1, self.getOutputExtension()))
 
 
     # --------------------------- INFO functions -----------------------------------
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors: Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+"""
+This protocol is used to score a set of protein structures with the Modeller assessment methods, independently of
+how the structures were obtained.
+
+"""
+
+import os
+from pyworkflow.protocol import params
+from pyworkflow.utils import Message
+import pyworkflow.object as pwobj
+from pwem.protocols import EMProtocol
+from pwem.objects.data import AtomStruct, SetOfAtomStructs
+
+from pwchemModeller import Plugin
+from pwchemModeller.constants import MODELLER_DIC
+from pwchemModeller.protocols.protocol_comparative_modelling import scoreChoices
+
+class ProtModellerScoreStructures(EMProtocol):
+    """
+    Scores any set of atomic structures (Modeller models, mutants or external models) with the Modeller
+    assessment methods (DOPE, DOPE-HR, normalized DOPE, GA341), in parallel.
+    https://salilab.org/modeller/manual/node468.html
+    """
+    _label = 'Score structures'
+
+    # -------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        """ """
+        form.addSection(label=Message.LABEL_INPUT)
+        group = form.addGroup('Input')
+        group.addParam('inputAtomStructs', params.MultiPointerParam,
+                       pointerClass='AtomStruct, SetOfAtomStructs', allowsNull=False,
+                       label="Input atom structures: ",
+                       help='Select the atom structures or sets of atom structures to score')
+
+        group = form.addGroup('Scoring')
+        for i, scoreName in enumerate(scoreChoices):
+            defa = True if i == 0 else False
+            group.addParam(f'score{scoreName}', params.BooleanParam, default=defa,
+                           label=f"Report {scoreName} score: ")
+        group.addParam('useCache', params.BooleanParam, default=True, expertLevel=params.LEVEL_ADVANCED,
+                       label='Use scores cache: ',
+                       help='Reuse the scores of structure files already scored in previous runs (identified by the '
+                            'hash of their content), so unchanged structures are never scored twice')
+        form.addParallelSection(threads=4, mpi=1)
+
+    # --------------------------- STEPS functions ------------------------------
+    def _insertAllSteps(self):
+        self._insertFunctionStep('scoreStep')
+        self._insertFunctionStep('createOutputStep')
+
+    def scoreStep(self):
+        with open(self.getInputListFile(), 'w') as f:
+            for structFile in self.getInputFiles():
+                f.write(structFile + '\n')
+
+        args = ['-i', os.path.abspath(self.getInputListFile()), '-sc', ','.join(self.getScoreNames()),
+                '-o', os.path.abspath(self.getScoresFile()), '-nj', self.numberOfThreads.get()]
+        if self.useCache.get():
+            args += ['-c', Plugin.getCacheDir('scores')]
+        Plugin.runScript(self, 'assess_structures.py', args=args, envDic=MODELLER_DIC, cwd=self._getExtraPath())
+
+    def createOutputStep(self):
+        scores = self.parseScoresTable()
+        outputSet = SetOfAtomStructs.create(self._getPath())
+        for structFile in self.getInputFiles():
+            outAS = AtomStruct(structFile)
+            for scoreName, score in scores.get(structFile, {}).items():
+                setattr(outAS, '_{}'.format(scoreName.replace('-', '_')), pwobj.Float(score))
+            outputSet.append(outAS)
+
+        self._defineOutputs(outputAtomStructs=outputSet)
+        for inPointer in self.inputAtomStructs:
+            self._defineSourceRelation(inPointer, outputSet)
+
+    # --------------------------- UTILS functions -----------------------------
+    def getInputFiles(self):
+        structFiles = []
+        for inPointer in self.inputAtomStructs:
+            inObj = inPointer.get()
+            items = inObj if isinstance(inObj, SetOfAtomStructs) else [inObj]
+            for item in items:
+                structFile = os.path.abspath(item.getFileName())
+                if structFile not in structFiles:
+                    structFiles.append(structFile)
+        return structFiles
+
+    def getScoreNames(self):
+        return [scoreName for scoreName in scoreChoices if getattr(self, f'score{scoreName}').get()]
+
+    def getInputListFile(self):
+        return self._getExtraPath('inputStructures.txt')
+
+    def getScoresFile(self):
+        return self._getPath('scores.tsv')
+
+    def parseScoresTable(self):
+        """ Returns {structFile: {scoreName: score}} from the scores table, skipping the failed scores """
+        scores = {}
+        if os.path.exists(self.getScoresFile()):
+            with open(self.getScoresFile()) as f:
+                scoreNames = f.readline().strip().split('\t')[1:]
+                for line in f:
+                    sline = line.rstrip('\n').split('\t')
+                    scores[sline[0]] = {scoreName: float(val) for scoreName, val in zip(scoreNames, sline[1:]) if val}
+        return scores
+
+    # --------------------------- INFO functions -----------------------------------
+    def _summary(self):
+        summary = []
+        scores = self.parseScoresTable()
+        if scores:
+            summary.append('GA341 score ranges from 0 to 1, the higher the better. '
+                           'Rest of scores are energy-like, the lower the better\n')
+            for structFile, strScores in scores.items():
+                summary.append('{}: {}'.format(os.path.basename(structFile),
+                                               ', '.join(['{} {:.3f}'.format(scoreName, score)
+                                                          for scoreName, score in strScores.items()])))
+        return summary
+
+    def _validate(self):
+        errors = []
+        if not self.getScoreNames():
+            errors.append('You must select at least one score to compute')
+        return errors
@@ -0,0 +1,62 @@
+# Adds hydrogens to heavy-atom models and optimizes only the hydrogens, keeping the heavy atoms fixed
+#
+#     Usage:   python add_hydrogens.py -i models.txt [-n 200]
+#
+#  The input file contains one <inputModel> <outputModel> pair per line. Building the models with all hydrogens
+#  (AllHModel) roughly doubles the atoms of every model, so the hydrogens are only added to the selected models.
+
+import os, sys, argparse
+
+from modeller import *
+from modeller.scripts import complete_pdb
+from modeller.optimizers import ConjugateGradients
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from model_output import getModelFormat, writeModel
+from modeller_progress import setLogVerbosity
+
+def readModelPairs(inputFile):
+    with open(inputFile) as f:
+        return [line.split() for line in f if line.strip()]
+
+def isHydrogen(atom):
+    """ Hydrogen atom names start by H, or by a digit followed by H (i.e: 1HB) """
+    return atom.name[0] == 'H' or (atom.name[0].isdigit() and atom.name[1:2] == 'H')
+
+def getParser():
+    parser = argparse.ArgumentParser(description='Add and optimize the hydrogens of heavy-atom models')
+    parser.add_argument('-i', '--inputFile', type=str, help='File with the input and output models of each line')
+    parser.add_argument('-n', '--nIterations', type=int, default=200, help='Maximum conjugate gradients iterations')
+    parser.add_argument('-v', '--verbosity', type=str, default='minimal',
+                        help='Modeller log verbosity: none, minimal or verbose')
+    return parser
+
+def addHydrogens(env, inFile, outFile, nIterations=200):
+    # The all hydrogen topology builds the hydrogens missing in the input model
+    if getModelFormat(inFile) == 'MMCIF':
+        mdl = complete_pdb(env, inFile, model_format='MMCIF')
+    else:
+        mdl = complete_pdb(env, inFile)
+
+    hSel = Selection(*[atom for atom in mdl.atoms if isHydrogen(atom)])
+    if len(hSel) > 0:
+        mdl.restraints.make(Selection(mdl), restraint_type='stereo', spline_on_site=False)
+        mdl.restraints.unpick_all()
+        mdl.restraints.pick(hSel)
+        # Non-bonded pairs with at least one hydrogen: they are placed in the field of the fixed heavy atoms
+        mdl.env.edat.nonbonded_sel_atoms = 1
+        ConjugateGradients().optimize(hSel, max_iterations=nIterations)
+
+    return writeModel(mdl, outFile)
+
+if __name__ == '__main__':
+    args = getParser().parse_args()
+    setLogVerbosity(args.verbosity)
+    env = Environ()
+    env.io.atom_files_directory = ['.']
+    env.edat.dynamic_sphere = True
+    env.libs.topology.read(file='$(LIB)/top_allh.lib')
+    env.libs.parameters.read(file='$(LIB)/par.lib')
+
+    for inFile, outFile in readModelPairs(args.inputFile):
+        addHydrogens(env, inFile, outFile, args.nIterations)
@@ -0,0 +1,118 @@
+# Scores a list of atomic structures with the modeller assessment methods
+# https://salilab.org/modeller/manual/node468.html
+#
+#     Usage:   python assess_structures.py -i structures.txt -sc DOPE,GA341 -o scores.tsv [-nj 4] [-c cacheDir]
+#
+#  Each structure is scored in a pool of processes. Scores are cached by the hash of the structure file, so
+#  unchanged structures are never scored twice.
+
+import os, sys, json, argparse
+from multiprocessing import Pool
+
+from modeller import *
+from modeller.scripts import complete_pdb
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from model_output import getModelFormat, getFileHash
+
+SCORE_NAMES = ['DOPE', 'DOPE-HR', 'Normalized_DOPE', 'GA341']
+CACHE_VERSION = 1
+
+env = None
+
+def initEnviron():
+    global env
+    log.none()
+    env = Environ()
+    env.libs.topology.read(file='$(LIB)/top_heav.lib')
+    env.libs.parameters.read(file='$(LIB)/par.lib')
+
+def scoreModel(mdl, scoreName):
+    if scoreName == 'DOPE':
+        return Selection(mdl).assess_dope()
+    elif scoreName == 'DOPE-HR':
+        return Selection(mdl).assess_dopehr()
+    elif scoreName == 'Normalized_DOPE':
+        return mdl.assess_normalized_dope()
+    elif scoreName == 'GA341':
+        return mdl.assess_ga341()[0]
+
+def scoreStructure(task):
+    """ Scores a structure file with the score names not already cached. Returns (structFile, {scoreName: score}) """
+    structFile, scoreNames = task
+    if getModelFormat(structFile) == 'MMCIF':
+        mdl = complete_pdb(env, structFile, model_format='MMCIF')
+    else:
+        mdl = complete_pdb(env, structFile)
+    scores = {}
+    for scoreName in scoreNames:
+        try:
+            scores[scoreName] = scoreModel(mdl, scoreName)
+        except Exception as e:
+            print('Error scoring {} with {}: {}'.format(structFile, scoreName, e))
+            scores[scoreName] = None
+    return structFile, scores
+
+def getCacheFile(cacheDir, fileHash):
+    return os.path.join(cacheDir, '{}.json'.format(fileHash)) if cacheDir else None
+
+def readCache(cacheFile):
+    """ Cached scores of a structure. Failed (None) scores are misses, so they are computed again """
+    if cacheFile and os.path.exists(cacheFile):
+        with open(cacheFile) as f:
+            cacheDic = json.load(f)
+        if cacheDic.get('version') == CACHE_VERSION:
+            return {scoreName: score for scoreName, score in cacheDic['scores'].items() if score is not None}
+    return {}
+
+def writeCache(cacheFile, scores):
+    """ Caches the computed scores of a structure, leaving out the failed ones """
+    scores = {scoreName: score for scoreName, score in scores.items() if score is not None}
+    if cacheFile and scores:
+        tmpFile = '{}.{}.tmp'.format(cacheFile, os.getpid())
+        with open(tmpFile, 'w') as f:
+            json.dump({'version': CACHE_VERSION, 'scores': scores}, f)
+        os.replace(tmpFile, cacheFile)
+
+def assessStructures(structFiles, scoreNames, nJobs=1, cacheDir=None):
+    """ Returns a dictionary {structFile: {scoreName: score}}, scoring in parallel only what is not cached """
+    results, tasks, cacheFiles = {}, [], {}
+    for structFile in structFiles:
+        cacheFiles[structFile] = getCacheFile(cacheDir, getFileHash(structFile))
+        results[structFile] = readCache(cacheFiles[structFile])
+        missing = [scoreName for scoreName in scoreNames if scoreName not in results[structFile]]
+        if missing:
+            tasks.append((structFile, missing))
+
+    print('{} structures to score, {} fully cached'.format(len(structFiles), len(structFiles) - len(tasks)))
+    if tasks:
+        with Pool(processes=max(1, min(nJobs, len(tasks))), initializer=initEnviron) as pool:
+            for structFile, scores in pool.imap_unordered(scoreStructure, tasks):
+                results[structFile].update(scores)
+                writeCache(cacheFiles[structFile], results[structFile])
+    return results
+
+def writeScoresTable(results, scoreNames, outFile):
+    with open(outFile, 'w') as f:
+        f.write('\t'.join(['file'] + scoreNames) + '\n')
+        for structFile, scores in results.items():
+            values = ['' if scores.get(scoreName) is None else '%.4f' % scores[scoreName] for scoreName in scoreNames]
+            f.write('\t'.join([structFile] + values) + '\n')
+
+def getParser():
+    parser = argparse.ArgumentParser(description='Score atomic structures with modeller assessment methods')
+    parser.add_argument('-i', '--inputFile', type=str, help='File with the structure files to score, one per line')
+    parser.add_argument('-sc', '--score', type=str, default='DOPE', help='Comma separated scores to compute')
+    parser.add_argument('-o', '--outputFile', type=str, default='scores.tsv', help='Output scores table')
+    parser.add_argument('-nj', '--nJobs', type=int, default=1, help='Number of processes')
+    parser.add_argument('-c', '--cacheDir', type=str, default='', help='Directory with the cached scores')
+    return parser
+
+if __name__ == '__main__':
+    args = getParser().parse_args()
+    with open(args.inputFile) as f:
+        structFiles = [line.strip() for line in f if line.strip()]
+    scoreNames = [scoreName for scoreName in args.score.split(',') if scoreName in SCORE_NAMES]
+
+    results = assessStructures(structFiles, scoreNames, args.nJobs, args.cacheDir)
+    writeScoresTable(results, scoreNames, args.outputFile)
@@ -0,0 +1,83 @@
+# Headless batch driver for the modeller scripts of the plugin, usable outside Scipion
+#
+#     Usage:   python batch_modeller.py jobs.json [-j nJobs] [-o results.json]
+#
+#  The manifest (json, or yaml if PyYAML is available) contains the list of jobs to run:
+#
+#  {"nJobs": 4,
+#   "jobs": [{"name": "hemo", "type": "comparative", "workDir": "hemo",
+#             "args": {"inputSeqName": "hemo", "alignFile": "/abs/alignment.pir", "pdbsFile": "/abs/pdbs.txt",
+#                      "pdbsDir": "/abs/templates", "nModels": 5, "score": "DOPE"}},
+#            {"name": "mut1", "type": "mutation",
+#             "args": {"inputFilename": "/abs/5ni1.pdb", "position": "2", "newResidue": "PRO", "chain": "B",
+#                      "outputFile": "/abs/5ni1_mutant.pdb"}}]}
+#
+#  The job args are the destinations of the arguments of comparative_modelling.py and mutate_residue.py.
+#  Relative work directories are taken from the manifest location. A consolidated results index is written
+#  in json format. Jobs are run by warm workers (modeller_worker.py), one per parallel job.
+
+import os, sys, json, argparse
+from multiprocessing import Pool
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from modeller_worker import ModellerWorker, COMPARATIVE, SCRIPT_MODULES
+
+worker = None
+
+def readManifest(manifestFile):
+    with open(manifestFile) as f:
+        if manifestFile.endswith(('.yml', '.yaml')):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError('PyYAML is needed to read yaml manifests. Use a json manifest instead')
+            return yaml.safe_load(f)
+        return json.load(f)
+
+def initWorker():
+    global worker
+    worker = ModellerWorker()
+
+def runWorkerJob(job):
+    return worker.run(job)
+
+def prepareJobs(manifest, manifestDir):
+    jobs = []
+    for i, job in enumerate(manifest['jobs']):
+        job = dict(job)
+        job['name'] = job.get('name', 'job_{}'.format(i + 1))
+        if job.get('type', COMPARATIVE) not in SCRIPT_MODULES:
+            raise ValueError('Unknown type of job {}: {}'.format(job['name'], job['type']))
+        workDir = job.get('workDir', job['name'])
+        job['workDir'] = workDir if os.path.isabs(workDir) else os.path.join(manifestDir, workDir)
+        jobs.append(job)
+    return jobs
+
+def runBatch(manifestFile, nJobs=None, resultsFile=None):
+    manifestFile = os.path.abspath(manifestFile)
+    manifestDir = os.path.dirname(manifestFile)
+    manifest = readManifest(manifestFile)
+    jobs = prepareJobs(manifest, manifestDir)
+    nJobs = nJobs if nJobs else manifest.get('nJobs', 1)
+    resultsFile = os.path.abspath(resultsFile if resultsFile else os.path.join(manifestDir, 'results.json'))
+
+    # Each pool process keeps a warm modeller worker, which runs every job in a forked copy of its state
+    with Pool(processes=max(1, min(nJobs, len(jobs))), initializer=initWorker) as pool:
+        results = list(pool.imap(runWorkerJob, jobs))
+
+    with open(resultsFile, 'w') as f:
+        json.dump({'manifest': manifestFile, 'nJobs': nJobs, 'results': results}, f, indent=2)
+
+    nFailed = len([res for res in results if res['status'] != 'ok'])
+    print('{} jobs finished ({} failed). Results index: {}'.format(len(results), nFailed, resultsFile))
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a batch of modeller comparative modelling or mutation jobs')
+    parser.add_argument('manifest', type=str, help='Json or yaml file with the list of jobs')
+    parser.add_argument('-j', '--nJobs', type=int, default=None, help='Number of jobs to run in parallel')
+    parser.add_argument('-o', '--output', type=str, default=None, help='Output results index file')
+    args = parser.parse_args()
+
+    results = runBatch(args.manifest, args.nJobs, args.output)
+    sys.exit(1 if any([res['status'] != 'ok' for res in results]) else 0)
@@ -1,21 +1,33 @@
 # A sample script for fully automated comparative modeling
 # https://salilab.org/modeller/manual/node32.html
 
-import os, argparse
+import os, json, argparse, resource
 from modeller import *
 from modeller.automodel import *  # Load the AutoModel class
 from modeller.parallel import *
 
+from model_output import getModelFormat, getModelIndex, convertModelOutput
+from modeller_progress import setLogVerbosity, emitProgress, exportModulePath
+from model_restraints import TargetAutoModel, TargetAllHModel, writeSharedAttributes
+
 def special_restraints(self, aln):
     # Constrain the A and B chains to be identical (but only restrain
     # the C-alpha atoms, to reduce the number of interatomic distances
     # that need to be calculated):
     if hasattr(self, 'symChains'):
         for chainPair in self.symChains:
-            s1 = Selection(self.chains[chainPair[0]]).only_atom_types(self.symAtom)
-            s2 = Selection(self.chains[chainPair[1]]).only_atom_types(self.symAtom)
+            s1 = getSymmetrySelection(self, chainPair[0]).only_atom_types(self.symAtom)
+            s2 = getSymmetrySelection(self, chainPair[1]).only_atom_types(self.symAtom)
             self.restraints.symmetry.append(Symmetry(s1, s2, 1.0))
 
+def getSymmetrySelection(mdl, chain):
+    """ Selection of a chain, restricted to the symmetry residue ranges if defined """
+    symRanges = getattr(mdl, 'symRanges', [])
+    if not symRanges:
+        return Selection(mdl.chains[chain])
+    return Selection(*[mdl.residue_range('{}:{}'.format(first, chain), '{}:{}'.format(last, chain))
+                       for first, last in symRanges])
+
 def special_patches(self, aln):
     if hasattr(self, 'renam'):
         # Rename both chains and renumber the residues in each
@@ -43,18 +55,27 @@ def parseScore(scoreStr):
 
     return ase, scoNames
 
+def parseResidueRanges(rangesStr):
+    ranges = []
+    for rangeStr in rangesStr.split(','):
+        if rangeStr.strip():
+            first, last = rangeStr.strip().split('-')
+            ranges.append((int(first), int(last)))
+    return ranges
+
 def parseSymmetries(symStr):
     chainPairs = []
     for cPair in symStr.split(','):
         chainPairs.append(tuple(cPair.strip().split('-')))
     return chainPairs
 
-def comparativeModelling():
+def patchModelClasses():
     setattr(AutoModel, 'special_restraints', special_restraints)
     setattr(AutoModel, 'special_patches', special_patches)
     setattr(AllHModel, 'special_restraints', special_restraints)
     setattr(AllHModel, 'special_patches', special_patches)
 
+def getParser():
     parser = argparse.ArgumentParser(description='Mutate residue from a given chain of a pdb file')
     parser.add_argument('-i', '--inputSeqName', type=str, help='Name of the sequence to model in the alignment')
     parser.add_argument('-af', '--alignFile', type=str, help='Input alignment PIR file')
@@ -62,11 +83,16 @@ def comparativeModelling():
     parser.add_argument('-pd', '--pdbsDir', type=str, help='Directory containing atomic structure files')
     parser.add_argument('--align', default=False, action='store_true', help='Automatic align of the sequences')
     parser.add_argument('-n', '--nModels', type=int, default=1, required=False, help='Number of models')
+    parser.add_argument('-sm', '--startModel', type=int, default=1, required=False,
+                        help='Index of the first model to build')
 
     parser.add_argument('-im', '--iniModel', type=str, default='', help='File containing the initial PDB model')
     parser.add_argument('--modelH', default=False, action='store_true', help='Optimize also hydrogens')
     parser.add_argument('-sc', '--score', type=str, default='', help='Score of the finals models to save')
     parser.add_argument('-opt', '--optimization', type=str, default='', help='Quality of the optimization')
+    parser.add_argument('-rm', '--randMethod', type=str, default='',
+                        help='Randomization of the initial model: xyz (also with Low-Fast optimization) or none '
+                             '(optimize the initial model coordinates as they are). Blank keeps the default')
     parser.add_argument('-nr', '--nReps', type=int, default=1, required=False,
                         help='Number of optimization repetitions')
     parser.add_argument('-renum', type=str, default='', help='Renumber each chain first residue index')
@@ -74,12 +100,29 @@ def comparativeModelling():
     parser.add_argument('-sym', '--symmetry', type=str, default='', help='Symmetry restrains by chain')
     parser.add_argument('-symAtom', '--symmetryAtom', type=str, default='',
                         help='Type of atoms to check the symmetry on')
+    parser.add_argument('-symRanges', '--symmetryRanges', type=str, default='',
+                        help='Residue ranges of each chain restrained by symmetry (i.e: 10-120,150-200)')
+    parser.add_argument('-s', '--seed', type=int, default=-8123, required=False, help='Random seed')
+    parser.add_argument('-rs', '--restraintsDir', type=str, default='',
+                        help='Directory with the initial model and restraints of the target, already built')
+    parser.add_argument('--restraintsOnly', action='store_true',
+                        help='Only build the initial model and restraints of the target in the current directory')
     parser.add_argument('-nj', '--nCPUs', type=int, default=1, required=False,
                         help='Number of CPUs')
+    parser.add_argument('-of', '--outputFormat', type=str, default='.pdb',
+                        help='Extension of the output models format: .pdb, .pdb.gz or .cif.gz')
+    parser.add_argument('-pg', '--progressFile', type=str, default='',
+                        help='Output file for the json lines progress events')
+    parser.add_argument('-v', '--verbosity', type=str, default='minimal',
+                        help='Modeller log verbosity: none, minimal or verbose')
     parser.add_argument('-mPath', '--modellerPath', type=str, default='',
                         help='Path to modeller home')
+    return parser
 
-    args = parser.parse_args()
+def runComparativeModelling(args, env=None):
+    """ Runs a comparative modelling in the current directory from the parsed arguments.
+    An already built modeller Environ can be reused. Returns the list of outputs of the modeller AutoModel """
+    patchModelClasses()
 
     targetName, alignFile = args.inputSeqName, args.alignFile
     pdbCodes, pdbDir = parsePDBCodes(args.pdbsFile), args.pdbsDir
@@ -97,12 +140,13 @@ def comparativeModelling():
     if iniModel == '':
         iniModel = None
 
-    log.verbose()
-    env = Environ()
+    setLogVerbosity(args.verbosity)
+    if env is None:
+        env = Environ(rand_seed=args.seed)
 
     env.io.atom_files_directory = ['.', pdbDir]
 
-    function = AutoModel if not modelH else AllHModel
+    function = TargetAutoModel if not modelH else TargetAllHModel
 
     scF = tuple(scoreFuncs) if scoreFuncs else None
     a = function(env, alnfile=alignFile,
@@ -110,8 +154,10 @@ def comparativeModelling():
                  assess_methods=scF,
                  inifile=iniModel)
 
-    ncpus, modellerPath = args.nCPUs, args.modellerPath
-    if ncpus > 1:
+    # Each worker is a full modeller process: never start more than models to build
+    ncpus, modellerPath = min(args.nCPUs, nModels), args.modellerPath
+    if ncpus > 1 and not args.restraintsOnly:
+        exportModulePath()
         j = job()
         for i in range(ncpus):
             j.append(LocalWorker())
@@ -125,9 +171,10 @@ def comparativeModelling():
     if args.symmetry != '':
         a.symChains = parseSymmetries(args.symmetry)
         a.symAtom = args.symmetryAtom
+        a.symRanges = parseResidueRanges(args.symmetryRanges)
 
-    a.starting_model = 1
-    a.ending_model = nModels
+    a.starting_model = args.startModel
+    a.ending_model = args.startModel + nModels - 1
 
     if align:
         a.auto_align()  # get an automatic alignment
@@ -139,18 +186,38 @@ def comparativeModelling():
         a.max_var_iterations = 300
         a.md_level = refine.slow
 
+    # very_fast() disables the randomization, so all the Low-Fast models would be the same
+    if args.randMethod == 'xyz':
+        a.rand_method = randomize.xyz
+    elif args.randMethod == 'none':
+        a.rand_method = None
+
+    if getModelFormat(args.outputFormat) == 'MMCIF':
+        a.set_output_model_format('MMCIF')
 
     a.repeat_optimization = nReps
+    a.progressFile = os.path.abspath(args.progressFile) if args.progressFile else None
+    if args.restraintsOnly:
+        # Only the initial model and restraints, shared by the runs building each model of the target
+        a.make(exit_stage=1)
+        writeSharedAttributes(a)
+        return []
+    a.restraintsDir = os.path.abspath(args.restraintsDir) if args.restraintsDir else None
+
+    emitProgress(a.progressFile, 'run_started', nModels=nModels)
     a.make()  # do comparative modeling
 
-    # Get a list of all successfully built models from a.outputs
+    # Get a list of all successfully built models from a.outputs, compressed if requested
     ok_models = [x for x in a.outputs if x['failure'] is None]
+    for m in ok_models:
+        m['name'] = convertModelOutput(m['name'], args.outputFormat)
+    emitProgress(a.progressFile, 'run_finished', nOk=len(ok_models), nFailed=len(a.outputs) - len(ok_models))
 
     # Rank the models by DOPE score
     if len(scoreKeys) > 0:
         scoreStr = ''
         for m in ok_models:
-            outId = int(os.path.splitext(m['name'])[0][-2:])
+            outId = getModelIndex(m['name'])
             scoreStr += "Model: 'outputAtomStruct_{}".format(outId)
             for scoreKey in scoreKeys:
                 if type(m[scoreKey]) == list:
@@ -161,5 +228,18 @@ def comparativeModelling():
         with open('scores.txt', 'w') as f:
             f.write(scoreStr)
 
+    writePeakMemory()
+    return a.outputs
+
+def writePeakMemory(outFile='memory.json'):
+    """ Writes the peak resident memory (bytes) of this process and of its largest worker """
+    selfPeak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    childPeak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+    with open(outFile, 'w') as f:
+        json.dump({'peakMemory': max(selfPeak, childPeak)}, f)
+
+def comparativeModelling():
+    runComparativeModelling(getParser().parse_args())
+
 if __name__ == '__main__':
-    comparativeModelling()
\ No newline at end of file
+    comparativeModelling()
@@ -0,0 +1,48 @@
+# Output formats of the models written by the modeller scripts of the plugin, and file helpers shared by them
+#
+#  Models can be written as PDB, gzip compressed PDB or gzip compressed mmCIF. The format is given by the extension
+#  of the output file: .pdb, .pdb.gz or .cif.gz (modeller reads compressed files transparently).
+
+import os, re, gzip, shutil, hashlib
+
+# Explicit copy of pwchemModeller.utils.utilsTemplates.getFileHash: the scripts run in the modeller environment,
+# where pwchemModeller cannot be imported. Both must return the same hashes (checked by the plugin tests)
+def getFileHash(fileName, blockSize=2 ** 20):
+    """ Returns the sha256 hexdigest of the content of a file """
+    sha = hashlib.sha256()
+    with open(fileName, 'rb') as f:
+        for block in iter(lambda: f.read(blockSize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def getModelFormat(fileName):
+    """ Modeller model_format of a file name: MMCIF for .cif(.gz), PDB otherwise """
+    return 'MMCIF' if fileName.endswith(('.cif', '.cif.gz')) else 'PDB'
+
+def getModelIndex(modelFile):
+    """ Index of an AutoModel output file (<seq>.B9999NNNN.pdb): its model number NNNN, as the output names of
+    the protocol """
+    return int(re.search(r'\.B9999(\d{4,})\.(pdb|cif)(\.gz)?$', modelFile).group(1))
+
+def gzipFile(inFile, outFile=None):
+    """ Compresses inFile into outFile (inFile.gz by default) and removes inFile """
+    outFile = outFile if outFile else inFile + '.gz'
+    with open(inFile, 'rb') as fIn, gzip.open(outFile, 'wb') as fOut:
+        shutil.copyfileobj(fIn, fOut)
+    os.remove(inFile)
+    return outFile
+
+def writeModel(mdl, outFile):
+    """ Writes a modeller model in the format given by the extension of outFile """
+    if outFile.endswith('.gz'):
+        mdl.write(file=outFile[:-3], model_format=getModelFormat(outFile))
+        return gzipFile(outFile[:-3], outFile)
+    mdl.write(file=outFile, model_format=getModelFormat(outFile))
+    return outFile
+
+def convertModelOutput(modelFile, outExt):
+    """ Compresses a model file written by AutoModel (already in the output format, as .pdb or .cif) if outExt
+    requires it. Returns the final file name """
+    if outExt.endswith('.gz') and not modelFile.endswith('.gz'):
+        return gzipFile(modelFile)
+    return modelFile
@@ -0,0 +1,40 @@
+# Initial model and restraints shared by several modelling runs of the same target
+#
+#  Building the initial model and the restraints (AutoModel.homcsr) gives the same result for every model of a
+#  target. A run with --restraintsOnly builds them once into a directory, and the runs building the single models
+#  of the target read them from there instead of building them again.
+
+import os, json
+
+from modeller_progress import ProgressAutoModel, ProgressAllHModel
+
+# Model attributes set while building the restraints which are used afterwards (i.e: by the GA341 assessment)
+SHARED_ATTRIBUTES = ['seq_id']
+SHARED_FILE = 'shared.json'
+
+def writeSharedAttributes(mdl, outDir='.'):
+    with open(os.path.join(outDir, SHARED_FILE), 'w') as f:
+        json.dump({key: getattr(mdl, key) for key in SHARED_ATTRIBUTES if hasattr(mdl, key)}, f)
+
+class SharedRestraintsMixin:
+    """ Model class reading the initial model and restraints of its target from restraintsDir, if given """
+    restraintsDir = None
+
+    def homcsr(self, exit_stage):
+        if not self.restraintsDir or exit_stage:
+            return super().homcsr(exit_stage)
+
+        self.inifile = os.path.join(self.restraintsDir, os.path.basename(self.inifile))
+        self.csrfile = os.path.join(self.restraintsDir, os.path.basename(self.csrfile))
+        sharedFile = os.path.join(self.restraintsDir, SHARED_FILE)
+        if os.path.exists(sharedFile):
+            with open(sharedFile) as f:
+                for key, value in json.load(f).items():
+                    setattr(self, key, value)
+        self.read(file=self.inifile)
+
+class TargetAutoModel(SharedRestraintsMixin, ProgressAutoModel):
+    pass
+
+class TargetAllHModel(SharedRestraintsMixin, ProgressAllHModel):
+    pass
@@ -0,0 +1,64 @@
+# Structured progress stream of the modeller scripts of the plugin
+#
+#  Events are appended as json lines to a progress file: {"time": ..., "event": ..., <fields>}
+#  run_started (nModels), model_started (model), cycle_finished (model, cycle, objective),
+#  model_finished (model, scores), run_finished (nOk, nFailed)
+#  objective is the value of the modeller objective function (molpdf) of the model after the optimization pass.
+#  Runs whose results are restored from the result store only write their run_finished event, with restored=true.
+#  Parallel modeller workers append to the same file, one short line per write.
+#
+#  The model events are emitted by the ProgressAutoModel and ProgressAllHModel classes. The parallel workers
+#  unpickle the model they optimize, so these classes live in this importable module, which is added to the
+#  PYTHONPATH of the workers.
+
+import os, json, time
+
+from modeller import log
+from modeller.automodel import AutoModel, AllHModel
+
+LOG_LEVELS = {'none': log.none, 'minimal': log.minimal, 'verbose': log.verbose}
+
+def setLogVerbosity(verbosity='minimal'):
+    LOG_LEVELS.get(verbosity.lower(), log.minimal)()
+
+def emitProgress(progressFile, event, **fields):
+    if progressFile:
+        line = json.dumps(dict(time=time.time(), event=event, pid=os.getpid(), **fields)) + '\n'
+        with open(progressFile, 'a') as f:
+            f.write(line)
+
+def exportModulePath():
+    """ Adds the directory of the scripts to the PYTHONPATH inherited by the parallel workers """
+    scriptsDir = os.path.dirname(os.path.abspath(__file__))
+    paths = [path for path in os.environ.get('PYTHONPATH', '').split(os.pathsep) if path]
+    if scriptsDir not in paths:
+        os.environ['PYTHONPATH'] = os.pathsep.join([scriptsDir] + paths)
+
+class ProgressMixin:
+    """ Model class hooks emitting the start and end of each model and of each of its optimization passes, with
+    the objective function reached by the pass """
+    progressFile = None
+
+    def single_model(self, atmsel, num, *args, **kwargs):
+        emitProgress(self.progressFile, 'model_started', model=num)
+        result = super().single_model(atmsel, num, *args, **kwargs)
+        scores = {key: (val[0] if type(val) == list else val) for key, val in result.items() if key.endswith('score')} \
+            if isinstance(result, dict) else {}
+        emitProgress(self.progressFile, 'model_finished', model=num, scores=scores)
+        return result
+
+    def single_model_pass(self, atmsel, num, *args, **kwargs):
+        result = super().single_model_pass(atmsel, num, *args, **kwargs)
+        if self.progressFile:
+            self.progressCycle = getattr(self, 'progressCycle', {})
+            self.progressCycle[num] = self.progressCycle.get(num, 0) + 1
+            objective = atmsel.energy(output='NO_REPORT')[0]
+            emitProgress(self.progressFile, 'cycle_finished', model=num, cycle=self.progressCycle[num],
+                         objective=objective)
+        return result
+
+class ProgressAutoModel(ProgressMixin, AutoModel):
+    pass
+
+class ProgressAllHModel(ProgressMixin, AllHModel):
+    pass
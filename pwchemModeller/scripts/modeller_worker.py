@@ -0,0 +1,133 @@
+# Warm worker for the modeller scripts of the plugin
+#
+#     Usage:   python modeller_worker.py -o results.jsonl [-i jobs.jsonl] (standard input if not given)
+#
+#  Reads one job per line (json, same format as the jobs of batch_modeller.py) and writes one result per line.
+#  Instead of (or besides) the args destinations, a job can give the command line of its script as an "argv" list,
+#  i.e: {"name": "model_1", "workDir": "/abs/task_1", "argv": ["-i", "target", "-af", "/abs/alignment.pir", ...]}
+#  The jobs are run in order, so a job may use the results of the previous ones.
+#  The worker imports modeller, patches the model classes and builds the modeller environments (with their default
+#  libraries loaded) only once. Each job is then run in a forked copy of that warm state, so all the state a job
+#  modifies (environment, random generator, model classes, working directory) is discarded when it finishes and
+#  every job starts exactly as it would in a fresh process.
+
+import os, sys, json, time, argparse, traceback
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from modeller import Environ
+import comparative_modelling, mutate_residue
+
+COMPARATIVE, MUTATION = 'comparative', 'mutation'
+SCRIPT_MODULES = {COMPARATIVE: comparative_modelling, MUTATION: mutate_residue}
+
+def buildJobArgs(jobType, jobArgs, argv=None):
+    """ Builds the arguments namespace of the script of the job type from its command line arguments (argv) and
+    the args destinations, using its defaults for the args not given """
+    parser = SCRIPT_MODULES[jobType].getParser()
+    args = parser.parse_args([str(arg) for arg in argv] if argv else [])
+    unknown = set(jobArgs) - set(vars(args))
+    if unknown:
+        raise ValueError('Unknown arguments for {} job: {}'.format(jobType, ', '.join(sorted(unknown))))
+    vars(args).update(jobArgs)
+    return args
+
+def getJobSeed(job):
+    """ Random seed the environment of the job must be created with """
+    return buildJobArgs(job.get('type', COMPARATIVE), job.get('args', {}), job.get('argv')).seed
+
+def runJob(job, env=None):
+    """ Runs a single job in its working directory and returns its entry for the results index """
+    jobType, workDir = job.get('type', COMPARATIVE), job['workDir']
+    result = {'name': job['name'], 'type': jobType, 'workDir': workDir, 'status': 'ok', 'error': '',
+              'outputs': [], 'scores': {}}
+    iniTime = time.time()
+    try:
+        os.makedirs(workDir, exist_ok=True)
+        os.chdir(workDir)
+        args = buildJobArgs(jobType, job.get('args', {}), job.get('argv'))
+
+        if jobType == COMPARATIVE:
+            outputs = comparative_modelling.runComparativeModelling(args, env=env)
+            for out in outputs:
+                if out['failure'] is None:
+                    outFile = os.path.abspath(out['name'])
+                    result['outputs'].append(outFile)
+                    result['scores'][outFile] = {key: (val[0] if type(val) == list else val)
+                                                 for key, val in out.items() if key.endswith('score')}
+        else:
+            result['outputs'].append(os.path.abspath(mutate_residue.runMutateResidue(args, env=env)))
+
+    except Exception as e:
+        result['status'], result['error'] = 'failed', '{}: {}'.format(type(e).__name__, e)
+        traceback.print_exc()
+
+    result['time'] = time.time() - iniTime
+    return result
+
+
+class ModellerWorker:
+    """ Keeps modeller loaded, the model classes patched and one warm Environ per random seed. Jobs run in forked
+    children of the warm worker, so only the per-job state is created for each of them """
+    def __init__(self):
+        comparative_modelling.patchModelClasses()
+        self.envs = {}
+
+    def getEnviron(self, seed=None):
+        if seed not in self.envs:
+            self.envs[seed] = Environ() if seed is None else Environ(rand_seed=seed)
+        return self.envs[seed]
+
+    def run(self, job):
+        try:
+            env = self.getEnviron(getJobSeed(job))
+        except Exception:
+            # Argument errors are reported by the job itself
+            env = None
+
+        if not hasattr(os, 'fork'):
+            return runJob(job, env=None)
+
+        rPipe, wPipe = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(rPipe)
+            status = 0
+            try:
+                result = runJob(job, env=env)
+                with os.fdopen(wPipe, 'w') as f:
+                    json.dump(result, f)
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            finally:
+                sys.stdout.flush(), sys.stderr.flush()
+                os._exit(status)
+
+        os.close(wPipe)
+        with os.fdopen(rPipe) as f:
+            resultStr = f.read()
+        _, status = os.waitpid(pid, 0)
+        if resultStr:
+            return json.loads(resultStr)
+        return {'name': job['name'], 'type': job.get('type', COMPARATIVE), 'workDir': job['workDir'],
+                'status': 'failed', 'error': 'Worker process died with status {}'.format(status),
+                'outputs': [], 'scores': {}, 'time': 0}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Warm modeller worker running the jobs of a file or the stdin')
+    parser.add_argument('-o', '--output', type=str, required=True, help='Output file with a json result per line')
+    parser.add_argument('-i', '--input', type=str, default=None,
+                        help='Input file with a json job per line. Jobs are read from the standard input if not given')
+    args = parser.parse_args()
+
+    worker = ModellerWorker()
+    fIn = open(args.input) if args.input else sys.stdin
+    with fIn, open(args.output, 'a') as fOut:
+        for line in fIn:
+            if line.strip():
+                job = json.loads(line)
+                job['name'] = job.get('name', 'job')
+                job['workDir'] = os.path.abspath(job.get('workDir', job['name']))
+                fOut.write(json.dumps(worker.run(job)) + '\n')
+                fOut.flush()
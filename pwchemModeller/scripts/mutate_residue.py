@@ -4,6 +4,9 @@ from modeller import *
 from modeller.optimizers import MolecularDynamics, ConjugateGradients
 from modeller.automodel import autosched
 
+from model_output import getModelFormat, writeModel
+from modeller_progress import setLogVerbosity
+
 #
 #  mutate_model.py
 #
@@ -59,7 +62,7 @@ def make_restraints(mdl1, aln):
                 spline_dx=0.3, spline_min_points = 5, aln=aln,
                 spline_on_site=True)
 
-def mutateResidue():
+def getParser():
     parser = argparse.ArgumentParser(description='Mutate residue from a given chain of a pdb file')
     parser.add_argument('-i', '--inputFilename', type=str, help='Input pdb file')
     parser.add_argument('-p', '--position', type=str, help='Residue position to mutate')
@@ -67,6 +70,8 @@ def mutateResidue():
     parser.add_argument('-c', '--chain', type=str, help='Chain of the protein to mutate')
     parser.add_argument('-s', '--seed', type=int, default=-49837, required=False, help='Random seed')
     parser.add_argument('-o', '--outputFile', type=str, help='Output file')
+    parser.add_argument('-v', '--verbosity', type=str, default='minimal',
+                        help='Modeller log verbosity: none, minimal or verbose')
 
     parser.add_argument('-contactShell', type=float, default=4.0, required=False)
     parser.add_argument('-updateDynamic', type=float, default=0.39, required=False)
@@ -84,16 +89,20 @@ def mutateResidue():
     parser.add_argument('-relativeDielectric', type=float, default=1.0, required=False)
 
     parser.add_argument('--dynamicModeller', default=False, action='store_true')
+    return parser
 
-    args = parser.parse_args()
+def runMutateResidue(args, env=None):
+    """ Performs the mutation from the parsed arguments. An already built modeller Environ, created with the same
+    random seed, can be reused. Returns the output file """
     modelname = args.inputFilename
 
     chain, resp, restyp = args.chain, args.position, args.newResidue
     seed, outputFile = args.seed, args.outputFile
-    log.verbose()
+    setLogVerbosity(args.verbosity)
 
     # Set a different value for rand_seed to get a different final model
-    env = Environ(rand_seed=seed)
+    if env is None:
+        env = Environ(rand_seed=seed)
     env.io.hetatm = True
 
     #soft sphere potential
@@ -125,7 +134,7 @@ def mutateResidue():
 
 
     # Read the original PDB file and copy its sequence to the alignment array:
-    mdl1 = Model(env, file=modelname)
+    mdl1 = Model(env, file=modelname, model_format=getModelFormat(modelname))
     ali = Alignment(env)
     ali.append_model(mdl1, atom_files=modelname, align_codes=modelname)
 
@@ -149,7 +158,7 @@ def mutateResidue():
     mdl1.build(initialize_xyz=False, build_method='INTERNAL_COORDINATES')
 
     #yes model2 is the same file as model1.  It's a modeller trick.
-    mdl2 = Model(env, file=modelname)
+    mdl2 = Model(env, file=modelname, model_format=getModelFormat(modelname))
     #required to do a transfer_res_numb
     #ali.append_model(mdl2, atom_files=modelname, align_codes=modelname)
     #transfers from "model 2" to "model 1"
@@ -199,8 +208,11 @@ def mutateResidue():
     # delete the temporary file
     os.remove(tmpFile)
 
-    #give a proper name
-    mdl1.write(file=outputFile)
+    #give a proper name, in the format of its extension
+    return writeModel(mdl1, outputFile)
+
+def mutateResidue():
+    runMutateResidue(getParser().parse_args())
 
 if __name__ == '__main__':
-    mutateResidue()
\ No newline at end of file
+    mutateResidue()
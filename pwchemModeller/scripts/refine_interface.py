@@ -0,0 +1,59 @@
+# Short refinement of the interface residues of an oligomer built from copies of a protomer
+#
+#     Usage:   python refine_interface.py -i oligomer.pdb -r interface.txt -o refined.pdb [-n 200]
+#
+#  The interface file contains one residue per line as <resNumber>:<chain>. Only those residues are optimized
+#  (conjugate gradients on their stereochemical restraints and the non-bonded interactions with their environment),
+#  the rest of the structure is kept fixed.
+
+import os, sys, argparse
+
+from modeller import *
+from modeller.scripts import complete_pdb
+from modeller.optimizers import ConjugateGradients
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from model_output import getModelFormat, writeModel
+from modeller_progress import setLogVerbosity
+
+def readInterfaceResidues(interfaceFile):
+    with open(interfaceFile) as f:
+        return [line.strip() for line in f if line.strip()]
+
+def getParser():
+    parser = argparse.ArgumentParser(description='Refine the interface residues of an oligomer')
+    parser.add_argument('-i', '--inputFile', type=str, help='Input oligomer structure file')
+    parser.add_argument('-r', '--residuesFile', type=str, help='File with the interface residues (resNumber:chain)')
+    parser.add_argument('-o', '--outputFile', type=str, help='Output refined structure file')
+    parser.add_argument('-n', '--nIterations', type=int, default=200, help='Maximum conjugate gradients iterations')
+    parser.add_argument('-v', '--verbosity', type=str, default='minimal',
+                        help='Modeller log verbosity: none, minimal or verbose')
+    return parser
+
+def refineInterface(args):
+    setLogVerbosity(args.verbosity)
+    env = Environ()
+    env.io.atom_files_directory = ['.']
+    env.edat.dynamic_sphere = True
+    env.libs.topology.read(file='$(LIB)/top_heav.lib')
+    env.libs.parameters.read(file='$(LIB)/par.lib')
+
+    if getModelFormat(args.inputFile) == 'MMCIF':
+        mdl = complete_pdb(env, args.inputFile, model_format='MMCIF')
+    else:
+        mdl = complete_pdb(env, args.inputFile)
+
+    residues = readInterfaceResidues(args.residuesFile)
+    if residues:
+        sel = Selection(*[mdl.residues[resId] for resId in residues])
+        mdl.restraints.make(Selection(mdl), restraint_type='stereo', spline_on_site=False)
+        mdl.restraints.unpick_all()
+        mdl.restraints.pick(sel)
+        # Non-bonded pairs with at least one selected atom: the interface feels its environment
+        mdl.env.edat.nonbonded_sel_atoms = 1
+        ConjugateGradients().optimize(sel, max_iterations=args.nIterations)
+
+    return writeModel(mdl, args.outputFile)
+
+if __name__ == '__main__':
+    refineInterface(getParser().parse_args())
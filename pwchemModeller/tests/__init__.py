@@ -26,3 +26,12 @@
 
 from pwchemModeller.tests.test_comparative_modelling import *
 from pwchemModeller.tests.test_mutate_residue import *
+from pwchemModeller.tests.test_score_structures import *
+from pwchemModeller.tests.test_templates import *
+from pwchemModeller.tests.test_template_search import *
+from pwchemModeller.tests.test_wizards import *
+from pwchemModeller.tests.test_resources import *
+from pwchemModeller.tests.test_clustering import *
+from pwchemModeller.tests.test_alignment import *
+from pwchemModeller.tests.test_scratch import *
+from pwchemModeller.tests.test_symmetry import *
@@ -0,0 +1,78 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import gzip
+import numpy as np
+from Bio.SeqUtils import seq3
+
+# Backbone atoms written for each residue, with their offsets (A) from the C-alpha
+BACKBONE = [('N', 'N', (-1.2, 0.6, 0.0)), ('CA', 'C', (0.0, 0.0, 0.0)),
+            ('C', 'C', (1.2, 0.6, 0.0)), ('O', 'O', (1.3, 1.8, 0.0))]
+
+ATOM_LINE = 'ATOM  {:5d}  {:<3s} {:3s} {:1s}{:4d}    {:8.3f}{:8.3f}{:8.3f}  1.00  0.00          {:>2s}'
+
+
+def getHelixCoords(nRes, shift=(0.0, 0.0, 0.0), noise=0.0, seed=0):
+    """ C-alpha coordinates of an ideal alpha helix of nRes residues, moved by shift and maybe perturbed """
+    angles = np.radians(100.0) * np.arange(nRes)
+    coords = np.stack([2.3 * np.cos(angles), 2.3 * np.sin(angles), 1.5 * np.arange(nRes)], axis=1)
+    if noise:
+        coords += np.random.default_rng(seed).normal(scale=noise, size=coords.shape)
+    return coords + np.array(shift)
+
+
+def writeSyntheticPDB(pdbFile, chains, firstIdx=1, coordsDic=None, resolution=None):
+    """ Writes a PDB file with the backbone of the chains {chainId: sequence}, built as helices placed 20 A apart.
+    The C-alpha coordinates of any chain can be given in coordsDic. A .gz file name is gzip compressed """
+    lines = ['REMARK   2 RESOLUTION.    {:.2f} ANGSTROMS.'.format(resolution)] if resolution else []
+    atomIdx = 1
+    for i, (chainId, seq) in enumerate(chains.items()):
+        coords = coordsDic[chainId] if coordsDic and chainId in coordsDic else \
+            getHelixCoords(len(seq), shift=(20.0 * i, 0.0, 0.0))
+        for j, (res, caCoords) in enumerate(zip(seq, coords)):
+            for atomName, element, offset in BACKBONE:
+                x, y, z = caCoords + np.array(offset)
+                lines.append(ATOM_LINE.format(atomIdx, atomName, seq3(res).upper(), chainId, firstIdx + j,
+                                              x, y, z, element))
+                atomIdx += 1
+        lines.append('TER')
+    lines.append('END')
+
+    pdbStr = '\n'.join(lines) + '\n'
+    if pdbFile.endswith('.gz'):
+        with gzip.open(pdbFile, 'wt') as f:
+            f.write(pdbStr)
+    else:
+        with open(pdbFile, 'w') as f:
+            f.write(pdbStr)
+    return pdbFile
+
+
+def writeFastaFile(fastaFile, seqDic):
+    with open(fastaFile, 'w') as f:
+        for name, seq in seqDic.items():
+            f.write('>{}\n{}\n'.format(name, seq))
+    return fastaFile
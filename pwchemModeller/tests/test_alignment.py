@@ -0,0 +1,181 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os, json
+import numpy as np
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+
+from ..utils.utilsAlignment import AlignmentCache, getAddAlignmentCommand, FULL, SUBSET, ADD, Alignment, \
+    readFasta, removeGapColumns, checkAlignmentTemplates
+from .synthetic import writeSyntheticPDB
+
+SEQS = {'target': 'MKTAYIAKQRQISFVK', '1abc_A': 'MKTAYAKQRQISFV', '2def_B': 'KTAYIAKQRISFVK'}
+ALIGNMENT = {'target': 'MKTAYIAKQRQISFVK', '1abc_A': 'MKTAY-AKQRQISFV-', '2def_B': '-KTAYIAKQR-ISFVK'}
+
+class TestAlignmentCache(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def test_getKey(self):
+        key = AlignmentCache.getKey('Mafft', {'gapOpen': 1.53}, SEQS['target'])
+        self.assertEqual(key, AlignmentCache.getKey('Mafft', {'gapOpen': 1.53}, SEQS['target']))
+        self.assertNotEqual(key, AlignmentCache.getKey('Mafft', {'gapOpen': 2.0}, SEQS['target']))
+        self.assertNotEqual(key, AlignmentCache.getKey('Clustal_Omega', {'gapOpen': 1.53}, SEQS['target']))
+
+    def test_saveLoad(self):
+        cache = AlignmentCache(self.getOutputPath())
+        key = AlignmentCache.getKey('Mafft', {}, SEQS['target'])
+        self.assertIsNone(cache.load(key))
+        cache.save(key, SEQS, Alignment.fromDict(ALIGNMENT))
+        cached = cache.load(key)
+        self.assertEqual((cached['sequences'], cached['alignment'].toDict()), (SEQS, ALIGNMENT))
+        self.assertEqual(os.listdir(self.getOutputPath()), ['{}.json'.format(key)])
+
+        # Caches of other versions are ignored
+        with open(cache.getFile(key), 'w') as f:
+            json.dump(dict(cached, alignment=ALIGNMENT, version=0), f)
+        self.assertIsNone(cache.load(key))
+
+        # Without cache directory nothing is stored
+        AlignmentCache('').save(key, SEQS, Alignment.fromDict(ALIGNMENT))
+        self.assertIsNone(AlignmentCache('').load(key))
+
+    def test_getUpdateMode(self):
+        cached = {'sequences': SEQS, 'alignment': ALIGNMENT}
+        self.assertEqual(AlignmentCache.getUpdateMode(None, SEQS), (FULL, []))
+        self.assertEqual(AlignmentCache.getUpdateMode(cached, SEQS), (SUBSET, []))
+        self.assertEqual(AlignmentCache.getUpdateMode(cached, {'target': SEQS['target']}), (SUBSET, []))
+        self.assertEqual(AlignmentCache.getUpdateMode(cached, dict(SEQS, **{'3ghi_A': 'MKTAYIAK'})),
+                         (ADD, ['3ghi_A']))
+        # A modified sequence under the same name needs a new alignment
+        self.assertEqual(AlignmentCache.getUpdateMode(cached, dict(SEQS, **{'1abc_A': 'MKTAY'})), (FULL, []))
+
+    def test_getAddAlignmentCommand(self):
+        self.assertEqual(getAddAlignmentCommand('Mafft', 'prev.fa', 'new.fa', 'out.fa'),
+                         ('mafft', '--add new.fa prev.fa > out.fa'))
+        self.assertEqual(getAddAlignmentCommand('Clustal_Omega', 'prev.fa', 'new.fa', 'out.fa')[0], 'clustalo')
+        self.assertIsNone(getAddAlignmentCommand('Muscle', 'prev.fa', 'new.fa', 'out.fa'))
+
+class TestAlignment(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def test_indexMaps(self):
+        alignment = Alignment.fromDict({'target': 'MK-TA/YI', 'tmpl': '-KLT-/Y.'})
+        self.assertEqual(alignment.getNumberOfColumns(), 8)
+        self.assertEqual(alignment.getSequence('tmpl', gapped=False), 'KLTY')
+        self.assertEqual(alignment.getColumnsToResidues('target').tolist(), [0, 1, -1, 2, 3, -1, 4, 5])
+        self.assertEqual(alignment.getColumnsToResidues('tmpl', firstResidue=10).tolist(),
+                         [-1, 10, 11, 12, -1, -1, 13, -1])
+        self.assertEqual(alignment.getResiduesToColumns('tmpl').tolist(), [1, 2, 3, 6])
+        self.assertTrue('tmpl' in alignment and 'other' not in alignment)
+
+    def test_statistics(self):
+        alignment = Alignment.fromDict(ALIGNMENT)
+        identity = alignment.getIdentity()
+        self.assertTrue(np.allclose(identity, identity.T))
+        self.assertTrue(np.allclose(np.diag(identity), 1))
+        self.assertTrue(np.allclose(alignment.getIdentity('target'), [1, 1, 1]))
+        self.assertTrue(np.allclose(alignment.getCoverage('target'), [1, 14 / 16, 14 / 16]))
+
+    def test_subsetRemoveGaps(self):
+        alnDic = {'target': 'MK-TAYI', 'tmpl1': 'MK-TA--', 'tmpl2': '-K-TAY-'}
+        self.assertEqual(removeGapColumns(Alignment.fromDict(alnDic)).toDict(),
+                         {'target': 'MKTAYI', 'tmpl1': 'MKTA--', 'tmpl2': '-KTAY-'})
+        self.assertEqual(Alignment.fromDict(alnDic).subset(['tmpl1', 'target']).toDict(),
+                         {'tmpl1': 'MKTA--', 'target': 'MKTAYI'})
+        self.assertEqual(Alignment.fromDict(alnDic).subset(['tmpl1', 'tmpl2']).toDict(),
+                         {'tmpl1': 'MKTA-', 'tmpl2': '-KTAY'})
+        self.assertEqual(len(removeGapColumns(Alignment([], []))), 0)
+        with self.assertRaises(ValueError):
+            Alignment.fromDict({'target': 'MKTA', 'tmpl': 'MK'})
+
+    def test_renameUpper(self):
+        headers = {'s1': 'structureX:1abc:2:A:15:A:::-1.00:-1.00'}
+        alignment = Alignment.fromDict({'s0': 'mk-ta', 's1': 'MKLT-'}, headers).rename(['target', '1abc_A']).upper()
+        self.assertEqual(alignment.toDict(), {'target': 'MK-TA', '1abc_A': 'MKLT-'})
+        self.assertEqual(alignment.headers, {'1abc_A': headers['s1']})
+
+    def test_readWrite(self):
+        headers = {'1abc_A': 'structureX:1abc:2:A:15:A:::-1.00:-1.00'}
+        alignment = Alignment.fromDict(ALIGNMENT, headers)
+        for ext in ['.pir', '.aln', '.fa']:
+            alignFile = alignment.write(self.getOutputPath('alignment' + ext))
+            read = Alignment.read(alignFile)
+            self.assertEqual(read.toDict(), ALIGNMENT)
+            self.assertEqual(list(read.toDict()), list(ALIGNMENT))
+        self.assertEqual(Alignment.read(self.getOutputPath('alignment.pir')).headers['1abc_A'], headers['1abc_A'])
+
+        # Long sequences are split in several blocks of the clustal format
+        longAln = {'target': 'MKTAYIAKQR' * 10, 'tmpl': 'MKTAY-AKQR' * 10}
+        alnFile = Alignment.fromDict(longAln).write(self.getOutputPath('long.aln'))
+        self.assertEqual(Alignment.read(alnFile).toDict(), longAln)
+
+    def test_readFasta(self):
+        fastaFile = self.getOutputPath('seqs.fa')
+        with open(fastaFile, 'w') as f:
+            f.write('>1abc_A mol:protein length:14\nMKTAY\nAKQRQISFV\n\n>2def_B\nKTAYIAKQRISFVK\n')
+        self.assertEqual(readFasta(fastaFile), {'1abc_A': SEQS['1abc_A'], '2def_B': SEQS['2def_B']})
+
+class TestAlignmentCheck(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        cls.atomDir = cls.getOutputPath('atoms')
+        os.makedirs(cls.atomDir)
+        writeSyntheticPDB(os.path.join(cls.atomDir, '1abc.pdb'), {'A': SEQS['target'], 'B': SEQS['2def_B']})
+
+    def _checkEntries(self, entries):
+        """ Checks a PIR alignment of the target with the template entries [(header, gappedSeq)] """
+        pirFile = self.getOutputPath('check.pir')
+        alignment = Alignment(['target'] + ['tmpl{}'.format(i) for i in range(len(entries))],
+                              [SEQS['target']] + [seq for _, seq in entries],
+                              {'tmpl{}'.format(i): header for i, (header, _) in enumerate(entries)})
+        alignment.writePIR(pirFile)
+        return checkAlignmentTemplates(pirFile, [self.getOutputPath('missing'), self.atomDir])
+
+    def test_matchingTemplates(self):
+        self.assertEqual(self._checkEntries([('structureX:1abc:3:A:+10:A:::-1.00:-1.00', '--TAYIAKQRQI----'),
+                                             ('structureX:1abc:FIRST:A:LAST:A:::-1.00:-1.00', SEQS['target']),
+                                             ('structureX:1abc:1:B:14:B:::-1.00:-1.00', '--' + SEQS['2def_B'])]),
+                         [])
+
+    def test_mismatchingTemplates(self):
+        errors = self._checkEntries([('structureX:1abc:3:C:+10:C:::-1.00:-1.00', '--TAYIAKQRQI----'),
+                                     ('structureX:1xyz:3:A:+10:A:::-1.00:-1.00', '--TAYIAKQRQI----'),
+                                     ('structureX:1abc:40:A:+10:A:::-1.00:-1.00', '--TAYIAKQRQI----'),
+                                     ('structureX:1abc:3:A:+10:A:::-1.00:-1.00', '--TAYIAKQRQV----'),
+                                     ('structureX:1abc:3:A:12:A:::-1.00:-1.00', '--TAYIAKQRQIS---')])
+        self.assertEqual(len(errors), 5)
+        self.assertIn('chain C not found', errors[0])
+        self.assertIn('atom file 1xyz not found', errors[1])
+        self.assertIn('start residue 40 not found', errors[2])
+        self.assertIn('residue 10 is I in the structure and V in the alignment', errors[3])
+        self.assertIn('10 residues in the structure and 11 in the alignment', errors[4])
@@ -0,0 +1,137 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import numpy as np
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+
+from ..utils.utilsClustering import loadCACoordinates, pairwiseRMSD, clusterByRMSD, collapseTemplates
+from ..utils.utilsTemplates import TemplateEntry, TemplateManifest
+from .synthetic import writeSyntheticPDB, writeFastaFile, getHelixCoords
+
+SEQ = 'MKTAYIAKQRQISFVKSHFSRQLEERLGLIEVQAPILSRVGDGTQDNLSGAEKAVQV'
+OTHER_SEQ = 'GSHMLEDPVDAFQEWMKLLTNPRWVEKYGQDLLPNAIRHLAEEQKWDDGSTRLAE'
+
+
+def getRotation(seed):
+    """ Random proper rotation matrix """
+    q, r = np.linalg.qr(np.random.default_rng(seed).normal(size=(3, 3)))
+    q *= np.sign(np.diag(r))
+    return q if np.linalg.det(q) > 0 else -q
+
+
+def kabschRMSD(coords1, coords2):
+    """ Reference RMSD after superposition, from the singular value decomposition of each covariance """
+    x, y = coords1 - coords1.mean(axis=0), coords2 - coords2.mean(axis=0)
+    u, s, vt = np.linalg.svd(x.T @ y)
+    s[-1] *= np.sign(np.linalg.det(u @ vt))
+    return np.sqrt(max(0, ((x ** 2).sum() + (y ** 2).sum() - 2 * s.sum()) / len(x)))
+
+
+class TestModelClustering(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def test_pairwiseRMSD(self):
+        coords = np.array([getHelixCoords(30, noise=0.5 * (i % 4), seed=i) @ getRotation(i).T + i
+                           for i in range(11)])
+        # Mirror image, only superimposable with a reflection
+        coords[10] = coords[9] * np.array([1, 1, -1])
+        rmsd = pairwiseRMSD(coords, blockSize=4)
+
+        refRMSD = np.array([[kabschRMSD(c1, c2) for c2 in coords] for c1 in coords])
+        self.assertTrue(np.allclose(rmsd, refRMSD, atol=1e-4))
+        self.assertTrue(np.allclose(rmsd, rmsd.T))
+        self.assertTrue(np.allclose(np.diag(rmsd), 0))
+        # Rotated and translated copies of the same helix
+        self.assertAlmostEqual(rmsd[0, 4], 0, places=4)
+        self.assertGreater(rmsd[9, 10], 0.5)
+
+    def test_clusterByRMSD(self):
+        rmsd = np.array([[0.0, 1.0, 5.0, 6.0],
+                         [1.0, 0.0, 4.0, 1.5],
+                         [5.0, 4.0, 0.0, 3.0],
+                         [6.0, 1.5, 3.0, 0.0]])
+        clusters = clusterByRMSD(rmsd, scores=[-1.0, -3.0, -2.0, 0.0], threshold=2.0)
+        self.assertEqual([(cl['representative'], cl['members']) for cl in clusters], [(1, [0, 1, 3]), (2, [2])])
+        self.assertAlmostEqual(clusters[0]['meanRMSD'], 2.5 / 3)
+        self.assertEqual(clusters[0]['maxRMSD'], 1.5)
+
+        # Without scores, the models are taken in order
+        clusters = clusterByRMSD(rmsd, threshold=2.0)
+        self.assertEqual([cl['members'] for cl in clusters], [[0, 1], [2], [3]])
+
+    def test_loadCACoordinates(self):
+        pdbFiles = [writeSyntheticPDB(self.getOutputPath('model_1.pdb'), {'A': SEQ}),
+                    writeSyntheticPDB(self.getOutputPath('model_2.pdb'), {'A': SEQ[2:]}, firstIdx=3)]
+        coords = loadCACoordinates(pdbFiles)
+        # Only the residues present in both models
+        self.assertEqual(coords.shape, (2, len(SEQ) - 2, 3))
+        self.assertTrue(np.allclose(coords[0], getHelixCoords(len(SEQ))[2:], atol=1e-3))
+
+
+class TestTemplateCollapsing(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        coords = getHelixCoords(len(SEQ))
+        # code: (sequence, C-alpha coordinates, first residue, resolution)
+        templates = {'1aaa': (SEQ, coords, 1, 2.5),
+                     '1bbb': (SEQ, getHelixCoords(len(SEQ), noise=0.2, seed=1), 1, 1.8),
+                     '1ccc': (SEQ[10:], coords[10:], 11, 1.5),
+                     '1ddd': (OTHER_SEQ, coords, 1, 1.0),
+                     '1eee': (SEQ, getHelixCoords(len(SEQ), noise=3.0, seed=2), 1, 1.2)}
+        cls.entries = []
+        for code, (seq, caCoords, firstIdx, resolution) in templates.items():
+            structFile = writeSyntheticPDB(cls.getOutputPath(code + '.pdb'), {'A': seq}, firstIdx=firstIdx,
+                                           coordsDic={'A': caCoords})
+            seqFile = writeFastaFile(cls.getOutputPath(code + '.fa'), {code + '_A': SEQ if code != '1ddd' else seq})
+            cls.entries.append(TemplateEntry(code, ['A'], [['FIRST', 'LAST']], [seqFile], structFile,
+                                             resolution=resolution))
+
+    def test_keepBestResolution(self):
+        kept, dropped = collapseTemplates(TemplateManifest(self.entries))
+        self.assertEqual([entry.code for entry in kept], ['1ccc', '1ddd', '1eee'])
+        self.assertEqual({drop['code']: drop['representative'] for drop in dropped}, {'1aaa': '1ccc', '1bbb': '1ccc'})
+        self.assertEqual([drop['identity'] for drop in dropped], [1.0, 1.0])
+        self.assertTrue(all([drop['rmsd'] < 1.0 for drop in dropped]))
+
+    def test_keepMostComplete(self):
+        kept, dropped = collapseTemplates(TemplateManifest(self.entries), keepBest='completeness')
+        # The complete templates tie, so the best resolution is kept
+        self.assertEqual([entry.code for entry in kept], ['1bbb', '1ddd', '1eee'])
+        dropped = {drop['code']: drop for drop in dropped}
+        self.assertEqual(sorted(dropped), ['1aaa', '1ccc'])
+        self.assertAlmostEqual(dropped['1ccc']['completeness'], (len(SEQ) - 10) / len(SEQ))
+
+    def test_thresholds(self):
+        kept, dropped = collapseTemplates(TemplateManifest(self.entries), rmsdThreshold=0.01)
+        self.assertEqual([entry.code for entry in kept], ['1bbb', '1ccc', '1ddd', '1eee'])
+        self.assertEqual([(drop['code'], drop['representative']) for drop in dropped], [('1aaa', '1ccc')])
+        kept, _ = collapseTemplates(TemplateManifest(self.entries), identityThreshold=1.01)
+        self.assertEqual(len(kept), len(self.entries))
@@ -24,7 +24,7 @@
 # *
 # **************************************************************************
 
-import json
+import os, json
 
 from pyworkflow.tests import BaseTest, setupTestProject, DataSet
 from pwem.protocols.protocol_import import ProtImportSequence
@@ -34,10 +34,14 @@ from pwem.constants import RESIDUES3TO1, RESIDUES1TO3
 
 from pwchem.utils import downloadPDB
 
+from pwchemModeller import Plugin
 from ..protocols import ProtModellerComparativeModelling
+from ..protocols.protocol_comparative_modelling import MODEL_FILE_RE
+from ..constants import MODELLER_DIC
 
 pdbDic = {'1a00': ['56', 'B', 'FIRST-LAST'], '1a01': ['496', 'D', 'FIRST-LAST'],
           '1a0u': ['356', 'B', 'FIRST-LAST'], '1aj9': ['613', 'B', 'FIRST-LAST'],}
+multiPdbId = '1a00'
 
 templatesStr = ''
 for i, pdbId in enumerate(pdbDic):
@@ -78,7 +82,9 @@ class TestModellerComparativeModelling(BaseTest):
 
         setupTestProject(cls)
         cls._runImportSeq()
+        cls._runImportSeqSet()
         cls._writeSequenceTemplates()
+        cls._writeMultiChainTemplate()
 
     @classmethod
     def _writeSequenceTemplates(cls):
@@ -105,6 +111,24 @@ class TestModellerComparativeModelling(BaseTest):
                 f.write('>{}\n{}\n'.format(seqName, seq))
 
 
+    @classmethod
+    def _writeMultiChainTemplate(cls):
+        # Fasta files of the alpha (A) and beta (B) chains of 1a00, as written by the multi-chain template wizard
+        structureHandler = emconv.AtomicStructHandler()
+        structureHandler.read(downloadPDB(multiPdbId, structureHandler))
+        modelsLength, modelsFirstResidue = structureHandler.getModelsChains()
+
+        for chain in ['A', 'B']:
+            finalResiduesList = [emobj.String(i) for i in getResidueList(modelsFirstResidue, 0, chain)]
+            idxs = [json.loads(finalResiduesList[0].get())['index'],
+                    json.loads(finalResiduesList[-1].get())['index']]
+            seqFile = cls.proj.getTmpPath('{}_0_{}_{}-{}.fa'.format(multiPdbId, chain, *idxs))
+            with open(seqFile, 'w') as f:
+                f.write('>{}_{}\n{}\n'.format(multiPdbId, chain, getSequence(finalResiduesList, idxs)))
+
+        cls.multiTemplatesStr = '1) {"pdbName": "%s", "chains": "0-A, 0-B", "seqFiles": "%s"}\n' % \
+                                (multiPdbId, os.path.abspath(cls.proj.getTmpPath('{}_0_*_*.fa'.format(multiPdbId))))
+
     @classmethod
     def _runImportSeq(cls):
         protImportSeq = cls.newProtocol(
@@ -114,6 +138,25 @@ class TestModellerComparativeModelling(BaseTest):
         cls.launchProtocol(protImportSeq)
         cls.protImportSeq = protImportSeq
 
+    @classmethod
+    def _runImportSeqSet(cls):
+        protImportAlpha = cls.newProtocol(
+            ProtImportSequence,
+            inputSequence=0, inputProteinSequence=3,
+            uniProtSequence='P69905', inputSequenceName='hemoAlpha')
+        cls.launchProtocol(protImportAlpha)
+
+        # Alpha and beta chains of hemoglobin as a set of sequences, stored as an output of the alpha import
+        seqSet = emobj.SetOfSequences.create(protImportAlpha._getPath())
+        for seqObj in [protImportAlpha.outputSequence, cls.protImportSeq.outputSequence]:
+            seqItem = seqObj.clone()
+            seqItem.setObjId(None)
+            seqSet.append(seqItem)
+        seqSet.write()
+        protImportAlpha._defineOutputs(outputSequences=seqSet)
+        cls.proj._storeProtocol(protImportAlpha)
+        cls.protImportSeqSet = protImportAlpha
+
     def _runModellerComparative(self):
         protModeller = self.newProtocol(
             ProtModellerComparativeModelling,
@@ -124,9 +167,91 @@ class TestModellerComparativeModelling(BaseTest):
         pdbOut = getattr(protModeller, 'outputAtomStruct_1', None)
         self.assertIsNotNone(pdbOut)
 
+    def _runModellerOptions(self, **kwargs):
+        protModeller = self.newProtocol(
+            ProtModellerComparativeModelling,
+            inputSequence=self.protImportSeq.outputSequence,
+            alignMethod=3, templateList=templatesStr, **kwargs)
+
+        self.launchProtocol(protModeller)
+        return protModeller
+
+    def _getOutputStructs(self, protModeller):
+        return {outName: out for outName, out in protModeller.iterOutputAttributes()
+                if outName.startswith('outputAtomStruct_')}
+
     def test_mutateResidue(self):
         self._runModellerComparative()
 
+    def test_clusterModels(self):
+        protModeller = self._runModellerOptions(nModels=4, clusterModels=True, clusterRMSD=100.0)
+        pdbOuts = list(self._getOutputStructs(protModeller).values())
+        self.assertEqual(len(pdbOuts), 1)
+        self.assertEqual(pdbOuts[0]._clusterSize.get(), 4)
+
+    def test_compressedOutput(self):
+        protModeller = self._runModellerOptions(outputFormat=1)
+        pdbOut = getattr(protModeller, 'outputAtomStruct_1', None)
+        self.assertIsNotNone(pdbOut)
+        self.assertTrue(pdbOut.getFileName().endswith('.pdb.gz'))
+
+    def test_topModelHydrogens(self):
+        protModeller = self._runModellerOptions(nModels=2, modelH=True, hydrogensMode=1, hydrogensTopK=1)
+        pdbOuts = list(self._getOutputStructs(protModeller).values())
+        self.assertEqual(len(pdbOuts), 2)
+        self.assertEqual(sorted([out._hydrogens.get() for out in pdbOuts]), [False, True])
+
+    def test_stagedRefinement(self):
+        protModeller = self._runModellerOptions(nModels=3, stagedRefinement=True, refineTopK=1)
+        self.assertEqual(len(self._getOutputStructs(protModeller)), 1)
+
+    def test_manyModels(self):
+        # Model numbers over 99 must not collide with the first ones
+        protModeller = self._runModellerOptions(nModels=101)
+        pdbOuts = self._getOutputStructs(protModeller)
+        self.assertEqual(len(pdbOuts), 101)
+        self.assertIn('outputAtomStruct_101', pdbOuts)
+
+    def test_multiChain(self):
+        # Each template chain is aligned by the header of its own fasta file
+        protModeller = self._runModellerOptions(multiChain=True, inputSequences=self.protImportSeqSet.outputSequences,
+                                                templateList=self.multiTemplatesStr)
+        self.assertIsNotNone(getattr(protModeller, 'outputAtomStruct_1', None))
+
+    def test_batchTargets(self):
+        # Two targets with two models each, whose restraints are built once per target
+        protModeller = self._runModellerOptions(batchMode=True, nModels=2,
+                                                inputBatchSequences=self.protImportSeqSet.outputSequences)
+        outSet = getattr(protModeller, 'outputAtomStructs', None)
+        self.assertIsNotNone(outSet)
+        self.assertEqual(outSet.getSize(), 4)
+
+        targetIds = [seqObj.getId() for seqObj in self.protImportSeqSet.outputSequences]
+        outModels = {(outAS._targetId.get(), outAS._modelIdx.get()): os.path.basename(outAS.getFileName())
+                     for outAS in outSet}
+        self.assertEqual(outModels, {(targetId, modelIdx): '{}_model_{}.pdb'.format(targetId, modelIdx)
+                                     for targetId in targetIds for modelIdx in [1, 2]})
 
+        for targetId in targetIds:
+            restraintsDir = protModeller.getBatchRestraintsDir(targetId)
+            self.assertEqual(len([file for file in os.listdir(restraintsDir) if file.endswith('.rsr')]), 1)
+            for modelIdx in [1, 2]:
+                taskDir = protModeller.getBatchTaskDir(targetId, modelIdx)
+                self.assertFalse([file for file in os.listdir(taskDir) if file.endswith('.rsr')])
 
+    def test_warmWorker(self):
+        # The models built by the warm worker of the batch steps are the same a fresh modeller process builds
+        protModeller = self._runModellerOptions(batchMode=True, nModels=1,
+                                                inputBatchSequences=self.protImportSeqSet.outputSequences)
+        targetId = self.protImportSeqSet.outputSequences.getFirstItem().getId()
+        freshDir = os.path.abspath(self.proj.getTmpPath('fresh_{}'.format(targetId)))
+        os.makedirs(freshDir, exist_ok=True)
+        args = protModeller._getModellerArgs(targetId, 1) + ['-rs', protModeller.getBatchRestraintsDir(targetId)]
+        args[args.index('-pg') + 1] = os.path.join(freshDir, 'progress.jsonl')
+        Plugin.runScript(self, 'comparative_modelling.py', args=args, envDic=MODELLER_DIC, cwd=freshDir, popen=True)
 
+        freshFile = [file for file in os.listdir(freshDir) if MODEL_FILE_RE.search(file)][0]
+        warmFile = protModeller._getPath('{}_model_1{}'.format(targetId, protModeller.getOutputExtension()))
+        with open(os.path.join(freshDir, freshFile)) as fFresh, open(warmFile) as fWarm:
+            self.assertEqual([line for line in fFresh if line.startswith('ATOM')],
+                             [line for line in fWarm if line.startswith('ATOM')])
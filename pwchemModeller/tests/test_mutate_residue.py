@@ -24,10 +24,13 @@
 # *
 # **************************************************************************
 
+import os, time, json, subprocess
+
 from pyworkflow.tests import BaseTest, setupTestProject, DataSet
 from pwem.protocols import ProtImportPdb
+from pwchemModeller import Plugin
 from ..protocols import ModellerMutateResidue
-from ..constants import AA_LIST
+from ..constants import AA_LIST, MODELLER_DIC
 
 textMutationListExample = '{"model": 0, "chain": "A", "residues": 141} | {"index": "1-1", "residues": "V"} | TRP\n\
 {"model": 0, "chain": "B", "residues": 146} | {"index": "2-2", "residues": "H"} | PRO\n'
@@ -62,9 +65,66 @@ class TestModellerMutateRes(BaseTest):
         pdbOut = getattr(protModeller, 'mutatedAtomStruct', None)
         self.assertIsNotNone(pdbOut)
 
+    def _runModellerStore(self):
+        protModeller = self.newProtocol(
+            ModellerMutateResidue,
+            inputAtomStruct=self.protImportPDB.outputPdb,
+            toMutateList=textMutationListExample, useResultStore=True)
+
+        self.launchProtocol(protModeller)
+        return protModeller
+
+    def _getEntryFiles(self, protModeller):
+        """ Entry files in the result store of the mutations of a protocol """
+        store = protModeller.getResultStore()
+        chains, respos, restypes = protModeller.parseMutations()
+        entryFiles = []
+        for mutIdx, mutation in enumerate(zip(chains, respos, restypes)):
+            key = protModeller.getMutationKey(protModeller._getModellerArgs(mutIdx, mutation), mutation)
+            entryFiles.append(os.path.join(store.getEntryDir(key), 'entry.json'))
+        return entryFiles
+
     def test_mutateResidue(self):
         self._runModellerMutate()
 
+    def test_resultStore(self):
+        # The second run with identical inputs restores the mutants from the store, marking its entries as used
+        protModeller1 = self._runModellerStore()
+        entryFiles = self._getEntryFiles(protModeller1)
+        self.assertTrue(all([os.path.exists(entryFile) for entryFile in entryFiles]))
+        mTimes = [os.path.getmtime(entryFile) for entryFile in entryFiles]
+
+        time.sleep(1)
+        protModeller2 = self._runModellerStore()
+        self.assertEqual(self._getEntryFiles(protModeller2), entryFiles)
+        self.assertTrue(all([os.path.getmtime(entryFile) > mTime for entryFile, mTime in zip(entryFiles, mTimes)]))
+        with open(protModeller1.mutatedAtomStruct.getFileName()) as f1, \
+                open(protModeller2.mutatedAtomStruct.getFileName()) as f2:
+            self.assertEqual(f1.read(), f2.read())
 
+    def test_batchDriver(self):
+        # Headless batch of two mutations and a job with a wrong argument, run by two warm workers
+        pdbFile = os.path.abspath(self.protImportPDB.outputPdb.getFileName())
+        batchDir = os.path.abspath(self.proj.getTmpPath('batch'))
+        os.makedirs(batchDir, exist_ok=True)
+        mutations = {'mutB2': ('B', '2', 'PRO'), 'mutA1': ('A', '1', 'TRP')}
+        jobs = [{'name': name, 'type': 'mutation',
+                 'args': {'inputFilename': pdbFile, 'chain': chain, 'position': position, 'newResidue': newRes,
+                          'outputFile': os.path.join(batchDir, name + '.pdb')}}
+                for name, (chain, position, newRes) in mutations.items()]
+        jobs.append({'name': 'wrong', 'type': 'mutation', 'args': {'wrongArg': 1}})
+        manifestFile = os.path.join(batchDir, 'jobs.json')
+        with open(manifestFile, 'w') as f:
+            json.dump({'nJobs': 2, 'jobs': jobs}, f)
 
+        # The driver exits with an error if any job failed
+        with self.assertRaises(subprocess.CalledProcessError):
+            Plugin.runScript(self, 'batch_modeller.py', args=[manifestFile], envDic=MODELLER_DIC, popen=True)
 
+        with open(os.path.join(batchDir, 'results.json')) as f:
+            results = {res['name']: res for res in json.load(f)['results']}
+        self.assertEqual({name: res['status'] for name, res in results.items()},
+                         {'mutB2': 'ok', 'mutA1': 'ok', 'wrong': 'failed'})
+        for name in mutations:
+            self.assertEqual(results[name]['outputs'], [os.path.join(batchDir, name + '.pdb')])
+            self.assertTrue(os.path.exists(results[name]['outputs'][0]))
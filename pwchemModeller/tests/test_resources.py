@@ -0,0 +1,90 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+
+from ..utils.utilsResources import MB, getNumberOfWorkers, estimateWorkerMemory, MemoryEstimator
+
+class TestWorkerSizing(BaseTest):
+    def test_limitedByModels(self):
+        nWorkers, reasons = getNumberOfWorkers(3, 8, 500 * MB, nCores=16, availMemory=64000 * MB)
+        self.assertEqual(nWorkers, 3)
+        self.assertEqual(reasons[0], '3 workers: limited by models to build')
+
+    def test_limitedByCores(self):
+        nWorkers, reasons = getNumberOfWorkers(20, 8, 500 * MB, nCores=4, availMemory=64000 * MB)
+        self.assertEqual(nWorkers, 4)
+        self.assertIn('available cores', reasons[0])
+
+    def test_limitedByMemory(self):
+        nWorkers, reasons = getNumberOfWorkers(20, 8, 1000 * MB, nCores=16, availMemory=2500 * MB)
+        self.assertEqual(nWorkers, 2)
+        self.assertIn('2500 MB available / 1000 MB estimated per worker', reasons[0])
+
+        # At least one worker, even if it does not fit in memory
+        self.assertEqual(getNumberOfWorkers(20, 8, 4000 * MB, nCores=16, availMemory=1000 * MB)[0], 1)
+
+    def test_estimateWorkerMemory(self):
+        base = estimateWorkerMemory(300)
+        self.assertGreater(estimateWorkerMemory(300, nTemplates=4), base)
+        self.assertGreater(estimateWorkerMemory(300, modelH=True), base)
+        self.assertGreater(estimateWorkerMemory(600), base)
+        # Symmetry restraints grow with the squared atoms per chain
+        symCA = estimateWorkerMemory(600, nChains=2, nSymPairs=1) - estimateWorkerMemory(600, nChains=2)
+        symAll = estimateWorkerMemory(600, nChains=2, nSymPairs=1, symAtom='ALL') - estimateWorkerMemory(600, nChains=2)
+        self.assertAlmostEqual(symAll / symCA, 64)
+
+class TestMemoryEstimator(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def test_noRecords(self):
+        estimator = MemoryEstimator()
+        self.assertEqual(estimator.factor, 1.0)
+        self.assertAlmostEqual(estimator.estimate(nResidues=300), estimateWorkerMemory(300) * estimator.safetyMargin)
+        # Without records file, adding a record does nothing
+        estimator.addRecord({'nResidues': 300}, 10 ** 9)
+        self.assertEqual(estimator.getRecords(), [])
+
+    def test_calibration(self):
+        recordsFile = self.getOutputPath('records.jsonl')
+        estimator = MemoryEstimator(recordsFile)
+        features = [{'nResidues': 200}, {'nResidues': 400, 'nTemplates': 3}, {'nResidues': 800, 'modelH': True}]
+        for feats in features:
+            self.assertEqual(estimator.factor, 1.0)
+            estimator.addRecord(feats, 2 * estimateWorkerMemory(**feats))
+        self.assertEqual(len(estimator.getRecords()), 3)
+        self.assertAlmostEqual(estimator.factor, 2.0)
+
+        # The records are read again by new estimators
+        self.assertAlmostEqual(MemoryEstimator(recordsFile).factor, 2.0)
+        # Reading a missing records file does not create it
+        self.assertEqual(MemoryEstimator(self.getOutputPath('other.jsonl')).factor, 1.0)
+        self.assertFalse(os.path.exists(self.getOutputPath('other.jsonl')))
@@ -0,0 +1,87 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+from unittest.mock import patch
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+
+from ..utils.utilsScratch import ScratchDir, getScratchBaseDir, KEEP_NEVER, KEEP_ON_FAILURE, KEEP_ALWAYS
+
+
+def isResult(fileName):
+    return fileName.endswith('.pdb')
+
+
+class TestScratchDir(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        cls.baseDir = cls.getOutputPath('scratch')
+
+    def _runJob(self, name, retention, fail=False):
+        """ Writes a result, an intermediate file and an intermediate directory in a scratch directory """
+        outDir, keepDir = self.getOutputPath(name, 'out'), self.getOutputPath(name, 'keep')
+        with ScratchDir(self.baseDir, outDir, isResult, keepDir, retention) as scratch:
+            self.assertEqual(os.path.dirname(scratch.path), self.baseDir)
+            for fileName in ['model.pdb', 'target.rsr', os.path.join('tmp', 'target.ini')]:
+                os.makedirs(os.path.dirname(os.path.join(scratch.path, fileName)), exist_ok=True)
+                with open(os.path.join(scratch.path, fileName), 'w') as f:
+                    f.write(fileName)
+            if fail:
+                raise RuntimeError('modeller failed')
+        return scratch, outDir, keepDir
+
+    def test_keepNever(self):
+        scratch, outDir, keepDir = self._runJob('never', KEEP_NEVER)
+        self.assertEqual(os.listdir(outDir), ['model.pdb'])
+        self.assertFalse(os.path.exists(keepDir))
+        self.assertFalse(os.path.exists(scratch.path))
+
+    def test_keepOnFailure(self):
+        scratch, outDir, keepDir = self._runJob('success', KEEP_ON_FAILURE)
+        self.assertFalse(os.path.exists(keepDir))
+
+        with self.assertRaises(RuntimeError):
+            self._runJob('failure', KEEP_ON_FAILURE, fail=True)
+        outDir, keepDir = self.getOutputPath('failure', 'out'), self.getOutputPath('failure', 'keep')
+        # The results produced before the failure are staged too
+        self.assertEqual(os.listdir(outDir), ['model.pdb'])
+        self.assertEqual(sorted(os.listdir(keepDir)), ['target.rsr', 'tmp'])
+        self.assertTrue(os.path.exists(os.path.join(keepDir, 'tmp', 'target.ini')))
+        self.assertEqual(os.listdir(self.baseDir), [])
+
+    def test_keepAlways(self):
+        scratch, outDir, keepDir = self._runJob('always', KEEP_ALWAYS)
+        self.assertEqual(os.listdir(outDir), ['model.pdb'])
+        self.assertEqual(sorted(os.listdir(keepDir)), ['target.rsr', 'tmp'])
+        self.assertFalse(os.path.exists(scratch.path))
+
+    def test_getScratchBaseDir(self):
+        self.assertEqual(getScratchBaseDir('/scratch/user'), '/scratch/user')
+        with patch.dict(os.environ, {'TMPDIR': self.baseDir}):
+            self.assertEqual(getScratchBaseDir(), self.baseDir)
@@ -0,0 +1,130 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import numpy as np
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+
+from ..utils.utilsSymmetry import parseSymmetryGroups, getSymmetryPairs, parseResidueRanges, REFERENCE, RING, \
+    ALL_PAIRS, kabsch, buildSymmetricOligomer, getInterfaceResidues, getAssemblyChains, getLongChainIds
+from ..utils.utilsTemplates import readStructure, writeStructure
+from .synthetic import writeSyntheticPDB, getHelixCoords
+
+SEQ = 'MKTAYIAKQRQISFVKSHFSRQLEERLGLIEVQAP'
+
+
+def getRotationZ(angle):
+    cos, sin = np.cos(np.radians(angle)), np.sin(np.radians(angle))
+    return np.array([[cos, -sin, 0], [sin, cos, 0], [0, 0, 1]])
+
+
+def getCACoords(chain):
+    return np.array([res['CA'].get_coord() for res in chain], dtype=np.float64)
+
+class TestSymmetryRestraints(BaseTest):
+    def test_parseSymmetryGroups(self):
+        self.assertEqual(parseSymmetryGroups('A,B,C,D;E, F'), [['A', 'B', 'C', 'D'], ['E', 'F']])
+        self.assertEqual(parseSymmetryGroups(' A , B ;; '), [['A', 'B']])
+        self.assertEqual(parseSymmetryGroups(''), [])
+
+    def test_getSymmetryPairs(self):
+        groups = [['A', 'B', 'C', 'D'], ['E', 'F']]
+        self.assertEqual(getSymmetryPairs(groups, REFERENCE), [('A', 'B'), ('A', 'C'), ('A', 'D'), ('E', 'F')])
+        self.assertEqual(getSymmetryPairs(groups, RING),
+                         [('A', 'B'), ('B', 'C'), ('C', 'D'), ('D', 'A'), ('E', 'F')])
+        self.assertEqual(len(getSymmetryPairs(groups, ALL_PAIRS)), 6 + 1)
+
+        # Number of restraint pairs of a 24-mer for each topology
+        chains = [[chr(ord('A') + i) for i in range(24)]]
+        self.assertEqual([len(getSymmetryPairs(chains, topology)) for topology in [REFERENCE, RING, ALL_PAIRS]],
+                         [23, 24, 276])
+
+    def test_parseResidueRanges(self):
+        self.assertEqual(parseResidueRanges('10-120, 150-200'), [(10, 120), (150, 200)])
+        self.assertEqual(parseResidueRanges(''), [])
+
+
+class TestProtomerSymmetry(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        # C3 template: the helix of chain A rotated 120 and 240 degrees around the z axis
+        protCoords = getHelixCoords(len(SEQ), shift=(12.0, 0.0, 0.0))
+        cls.templCoords = {chain: protCoords @ getRotationZ(angle).T
+                           for chain, angle in zip('ABC', [0, 120, 240])}
+        cls.templateFile = writeSyntheticPDB(cls.getOutputPath('template.pdb'), {chain: SEQ for chain in 'ABC'},
+                                             coordsDic=cls.templCoords)
+
+    def test_kabsch(self):
+        mobile = getHelixCoords(20, noise=0.3)
+        rot = getRotationZ(70) @ np.array([[1, 0, 0], [0, 0, -1], [0, 1, 0]])
+        rotFit, trans = kabsch(mobile, mobile @ rot.T + (5.0, -2.0, 1.0))
+        self.assertTrue(np.allclose(rotFit, rot))
+        self.assertTrue(np.allclose(trans, (5.0, -2.0, 1.0)))
+
+    def test_buildSymmetricOligomer(self):
+        # Protomer model in another frame, missing its first residues
+        protCoords = getHelixCoords(len(SEQ))[3:] @ getRotationZ(50).T + (-30.0, 4.0, 8.0)
+        protomerFile = writeSyntheticPDB(self.getOutputPath('protomer.pdb'), {'X': SEQ[3:]}, firstIdx=4,
+                                         coordsDic={'X': protCoords})
+
+        outFile = self.getOutputPath('oligomer.pdb')
+        oligomer = buildSymmetricOligomer(protomerFile, self.templateFile, outFile=outFile)
+        model = readStructure(outFile).child_list[0]
+        self.assertEqual([chain.id for chain in model], ['A', 'B', 'C'])
+        for chain in model:
+            self.assertTrue(np.allclose(getCACoords(chain), self.templCoords[chain.id][3:], atol=1e-2))
+        self.assertEqual(len(list(oligomer.get_residues())), 3 * (len(SEQ) - 3))
+
+        # Only the selected template chains are used
+        oligomer = buildSymmetricOligomer(protomerFile, self.templateFile, chains=['B', 'C'])
+        self.assertEqual([chain.id for chain in oligomer.child_list[0]], ['B', 'C'])
+
+    def test_longChainIds(self):
+        # Assemblies with chain ids longer than one character are written as mmCIF
+        template = readStructure(self.templateFile)
+        for chain in list(template.child_list[0]):
+            chain.id = chain.id * 2
+        cifTemplate = writeStructure(template, self.getOutputPath('template_long.cif'))
+        self.assertEqual(getAssemblyChains(cifTemplate), ['AA', 'BB', 'CC'])
+        self.assertEqual(getLongChainIds(['A', 'BB', 'c']), ['BB'])
+
+        protomerFile = writeSyntheticPDB(self.getOutputPath('protomer_long.pdb'), {'X': SEQ})
+        outFile = self.getOutputPath('oligomer_long.cif')
+        buildSymmetricOligomer(protomerFile, cifTemplate, outFile=outFile)
+        self.assertEqual([chain.id for chain in readStructure(outFile).child_list[0]], ['AA', 'BB', 'CC'])
+        with self.assertRaises(ValueError):
+            buildSymmetricOligomer(protomerFile, cifTemplate, chains=['AA', 'BB'],
+                                   outFile=self.getOutputPath('oligomer_long.pdb'))
+
+    def test_getInterfaceResidues(self):
+        coords = getHelixCoords(len(SEQ))
+        pdbFile = writeSyntheticPDB(self.getOutputPath('dimer.pdb'), {'A': SEQ, 'B': SEQ},
+                                    coordsDic={'A': coords, 'B': coords + (8.0, 0.0, 0.0)})
+        interface = getInterfaceResidues(readStructure(pdbFile))
+        self.assertEqual(sorted(set([chain for _, chain in interface])), ['A', 'B'])
+        self.assertEqual(getInterfaceResidues(readStructure(self.templateFile)), [])
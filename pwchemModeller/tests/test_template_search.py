@@ -0,0 +1,143 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os, time
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+
+from ..utils.utilsSearch import TemplateIndex, locateHit, resolveHit, getTemplateKeys, getHitKeys
+from .synthetic import writeSyntheticPDB
+
+SEQ_A = 'MKTAYIAKQRQISFVKSHFSRQLEERLGLIEVQAPILSRVGDGTQDNLSGAEKAVQV'
+SEQ_B = 'GSHMLEDPVDAFQEWMKLLTNPRWVEKYGQDLLPNAIRHLAEEQKW'
+SEQ_C = 'MVLSPADKTNVKAAWGKVGAHAGEYGAEALERMFLSFPTTKTYFPHF'
+# First residues of the alpha chain (A) of 1a00
+SEQ_1A00_A = 'VLSPADKTNVKAAWGKVGAHAGEYGAEALERMFLSFPTTKTYFPHF'
+
+class TestTemplateSearch(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def _getDir(self, name):
+        outDir = self.getOutputPath(name)
+        os.makedirs(outDir, exist_ok=True)
+        return outDir
+
+    def _writeStructures(self, structDir):
+        writeSyntheticPDB(os.path.join(structDir, '1abc.pdb'), {'A': SEQ_A, 'B': SEQ_B})
+        writeSyntheticPDB(os.path.join(structDir, '2def.pdb.gz'), {'A': SEQ_C})
+
+    def test_searchIndex(self):
+        structDir = self._getDir('searchStructs')
+        self._writeStructures(structDir)
+        index = TemplateIndex(self._getDir('searchIndex'))
+        self.assertEqual(index.update(structDir), (2, 0, {}))
+        self.assertEqual(len(index), 3)
+
+        hit = index.search(SEQ_A)[0]
+        self.assertEqual((hit['code'], hit['chain'], hit['seqres']), ('1abc', 'A', False))
+        self.assertEqual((hit['first'], hit['last'], hit['identity']), (1, len(SEQ_A), 1.0))
+        self.assertEqual(index.search(SEQ_C[5:])[0]['code'], '2def')
+
+    def test_updateIndex(self):
+        structDir, indexDir = self._getDir('updateStructs'), self._getDir('updateIndex')
+        self._writeStructures(structDir)
+        index = TemplateIndex(indexDir)
+        index.update(structDir)
+        index.write()
+        self.assertEqual(index.update(structDir), (0, 0, {}))
+
+        # Modified files are parsed again and their old chains removed
+        time.sleep(0.01)
+        writeSyntheticPDB(os.path.join(structDir, '1abc.pdb'), {'B': SEQ_B})
+        self.assertEqual(index.update(structDir), (1, 1, {}))
+        self.assertEqual(len(index), 2)
+        self.assertEqual(index.search(SEQ_A), [])
+
+        index.write()
+        loaded = TemplateIndex(indexDir)
+        self.assertEqual(len(loaded), 2)
+        self.assertEqual(loaded.search(SEQ_B)[0]['code'], '1abc')
+
+    def test_seqresHit(self):
+        seqresFile = self.getOutputPath('pdb_seqres.txt')
+        with open(seqresFile, 'w') as f:
+            f.write('>1ABC_A mol:protein length:{}  TEST\nMGSS{}\n'.format(len(SEQ_A) + 4, SEQ_A))
+            f.write('>1ABC_C mol:na length:10  DNA\nACGTACGTAC\n')
+        index = TemplateIndex(self._getDir('seqresIndex'))
+        index.update(seqresFile)
+        hit = index.search(SEQ_A)[0]
+        self.assertEqual((hit['code'], hit['chain'], hit['seqres'], hit['first']), ('1abc', 'A', True, 5))
+
+        # The mirror structure is numbered from 10 and only has the resolved residues
+        mirrorDir = self._getDir('mirror')
+        os.makedirs(os.path.join(mirrorDir, 'ab'))
+        mirrorFile = writeSyntheticPDB(os.path.join(mirrorDir, 'ab', 'pdb1abc.ent.gz'), {'A': SEQ_A[2:]}, firstIdx=10)
+        located, useFile = resolveHit(hit, mirrorDir)
+        self.assertTrue(useFile)
+        self.assertEqual((located['source'], located['seqres']), (mirrorFile, False))
+        self.assertEqual((located['first'], located['last']), (10, 10 + len(SEQ_A) - 3))
+        self.assertEqual(located['sequence'], SEQ_A[2:])
+        self.assertIsNone(locateHit(dict(hit, chain='B'), mirrorFile))
+
+    def test_locateHitCAGap(self):
+        # A residue without C-alpha and a non-standard residue are kept, so the range maps back exactly
+        structFile = writeSyntheticPDB(self.getOutputPath('1gap.pdb'), {'A': SEQ_A}, firstIdx=10)
+        with open(structFile) as f:
+            lines = [line for line in f if not (line[12:16].strip() == 'CA' and int(line[22:26]) == 20)]
+        lines = [line[:17] + 'UNK' + line[20:] if line.startswith('ATOM') and int(line[22:26]) == 30 else line
+                 for line in lines]
+        with open(structFile, 'w') as f:
+            f.write(''.join(lines))
+
+        hit = {'code': '1gap', 'chain': 'A', 'seqres': True, 'sequence': SEQ_A}
+        located = locateHit(hit, structFile)
+        self.assertEqual((located['first'], located['last']), (10, 10 + len(SEQ_A) - 1))
+        self.assertEqual(located['sequence'], SEQ_A[:20] + 'X' + SEQ_A[21:])
+
+    def test_downloadHit(self):
+        hit = {'code': '1a00', 'chain': 'A', 'seqres': True, 'sequence': SEQ_1A00_A}
+        downloadDir = self._getDir('download')
+        located, useFile = resolveHit(hit, mirrorDir=None, downloadDir=downloadDir)
+        self.assertFalse(useFile)
+        self.assertEqual(os.path.dirname(os.path.abspath(located['source'])), os.path.abspath(downloadDir))
+        self.assertEqual((located['chain'], located['first'], located['last']), ('A', 1, len(SEQ_1A00_A)))
+
+    def test_templateKeys(self):
+        templateList = '1) {"pdbName": "1ABC", "chain": "A", "index": "1-50", "seqFile": "1abc.fa"}\n' \
+                       '2) {"pdbName": "pdb2def", "chain": "B", "index": "1-40", "seqFile": "2def.fa", ' \
+                       '"pdbFile": "/mirror/de/pdb2def.ent.gz"}\n' \
+                       '3) {"pdbName": "1a00", "chains": "0-A, 0-B", "index": "FIRST-LAST", "seqFile": "1a00.fa"}\n'
+        keys = getTemplateKeys(templateList)
+        self.assertEqual(keys, {('1abc', 'A'), ('2def', 'B'), ('1a00', 'A'), ('1a00', 'B')})
+
+        self.assertTrue(getHitKeys({'code': '1abc', 'chain': 'a', 'seqres': True, 'source': 'seqres.txt'}) & keys)
+        self.assertTrue(getHitKeys({'code': 'x', 'chain': 'B', 'seqres': False,
+                                    'source': '/other/2DEF.cif'}) & keys)
+        self.assertTrue(getHitKeys({'code': '1a00', 'chain': 'B', 'seqres': False, 'source': '1a00.cif'}) & keys)
+        self.assertFalse(getHitKeys({'code': '1a00', 'chain': 'C', 'seqres': False, 'source': '1a00.cif'}) & keys)
@@ -0,0 +1,187 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os, gzip, importlib.util
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+
+from ..utils.utilsTemplates import TemplateEntry, TemplateManifest, prepareTemplate, prepareTemplates, \
+    readStructure, getFileHash, findInMirror, copyDecompressed
+from .synthetic import writeSyntheticPDB, writeFastaFile
+
+SEQ_A, SEQ_B = 'MKTAYIAKQRQISFVK', 'GSHMLEDPVDAFQ'
+
+class TestTemplateManifest(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        cls.structFile = writeSyntheticPDB(cls.getOutputPath('1xyz.pdb'), {'A': SEQ_A, 'B': SEQ_B})
+        cls.seqFile = writeFastaFile(cls.getOutputPath('1abc_1_A_2-9.fa'), {'1abc_A': SEQ_A[1:9]})
+        # Fasta files of a multi-chain template, as written by the template wizard
+        cls.multiSeqFiles = [writeFastaFile(cls.getOutputPath('1xyz_2_{}_1-{}.fa'.format(chain, len(seq))),
+                                            {'1xyz_{}'.format(chain): seq})
+                             for chain, seq in [('A', SEQ_A), ('B', SEQ_B)]]
+        cls.templateList = \
+            '1) {"pdbName": "1abc", "chain": "A", "index": "2-9", "seqFile": "%s"}\n' % cls.seqFile + \
+            '2) {"pdbName": "1xyz", "chains": "0-A, 0-B", "seqFiles": "%s", "pdbFile": "%s"}\n' % \
+            (cls.getOutputPath('1xyz_2_*_*.fa'), cls.structFile)
+
+    def test_fromTemplateList(self):
+        manifest = TemplateManifest.fromTemplateList(self.templateList)
+        self.assertEqual(manifest.getCodes(), ['1abc', '1xyz'])
+        single, multi = manifest
+        self.assertEqual((single.chains, single.ranges, single.multiChain), (['A'], [['2', '9']], False))
+        self.assertEqual(single.structHash, '')
+        self.assertEqual((multi.chains, multi.ranges, multi.multiChain),
+                         (['A', 'B'], [['1', str(len(SEQ_A))], ['1', str(len(SEQ_B))]], True))
+        self.assertEqual(multi.seqFiles, self.multiSeqFiles)
+        self.assertEqual(multi.structHash, getFileHash(self.structFile))
+
+    def test_writeLoad(self):
+        manifest = TemplateManifest.fromTemplateList(self.templateList)
+        loaded = TemplateManifest.load(manifest.write(self.getOutputPath('manifest.json')))
+        self.assertEqual([entry.toDict() for entry in loaded], [entry.toDict() for entry in manifest])
+        self.assertEqual(loaded.getKey(), manifest.getKey())
+        self.assertEqual(loaded.getEntry('1xyz').chains, ['A', 'B'])
+        self.assertIsNone(loaded.getEntry('2def'))
+
+    def test_getKey(self):
+        manifest = TemplateManifest.fromTemplateList(self.templateList)
+        otherRange = TemplateManifest.fromTemplateList(self.templateList.replace('"index": "2-9"', '"index": "2-8"'))
+        self.assertNotEqual(manifest.getKey(), otherRange.getKey())
+
+        # Same names, different contents
+        manifest[1].setStructFile(writeSyntheticPDB(self.getOutputPath('1xyz_moved.pdb'), {'A': SEQ_A, 'B': SEQ_B},
+                                                    firstIdx=5))
+        self.assertNotEqual(manifest.getKey(), TemplateManifest.fromTemplateList(self.templateList).getKey())
+
+class TestTemplatePreparation(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def _getEntry(self, structFile, chains=('A',), ranges=(('FIRST', 'LAST'),)):
+        seqFiles = [writeFastaFile(self.getOutputPath('1xyz_{}.fa'.format(chain)), {'1xyz_{}'.format(chain): SEQ_A})
+                    for chain in chains]
+        return TemplateEntry('1xyz', list(chains), [list(cRange) for cRange in ranges], seqFiles, structFile)
+
+    def _getOutDir(self, name):
+        outDir = self.getOutputPath(name)
+        os.makedirs(outDir, exist_ok=True)
+        return outDir
+
+    def test_prepareCompressedTemplate(self):
+        structFile = writeSyntheticPDB(self.getOutputPath('1XYZ.pdb.gz'), {'A': SEQ_A, 'B': SEQ_B}, resolution=2.1)
+        localFile = prepareTemplate(self._getEntry(structFile), self._getOutDir('compressed'))
+        self.assertEqual(os.path.basename(localFile), '1xyz.pdb')
+        self.assertEqual(len(list(readStructure(localFile).get_residues())), len(SEQ_A) + len(SEQ_B))
+
+    def test_trimTemplate(self):
+        structFile = writeSyntheticPDB(self.getOutputPath('1xyz_trim.pdb'), {'A': SEQ_A, 'B': SEQ_B}, resolution=2.1)
+        cacheDir = self._getOutDir('trimCache')
+        entry = self._getEntry(structFile, ranges=(('3', '10'),))
+        localFile = prepareTemplate(entry, self._getOutDir('trimmed'), trim=True, cacheDir=cacheDir)
+
+        chains = list(readStructure(localFile)[0])
+        self.assertEqual([chain.id for chain in chains], ['A'])
+        self.assertEqual([res.id[1] for res in chains[0]], list(range(3, 11)))
+        self.assertEqual(entry.resolution, 2.1)
+        self.assertEqual(len(os.listdir(cacheDir)), 1)
+        self.assertTrue(os.path.basename(localFile).startswith(entry.atomFile))
+
+    def test_prepareSharedTemplates(self):
+        structFile = writeSyntheticPDB(self.getOutputPath('1xyz_shared.pdb'), {'A': SEQ_A, 'B': SEQ_B}, resolution=2.1)
+        outDir = self._getOutDir('shared')
+        manifest = TemplateManifest([self._getEntry(structFile, chains=(chainId,)) for chainId in ['A', 'B']])
+        errors = prepareTemplates(manifest, outDir, nThreads=4, trim=True)
+
+        # The shared structure is acquired once, trimmed for each template and then removed
+        self.assertEqual(errors, {})
+        self.assertEqual(len({entry.structFile for entry in manifest}), 2)
+        self.assertNotIn('1xyz.pdb', os.listdir(outDir))
+        for entry, chainId in zip(manifest, ['A', 'B']):
+            self.assertEqual([chain.id for chain in readStructure(entry.structFile)[0]], [chainId])
+            self.assertEqual(entry.resolution, 2.1)
+
+    def test_scriptsFileHash(self):
+        # The modeller scripts cannot import the plugin and keep their own copy of getFileHash
+        scriptFile = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts',
+                                  'model_output.py')
+        spec = importlib.util.spec_from_file_location('model_output', scriptFile)
+        modelOutput = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(modelOutput)
+
+        structFile = writeSyntheticPDB(self.getOutputPath('1xyz_hash.pdb'), {'A': SEQ_A})
+        self.assertEqual(modelOutput.getFileHash(structFile), getFileHash(structFile))
+        self.assertEqual(modelOutput.getFileHash(structFile, blockSize=7), getFileHash(structFile))
+
+class TestTemplateMirror(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        # Divided layout of the PDB archive and flat directory
+        cls.mirrorDir = cls.getOutputPath('mirror')
+        os.makedirs(os.path.join(cls.mirrorDir, 'ab'))
+        cls.dividedFile = writeSyntheticPDB(os.path.join(cls.mirrorDir, 'ab', 'pdb1abc.ent.gz'), {'A': SEQ_A})
+        cls.flatFile = writeSyntheticPDB(os.path.join(cls.mirrorDir, '2DEF.pdb'), {'A': SEQ_B})
+
+    def _getEntry(self, code, structFile=''):
+        seqFile = writeFastaFile(self.getOutputPath('{}_A.fa'.format(code)), {'{}_A'.format(code): SEQ_A})
+        return TemplateEntry(code, ['A'], [['FIRST', 'LAST']], [seqFile], structFile)
+
+    def test_findInMirror(self):
+        self.assertEqual(findInMirror('1ABC', self.mirrorDir), self.dividedFile)
+        self.assertEqual(findInMirror('2def', self.mirrorDir), self.flatFile)
+        self.assertIsNone(findInMirror('3ghi', self.mirrorDir))
+        self.assertIsNone(findInMirror('1abc', None))
+
+    def test_copyDecompressed(self):
+        outDir = self.getOutputPath('copied')
+        os.makedirs(outDir)
+        outFile = copyDecompressed(self.dividedFile, outDir, '1abc')
+        self.assertEqual(outFile, os.path.join(outDir, '1abc.pdb'))
+        with gzip.open(self.dividedFile, 'rt') as fIn, open(outFile) as fOut:
+            self.assertEqual(fIn.read(), fOut.read())
+        self.assertEqual(copyDecompressed(self.flatFile, outDir, '2def'), os.path.join(outDir, '2def.pdb'))
+
+        # Upper-case extensions are normalised, so Modeller finds the files
+        upperFile = writeSyntheticPDB(self.getOutputPath('4JKL.PDB'), {'A': SEQ_A})
+        self.assertEqual(copyDecompressed(upperFile, outDir, '4jkl'), os.path.join(outDir, '4jkl.pdb'))
+        mixedFile = writeSyntheticPDB(self.getOutputPath('5mno.Pdb.gz'), {'A': SEQ_A})
+        self.assertEqual(copyDecompressed(mixedFile, outDir, '5mno'), os.path.join(outDir, '5mno.pdb'))
+
+    def test_prepareTemplates(self):
+        outDir = self.getOutputPath('prepared')
+        os.makedirs(outDir)
+        manifest = TemplateManifest([self._getEntry('1abc'), self._getEntry('2DEF'),
+                                     self._getEntry('3ghi', self.getOutputPath('missing', '3ghi.pdb'))])
+        errors = prepareTemplates(manifest, outDir, mirrorDir=self.mirrorDir, nThreads=3)
+
+        self.assertEqual(list(errors), ['3ghi'])
+        self.assertEqual(sorted(os.listdir(outDir)), ['1abc.pdb', '2def.pdb'])
+        self.assertEqual(manifest[0].structFile, os.path.join(outDir, '1abc.pdb'))
+        self.assertEqual(manifest[1].structHash, getFileHash(self.flatFile))
+        self.assertEqual(manifest[1].structFile, os.path.join(outDir, '2def.pdb'))
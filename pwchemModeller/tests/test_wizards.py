@@ -0,0 +1,64 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+
+from ..wizards import AddStructSequenceWizard
+from .synthetic import writeSyntheticPDB
+
+SEQ_A, SEQ_B = 'MKTAYIAKQRQISFVK', 'GSHMLEDPVDAFQ'
+
+class TestAddStructSequenceWizard(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        cls.wizard = AddStructSequenceWizard()
+        cls.pdbFile = writeSyntheticPDB(cls.getOutputPath('1xyz.pdb'), {'A': SEQ_A, 'B': SEQ_B})
+
+    def test_parseMultiPositions(self):
+        self.assertEqual(self.wizard.parseMultiPositions('1-30, 4-35', 3), [[1, 30], [4, 35], None])
+        self.assertEqual(self.wizard.parseMultiPositions(', 2-8', 2), [None, [2, 8]])
+        self.assertEqual(self.wizard.parseMultiPositions('', 2), [None, None])
+
+    def test_yieldChainsSequences(self):
+        posIdxs = self.wizard.parseMultiPositions('3-10, ', 2)
+        chainSeqs = list(self.wizard.yieldChainsSequences(self.pdbFile, ['0-A', '0-B'], posIdxs))
+        self.assertEqual(chainSeqs, [('A', SEQ_A[2:10], [3, 10]), ('B', SEQ_B, [1, len(SEQ_B)])])
+
+        chainSeqs = list(self.wizard.yieldChainsSequences(self.pdbFile, ['0-B']))
+        self.assertEqual(chainSeqs, [('B', SEQ_B, [1, len(SEQ_B)])])
+
+    def test_writeSequenceFiles(self):
+        seqFiles = {self.getOutputPath('1xyz_1_{}_1-5.fa'.format(chain)): '>1xyz_{}\n{}\n'.format(chain, seq[:5])
+                    for chain, seq in [('A', SEQ_A), ('B', SEQ_B)]}
+        self.wizard.writeSequenceFiles(seqFiles)
+        for seqFile, fastaStr in seqFiles.items():
+            with open(seqFile) as f:
+                self.assertEqual(f.read(), fastaStr)
+        self.assertEqual(len([file for file in os.listdir(self.getOutputPath()) if file.endswith('.fa')]), 2)
@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# Module to declare utils
+# **************************************************************************
+
+from .utilsTemplates import getFileHash, TemplateEntry, TemplateManifest, prepareTemplates, readStructure, \
+    writeStructure, rewritePIRAtomFiles
+from .utilsResources import getAvailableCores, getAvailableMemory, getTotalMemory, estimateWorkerMemory, \
+    getNumberOfWorkers, MemoryEstimator
+from .utilsClustering import loadCACoordinates, pairwiseRMSD, clusterByRMSD, collapseTemplates
+from .utilsAlignment import readFasta, writeFasta, removeGapColumns, getAddAlignmentCommand, AlignmentCache, \
+    Alignment, checkAlignmentTemplates
+from .utilsScratch import getScratchBaseDir, ScratchDir, RETENTION_POLICIES
+from .utilsSymmetry import SYM_TOPOLOGIES, parseSymmetryGroups, getSymmetryPairs, parseResidueRanges, \
+    buildSymmetricOligomer, getInterfaceResidues, getAssemblyChains, getLongChainIds
+from .utilsStore import normalizeArgs, ResultStore
+from .utilsSearch import TemplateIndex, locateHit, resolveHit, getTemplateKeys, getHitKeys
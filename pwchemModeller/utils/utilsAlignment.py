@@ -0,0 +1,391 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors: Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Utilities to handle sequence alignments as arrays (PIR, Clustal and FASTA formats), to reuse the alignments of
+previous runs, adding only the new sequences to them, and to check PIR alignments against their template structures.
+"""
+
+import os, re, json, hashlib
+import numpy as np
+from Bio.SeqUtils import seq1
+
+from .utilsTemplates import readStructure
+
+ALIGNMENT_CACHE_VERSION = 1
+FULL, SUBSET, ADD = 'full', 'subset', 'add'
+
+
+def readFasta(fastaFile):
+    """ Returns an ordered dictionary {seqName: sequence} from a fasta file (name: first word of the header) """
+    seqDic, name = {}, None
+    with open(fastaFile) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('>'):
+                name = line[1:].split()[0] if line[1:].strip() else ''
+                seqDic[name] = ''
+            elif line and name is not None:
+                seqDic[name] += line
+    return seqDic
+
+
+def writeFasta(seqDic, fastaFile):
+    with open(fastaFile, 'w') as f:
+        for name, seq in seqDic.items():
+            f.write('>{}\n{}\n'.format(name, seq))
+
+
+def removeGapColumns(alignment):
+    """ Returns the alignment without the columns that are gaps in every sequence """
+    if not len(alignment):
+        return alignment
+    return alignment.subset(alignment.names)
+
+
+def getAddAlignmentCommand(programName, profileFile, newSeqsFile, outFile):
+    """ Program and args to add the sequences of newSeqsFile to the alignment in profileFile, writing a fasta
+    alignment to outFile. None if the program cannot add sequences to an existing alignment """
+    if programName.lower().startswith('mafft'):
+        return 'mafft', '--add {} {} > {}'.format(newSeqsFile, profileFile, outFile)
+    elif programName.lower().startswith('clustal'):
+        return 'clustalo', '-i {} --profile1 {} -o {} --outfmt=fa --force'.format(newSeqsFile, profileFile, outFile)
+
+
+class AlignmentCache:
+    """ Alignments of previous runs, stored as json files in cacheDir. Each alignment is keyed by the aligning
+    program, its settings and the target sequence, and stores the raw and the aligned sequences it contains """
+    def __init__(self, cacheDir):
+        self.cacheDir = cacheDir
+
+    @staticmethod
+    def getKey(programName, settings, targetSeq):
+        return hashlib.sha256(json.dumps([programName, settings, targetSeq]).encode()).hexdigest()
+
+    def getFile(self, key):
+        return os.path.join(self.cacheDir, '{}.json'.format(key))
+
+    def load(self, key):
+        if self.cacheDir and os.path.exists(self.getFile(key)):
+            with open(self.getFile(key)) as f:
+                cached = json.load(f)
+            if cached.get('version') == ALIGNMENT_CACHE_VERSION:
+                cached['alignment'] = Alignment.fromDict(cached['alignment'])
+                return cached
+
+    def save(self, key, seqDic, alignment):
+        if self.cacheDir:
+            tmpFile = '{}.{}.tmp'.format(self.getFile(key), os.getpid())
+            with open(tmpFile, 'w') as f:
+                json.dump({'version': ALIGNMENT_CACHE_VERSION, 'sequences': seqDic, 'alignment': alignment.toDict()},
+                          f)
+            os.replace(tmpFile, self.getFile(key))
+
+    @staticmethod
+    def getUpdateMode(cached, seqDic):
+        """ Returns how the alignment of seqDic can be obtained from the cached one and the sequences to add:
+        FULL (realign everything), SUBSET (all the sequences are already aligned) or ADD (add the new ones) """
+        if not cached:
+            return FULL, []
+        cachedSeqs = cached['sequences']
+        if any([name in cachedSeqs and cachedSeqs[name] != seq for name, seq in seqDic.items()]):
+            return FULL, []
+        newNames = [name for name in seqDic if name not in cachedSeqs]
+        return (ADD, newNames) if newNames else (SUBSET, [])
+
+
+GAP_CHARS, CHAIN_BREAK = b'-.', b'/'
+ALIGNMENT_FORMATS = {'.pir': 'pir', '.ali': 'pir', '.aln': 'clustal', '.clu': 'clustal',
+                     '.fa': 'fasta', '.fasta': 'fasta', '.fas': 'fasta'}
+
+
+class Alignment:
+    """ Alignment of several sequences stored as a (nSeqs, nColumns) array of single characters, with the gap masks
+    and the column <-> residue index maps of every sequence precomputed. Chain breaks ('/') are aligned columns that
+    are neither gaps nor residues. PIR description lines are kept in headers ({name: 'structureX:...'}) """
+    def __init__(self, names, seqs, headers=None):
+        self.names = list(names)
+        self.headers = dict(headers) if headers else {}
+        seqs = [seq.encode('ascii') if isinstance(seq, str) else seq for seq in seqs]
+        if len(set([len(seq) for seq in seqs])) > 1:
+            lengths = ['{} ({})'.format(name, len(seq)) for name, seq in zip(self.names, seqs)]
+            raise ValueError('The aligned sequences have different lengths: {}'.format(', '.join(lengths)))
+        nCols = len(seqs[0]) if seqs else 0
+        self.residues = np.frombuffer(b''.join(seqs), dtype='S1').reshape(len(seqs), nCols)
+
+        self.gapMask = np.isin(self.residues, np.frombuffer(GAP_CHARS, dtype='S1'))
+        self.breakMask = self.residues == CHAIN_BREAK
+        self.residueMask = ~(self.gapMask | self.breakMask)
+        # Index of the residue of each column (-1 for gaps and chain breaks) and column of each residue
+        self.colToRes = np.where(self.residueMask, np.cumsum(self.residueMask, axis=1) - 1, -1)
+        self.resToCol = [np.flatnonzero(mask) for mask in self.residueMask]
+        self._rows = {name: i for i, name in enumerate(self.names)}
+
+    @classmethod
+    def fromDict(cls, alnDic, headers=None):
+        return cls(list(alnDic.keys()), list(alnDic.values()), headers)
+
+    def toDict(self):
+        return {name: self.getSequence(name) for name in self.names}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self._rows
+
+    def getNumberOfColumns(self):
+        return self.residues.shape[1]
+
+    def getRow(self, name):
+        return self._rows[name]
+
+    def getSequence(self, name, gapped=True):
+        row = self.residues[self.getRow(name)]
+        return (row if gapped else row[self.residueMask[self.getRow(name)]]).tobytes().decode()
+
+    def getColumnsToResidues(self, name, firstResidue=0):
+        """ Residue number of each column for the sequence (-1 for gaps), starting from firstResidue """
+        colToRes = self.colToRes[self.getRow(name)]
+        return np.where(colToRes >= 0, colToRes + firstResidue, -1)
+
+    def getResiduesToColumns(self, name):
+        """ Column of each residue of the sequence """
+        return self.resToCol[self.getRow(name)]
+
+    def subset(self, names, removeGaps=True):
+        """ New alignment with only the given sequences, removing the columns that are gaps in all of them """
+        rows = [self.getRow(name) for name in names]
+        residues = self.residues[rows]
+        if removeGaps:
+            residues = residues[:, ~self.gapMask[rows].all(axis=0)]
+        return Alignment(names, [row.tobytes() for row in residues], {name: self.headers[name] for name in names
+                                                                       if name in self.headers})
+
+    def rename(self, names):
+        """ New alignment with the same sequences, in order, named as names (i.e: replacing the plain ids given to
+        the alignment programs) """
+        headers = {newName: self.headers[name] for name, newName in zip(self.names, names) if name in self.headers}
+        return Alignment(names, [row.tobytes() for row in self.residues], headers)
+
+    def upper(self):
+        """ New alignment with the residues in upper case, as some programs output the added sequences in lower """
+        return Alignment(self.names, [row.tobytes().upper() for row in self.residues], self.headers)
+
+    # Vectorized statistics
+    def getIdentity(self, refName=None):
+        """ Fraction of identical residues among the columns where both sequences have a residue. Returns the
+        vector of identities against refName or, if None, the pairwise identity matrix """
+        refRows = [self.getRow(refName)] if refName is not None else range(len(self))
+        identity = np.zeros((len(refRows), len(self)))
+        for i, refRow in enumerate(refRows):
+            aligned = self.residueMask & self.residueMask[refRow]
+            same = (self.residues == self.residues[refRow]) & aligned
+            identity[i] = same.sum(axis=1) / np.maximum(aligned.sum(axis=1), 1)
+        return identity[0] if refName is not None else identity
+
+    def getCoverage(self, refName):
+        """ Fraction of the residues of refName aligned to a residue in each of the sequences """
+        refMask = self.residueMask[self.getRow(refName)]
+        return (self.residueMask & refMask).sum(axis=1) / max(refMask.sum(), 1)
+
+    # Input / output
+    @classmethod
+    def read(cls, alignFile, fmt=None):
+        fmt = fmt if fmt else ALIGNMENT_FORMATS.get(os.path.splitext(alignFile)[1].lower(), 'fasta')
+        if fmt == 'pir':
+            return cls.readPIR(alignFile)
+        elif fmt == 'clustal':
+            return cls.readClustal(alignFile)
+        return cls.fromDict(readFasta(alignFile))
+
+    @classmethod
+    def readPIR(cls, pirFile):
+        names, seqs, headers = [], [], {}
+        with open(pirFile) as f:
+            lines = [line.strip() for line in f]
+        i = 0
+        while i < len(lines):
+            if lines[i].startswith('>P1;'):
+                name = lines[i][4:].strip()
+                headers[name], seqLines = lines[i + 1], []
+                i += 2
+                while i < len(lines) and not lines[i].startswith('>P1;'):
+                    seqLines.append(lines[i])
+                    i += 1
+                names.append(name), seqs.append(''.join(seqLines).rstrip('*'))
+            else:
+                i += 1
+        return cls(names, seqs, headers)
+
+    @classmethod
+    def readClustal(cls, alnFile):
+        alnDic = {}
+        with open(alnFile) as f:
+            for line in f:
+                if not line.strip() or line[0].isspace() or line.startswith(('CLUSTAL', 'MUSCLE')):
+                    continue
+                fields = line.split()
+                alnDic[fields[0]] = alnDic.get(fields[0], '') + fields[1]
+        return cls.fromDict(alnDic)
+
+    def write(self, alignFile, fmt=None):
+        fmt = fmt if fmt else ALIGNMENT_FORMATS.get(os.path.splitext(alignFile)[1].lower(), 'fasta')
+        if fmt == 'pir':
+            self.writePIR(alignFile)
+        elif fmt == 'clustal':
+            self.writeClustal(alignFile)
+        else:
+            writeFasta(self.toDict(), alignFile)
+        return alignFile
+
+    def writePIR(self, pirFile):
+        with open(pirFile, 'w') as f:
+            for name in self.names:
+                f.write('>P1;{}\n{}\n{}*\n'.format(name, self.headers.get(name, 'sequence:{}:::::::0.00: 0.00'.
+                                                                          format(name)), self.getSequence(name)))
+
+    def writeClustal(self, alnFile, lineLength=60):
+        nameWidth = max([len(name) for name in self.names]) + 4
+        with open(alnFile, 'w') as f:
+            f.write('CLUSTAL W multiple sequence alignment\n\n')
+            for iniCol in range(0, self.getNumberOfColumns(), lineLength):
+                for name in self.names:
+                    f.write('{}{}\n'.format(name.ljust(nameWidth), self.getSequence(name)[iniCol:iniCol + lineLength]))
+                f.write('\n')
+
+
+ATOM_FILE_EXTENSIONS = ['', '.pdb', '.cif', '.ent', '.atm', '.pdb.gz', '.cif.gz', '.ent.gz']
+
+
+def findAtomFile(atomFile, atomDirs):
+    """ Path of a PIR atom file, searched as modeller does in the atom files directories """
+    for atomDir in atomDirs:
+        for name in [atomFile, 'pdb' + atomFile]:
+            for ext in ATOM_FILE_EXTENSIONS:
+                path = os.path.join(atomDir, name + ext)
+                if os.path.isfile(path):
+                    return path
+
+
+def parseResidueId(resStr):
+    """ Parses a PIR residue field: '12', '12A' or '+12' (number of residues from the first one) """
+    match = re.match(r'^\s*(\+?)(-?\d+)([A-Za-z]?)\s*$', resStr)
+    if match:
+        return match.group(1) == '+', int(match.group(2)), match.group(3).upper() or ' '
+
+
+def getStructureResidues(structure):
+    """ [(chainId, resNumber, insertionCode, oneLetter)] of the standard residues of the first model """
+    return [(res.get_parent().id, res.id[1], res.id[2], seq1(res.get_resname()))
+            for res in structure.child_list[0].get_residues() if res.id[0] == ' ']
+
+
+def getStructureRange(residues, header):
+    """ Returns the slice of residues selected by a PIR structure header (structureX:file:startRes:startChain:
+    endRes:endChain:...) or raises ValueError if it does not exist in the structure """
+    fields = header.split(':')
+    startRes, startChain, endRes, endChain = [field.strip() for field in fields[2:6]]
+    chains = list(dict.fromkeys([res[0] for res in residues]))
+    for chain in [startChain, endChain]:
+        if chain and chain not in chains:
+            raise ValueError('chain {} not found (chains in file: {})'.format(chain, ', '.join(chains)))
+
+    startChain = startChain if startChain else chains[0]
+    chainIdxs = [i for i, res in enumerate(residues) if res[0] == startChain]
+    if startRes in ['', 'FIRST', '.']:
+        iniIdx = chainIdxs[0]
+    else:
+        _, resNum, iCode = parseResidueId(startRes)
+        iniIdx = [i for i in chainIdxs if residues[i][1:3] == (resNum, iCode)]
+        if not iniIdx:
+            raise ValueError('start residue {} not found in chain {}'.format(startRes, startChain))
+        iniIdx = iniIdx[0]
+
+    if endRes.startswith('+'):
+        endIdx = iniIdx + parseResidueId(endRes)[1] - 1
+        if endIdx >= len(residues):
+            raise ValueError('{} residues requested from {} but only {} exist'.
+                             format(endRes[1:], startRes, len(residues) - iniIdx))
+    else:
+        endChain = endChain if endChain else (chains[-1] if endRes in ['', 'LAST', '.'] else startChain)
+        chainIdxs = [i for i, res in enumerate(residues) if res[0] == endChain]
+        if endRes in ['', 'LAST', '.']:
+            endIdx = chainIdxs[-1]
+        else:
+            _, resNum, iCode = parseResidueId(endRes)
+            endIdx = [i for i in chainIdxs if residues[i][1:3] == (resNum, iCode)]
+            if not endIdx:
+                raise ValueError('end residue {} not found in chain {}'.format(endRes, endChain))
+            endIdx = endIdx[0]
+    return residues[iniIdx:endIdx + 1]
+
+
+def compareSequences(structSeq, alignSeq):
+    """ Description of the first difference between the structure and the ungapped alignment sequences (unknown
+    residues X match anything), or None if they match """
+    for i, (sRes, aRes) in enumerate(zip(structSeq, alignSeq)):
+        if sRes != aRes and 'X' not in (sRes, aRes):
+            return 'residue {} is {} in the structure and {} in the alignment'.format(i + 1, sRes, aRes)
+    if len(structSeq) != len(alignSeq):
+        return '{} residues in the structure and {} in the alignment'.format(len(structSeq), len(alignSeq))
+
+
+def checkAlignmentTemplates(alignFile, atomDirs):
+    """ Checks that the chain, residue range and ungapped sequence of every structure entry of a PIR alignment
+    match its atom file. Each atom file is parsed once. Returns the list of all the mismatches found """
+    try:
+        alignment = Alignment.readPIR(alignFile)
+    except ValueError as e:
+        return ['{}: {}'.format(os.path.basename(alignFile), e)]
+
+    structures, errors = {}, []
+    for name in alignment.names:
+        header = alignment.headers.get(name, '')
+        if not header.startswith('structure'):
+            continue
+
+        atomFile = header.split(':')[1].strip()
+        structFile = findAtomFile(atomFile, atomDirs)
+        if structFile is None:
+            errors.append('{}: atom file {} not found in {}'.format(name, atomFile, ', '.join(atomDirs)))
+            continue
+
+        try:
+            if structFile not in structures:
+                structures[structFile] = getStructureResidues(readStructure(structFile))
+            residues = getStructureRange(structures[structFile], header)
+        except Exception as e:
+            errors.append('{} ({}): {}'.format(name, os.path.basename(structFile), e))
+            continue
+
+        structSeq = ''.join([res[3] for res in residues])
+        alignSeq = ''.join([res for res in alignment.getSequence(name, gapped=False) if res.isupper()])
+        diff = compareSequences(structSeq, alignSeq)
+        if diff:
+            errors.append('{} ({}, {}): {}'.format(name, os.path.basename(structFile), header, diff))
+    return errors
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors: Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Utilities to compare and cluster output models by their C-alpha RMSD, using vectorized Kabsch superpositions,
+and to collapse redundant templates by sequence identity and C-alpha RMSD.
+"""
+
+import numpy as np
+
+from .utilsTemplates import readStructure
+from .utilsAlignment import readFasta
+from .utilsSymmetry import kabsch, getChainResidues, matchResidues
+
+
+def getCACoordinates(structFile):
+    """ Returns a dictionary {(chain, resIdx): [x, y, z]} with the C-alpha atoms of the first model of a structure """
+    structure = readStructure(structFile)
+    model = structure.child_list[0]
+    return {(res.get_parent().id, res.get_id()[1]): res['CA'].get_coord()
+            for res in model.get_residues() if 'CA' in res}
+
+
+def loadCACoordinates(structFiles):
+    """ Loads the C-alpha coordinates of several models of the same sequence into an array (nModels, nCA, 3).
+    Only the residues present in all the models are used """
+    caDics = [getCACoordinates(structFile) for structFile in structFiles]
+    keys = set(caDics[0])
+    for caDic in caDics[1:]:
+        keys &= set(caDic)
+    keys = sorted(keys)
+    return np.array([[caDic[key] for key in keys] for caDic in caDics], dtype=np.float64)
+
+
+def det3(mats):
+    """ Determinants of an array of 3x3 matrices (..., 3, 3) """
+    return mats[..., 0, 0] * (mats[..., 1, 1] * mats[..., 2, 2] - mats[..., 1, 2] * mats[..., 2, 1]) - \
+           mats[..., 0, 1] * (mats[..., 1, 0] * mats[..., 2, 2] - mats[..., 1, 2] * mats[..., 2, 0]) + \
+           mats[..., 0, 2] * (mats[..., 1, 0] * mats[..., 2, 1] - mats[..., 1, 1] * mats[..., 2, 0])
+
+
+def symmetricEigenvalues(mats):
+    """ Eigenvalues (descending) of an array of symmetric 3x3 matrices (..., 3, 3), using the closed form
+    trigonometric solution, much faster than a batched eigendecomposition """
+    q = np.trace(mats, axis1=-2, axis2=-1) / 3
+    p1 = mats[..., 0, 1] ** 2 + mats[..., 0, 2] ** 2 + mats[..., 1, 2] ** 2
+    p2 = (mats[..., 0, 0] - q) ** 2 + (mats[..., 1, 1] - q) ** 2 + (mats[..., 2, 2] - q) ** 2 + 2 * p1
+    p = np.sqrt(p2 / 6)
+    safeP = np.where(p > 0, p, 1)
+
+    bMats = (mats - q[..., None, None] * np.eye(3)) / safeP[..., None, None]
+    r = np.clip(det3(bMats) / 2, -1, 1)
+    phi = np.arccos(r) / 3
+    eig1 = np.where(p > 0, q + 2 * p * np.cos(phi), q)
+    eig3 = np.where(p > 0, q + 2 * p * np.cos(phi + 2 * np.pi / 3), q)
+    eig2 = 3 * q - eig1 - eig3
+    return np.stack([eig1, eig2, eig3], axis=-1)
+
+
+def pairwiseRMSD(coords, blockSize=256):
+    """ Pairwise RMSD matrix (nModels, nModels) after optimal superposition (Kabsch) of every pair of models.
+    The rotations are not applied: the minimum RMSD is obtained from the singular values of the covariance matrices
+    (with the reflection correction), computed for blocks of pairs at once """
+    nModels, nAtoms = coords.shape[:2]
+    centered = coords - coords.mean(axis=1, keepdims=True)
+    sqNorms = np.einsum('mki,mki->m', centered, centered)
+    # (nAtoms, nModels * 3) so the covariances of a block with all the models are a single matrix product
+    allCols = centered.transpose(1, 0, 2).reshape(nAtoms, nModels * 3)
+    rmsd = np.zeros((nModels, nModels))
+
+    # Only the upper triangle (pairs of each block with itself and the following models) is computed
+    for iniIdx in range(0, nModels, blockSize):
+        block = centered[iniIdx:iniIdx + blockSize]
+        nBlock, nRest = block.shape[0], nModels - iniIdx
+        covs = (block.transpose(0, 2, 1).reshape(nBlock * 3, nAtoms) @ allCols[:, iniIdx * 3:]). \
+            reshape(nBlock, 3, nRest, 3).transpose(0, 2, 1, 3)
+
+        sVals = np.sqrt(np.clip(symmetricEigenvalues(np.einsum('...ki,...kj->...ij', covs, covs)), 0, None))
+        signs = np.sign(det3(covs))
+        sumS = sVals[..., 0] + sVals[..., 1] + np.where(signs < 0, -1, 1) * sVals[..., 2]
+
+        msd = (sqNorms[iniIdx:iniIdx + nBlock, None] + sqNorms[None, iniIdx:] - 2 * sumS) / nAtoms
+        rmsd[iniIdx:iniIdx + nBlock, iniIdx:] = np.sqrt(np.clip(msd, 0, None))
+
+    rmsd = np.triu(rmsd, k=1)
+    return rmsd + rmsd.T
+
+
+def clusterByRMSD(rmsd, scores=None, threshold=2.0):
+    """ Greedy clustering of the models: the best scored (lowest) unassigned model becomes the representative of a
+    new cluster, which takes all the unassigned models closer than threshold. Returns a list of clusters as
+    dictionaries with the representative index, the member indexes and their mean and max RMSD to it """
+    nModels = rmsd.shape[0]
+    order = np.argsort(scores, kind='stable') if scores is not None else np.arange(nModels)
+    unassigned = np.ones(nModels, dtype=bool)
+
+    clusters = []
+    for repIdx in order:
+        if unassigned[repIdx]:
+            members = np.where(unassigned & (rmsd[repIdx] <= threshold))[0]
+            unassigned[members] = False
+            memberRMSDs = rmsd[repIdx, members]
+            clusters.append({'representative': int(repIdx), 'members': members.tolist(), 'size': len(members),
+                             'meanRMSD': float(memberRMSDs.mean()), 'maxRMSD': float(memberRMSDs.max())})
+    return clusters
+
+
+def getTemplateResidues(entry):
+    """ Lists of the C-alpha residues of each chain of a template entry, within the ranges used """
+    model = readStructure(entry.structFile, entry.code).child_list[0]
+    chainResidues = []
+    for chain, (first, last) in zip(entry.chains, entry.ranges):
+        residues = getChainResidues(model[chain]) if chain in model else []
+        chainResidues.append([res for res in residues if (first == 'FIRST' or res.id[1] >= int(first)) and
+                              (last == 'LAST' or res.id[1] <= int(last))])
+    return chainResidues
+
+
+def getTemplateCompleteness(entry, chainResidues):
+    """ Fraction of the residues of the template sequences with resolved C-alpha in the structure """
+    seqLength = sum([len(seq) for seqFile in entry.seqFiles for seq in readFasta(seqFile).values()])
+    return min(1.0, sum([len(residues) for residues in chainResidues]) / seqLength) if seqLength else 0.0
+
+
+def compareTemplates(chainResidues1, chainResidues2):
+    """ Sequence identity (over the shortest template) and C-alpha RMSD after superposition of the residues matched
+    by a global alignment of each pair of equivalent chains of two templates """
+    pairs, nShortest = [], 0
+    for residues1, residues2 in zip(chainResidues1, chainResidues2):
+        pairs += matchResidues(residues1, residues2)
+        nShortest += min(len(residues1), len(residues2))
+    if not pairs or nShortest == 0:
+        return 0.0, None
+
+    identity = sum([res1.get_resname() == res2.get_resname() for res1, res2 in pairs]) / nShortest
+    coords1 = np.array([res1['CA'].get_coord() for res1, _ in pairs], dtype=np.float64)
+    coords2 = np.array([res2['CA'].get_coord() for _, res2 in pairs], dtype=np.float64)
+    rot, trans = kabsch(coords1, coords2)
+    rmsd = np.sqrt(((coords1 @ rot.T + trans - coords2) ** 2).sum(axis=1).mean())
+    return identity, float(rmsd)
+
+
+def collapseTemplates(manifest, identityThreshold=0.95, rmsdThreshold=1.0, keepBest='resolution'):
+    """ Clusters the templates of a manifest whose sequence identity is over identityThreshold and whose C-alpha RMSD
+    is under rmsdThreshold, keeping the best one of each cluster: the best resolution or the most complete
+    (keepBest='completeness'), the other criterion breaking ties.
+    Returns the list of kept entries and a list of dictionaries describing the dropped ones """
+    entries = list(manifest)
+    chainResidues = [getTemplateResidues(entry) for entry in entries]
+    completeness = [getTemplateCompleteness(entry, residues) for entry, residues in zip(entries, chainResidues)]
+
+    nEntries = len(entries)
+    identities, dists = np.eye(nEntries), np.where(np.eye(nEntries) > 0, 0.0, np.inf)
+    for i in range(nEntries):
+        for j in range(i + 1, nEntries):
+            if len(entries[i].chains) != len(entries[j].chains):
+                continue
+            identity, rmsd = compareTemplates(chainResidues[i], chainResidues[j])
+            identities[i, j] = identities[j, i] = identity
+            if rmsd is not None and identity >= identityThreshold:
+                dists[i, j] = dists[j, i] = rmsd
+
+    # Lower rank is better. Templates without reported resolution go after the rest
+    resKeys = [(entry.resolution is None, entry.resolution or 0) for entry in entries]
+    if keepBest == 'completeness':
+        sortKeys = [(-completeness[i], resKeys[i], i) for i in range(nEntries)]
+    else:
+        sortKeys = [(resKeys[i], -completeness[i], i) for i in range(nEntries)]
+    ranks = np.empty(nEntries)
+    ranks[sorted(range(nEntries), key=lambda i: sortKeys[i])] = np.arange(nEntries)
+
+    kept, dropped = [], []
+    for cluster in clusterByRMSD(dists, ranks, threshold=rmsdThreshold):
+        repIdx = cluster['representative']
+        kept.append(repIdx)
+        for idx in cluster['members']:
+            if idx != repIdx:
+                dropped.append({'code': entries[idx].code, 'representative': entries[repIdx].code,
+                                'identity': float(identities[repIdx, idx]), 'rmsd': float(dists[repIdx, idx]),
+                                'resolution': entries[idx].resolution, 'completeness': completeness[idx]})
+    return [entries[idx] for idx in sorted(kept)], dropped
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors: Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Utilities to estimate the peak memory of the modeller workers and size their number from the available
+resources of the node.
+"""
+
+import os, json
+import numpy as np
+import psutil
+
+MB = 2 ** 20
+
+
+def getAvailableCores():
+    """ Number of cores this process is allowed to run on """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def getAvailableMemory():
+    """ Memory available for new processes in the node, in bytes """
+    return psutil.virtual_memory().available
+
+
+def estimateWorkerMemory(nResidues, nTemplates=1, modelH=False, nChains=1, nSymPairs=0, symAtom='CA'):
+    """ Raw estimation of the peak memory (bytes) of a modeller worker: a fixed base, the atoms of the model and
+    the restraints derived from each template and chain, and the symmetry restraints between chain pairs """
+    atomsPerRes = 16 if modelH else 8
+    nAtoms = nResidues * atomsPerRes
+    restraintsPerAtom = 30 + 15 * nTemplates
+    memory = 200 * MB + nAtoms * restraintsPerAtom * 100 + nChains * 5 * MB
+
+    if nSymPairs > 0:
+        symAtomsPerChain = nResidues / max(nChains, 1) * (1 if symAtom == 'CA' else atomsPerRes)
+        memory += nSymPairs * symAtomsPerChain ** 2 * 8
+    return memory
+
+
+class MemoryEstimator:
+    """ Peak memory estimator of a modeller worker, calibrated against the peak memory recorded in previous runs.
+    The records are stored as json lines: {"features": {...}, "peakMemory": bytes} """
+    minRecords, safetyMargin = 3, 1.2
+
+    def __init__(self, recordsFile=None):
+        self.recordsFile = recordsFile
+        self.factor = self.calibrate()
+
+    def getRecords(self):
+        records = []
+        if self.recordsFile and os.path.exists(self.recordsFile):
+            with open(self.recordsFile) as f:
+                for line in f:
+                    if line.strip():
+                        records.append(json.loads(line))
+        return records
+
+    def calibrate(self):
+        """ Least squares scale factor between the raw estimations and the recorded peak memories """
+        records = self.getRecords()
+        if len(records) < self.minRecords:
+            return 1.0
+        preds = np.array([estimateWorkerMemory(**rec['features']) for rec in records])
+        obs = np.array([rec['peakMemory'] for rec in records])
+        return float(np.dot(preds, obs) / np.dot(preds, preds))
+
+    def estimate(self, **features):
+        """ Calibrated peak memory estimation (bytes) per worker, including a safety margin """
+        return estimateWorkerMemory(**features) * self.factor * self.safetyMargin
+
+    def addRecord(self, features, peakMemory):
+        if self.recordsFile:
+            with open(self.recordsFile, 'a') as f:
+                f.write(json.dumps({'features': features, 'peakMemory': peakMemory}) + '\n')
+            self.factor = self.calibrate()
+
+
+def getTotalMemory():
+    """ Total memory of the node, in bytes """
+    return psutil.virtual_memory().total
+
+
+def getNumberOfWorkers(nModels, nThreads, memPerWorker, nCores=None, availMemory=None):
+    """ Returns the number of modeller workers to use and the reasons of that choice. The workers are limited by
+    the models that will be built, the threads requested, the available cores and the available memory """
+    nCores = nCores if nCores else getAvailableCores()
+    availMemory = availMemory if availMemory else getAvailableMemory()
+    memWorkers = max(1, int(availMemory // memPerWorker)) if memPerWorker > 0 else nThreads
+
+    limits = [(nThreads, 'threads requested'),
+              (nModels, 'models to build'),
+              (nCores, 'available cores'),
+              (memWorkers, '{:.0f} MB available / {:.0f} MB estimated per worker'.
+               format(availMemory / MB, memPerWorker / MB))]
+    nWorkers = max(1, min([limit for limit, _ in limits]))
+
+    reasons = ['{} workers: limited by {}'.format(nWorkers, ', '.join([reason for limit, reason in limits
+                                                                       if limit == nWorkers]) or 'minimum of 1')]
+    reasons += ['{}: {}'.format(reason, limit) for limit, reason in limits]
+    return nWorkers, reasons
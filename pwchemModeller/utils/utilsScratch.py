@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors: Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Utilities to run jobs in node-local scratch directories, staging back only their results.
+"""
+
+import os, shutil, tempfile
+
+KEEP_NEVER, KEEP_ON_FAILURE, KEEP_ALWAYS = 'Never', 'On failure', 'Always'
+RETENTION_POLICIES = [KEEP_NEVER, KEEP_ON_FAILURE, KEEP_ALWAYS]
+
+
+def getScratchBaseDir(scratchDir=''):
+    """ Base directory for the scratch directories: the given one, $TMPDIR or the system temporary directory """
+    return scratchDir if scratchDir else os.environ.get('TMPDIR', tempfile.gettempdir())
+
+
+class ScratchDir:
+    """ Context manager creating a private scratch working directory for a job. On exit, the files selected by
+    stageFilter are moved to outDir, the rest (intermediates) are copied to keepDir following the retention
+    policy, and the scratch directory is always removed, also when the job fails """
+    def __init__(self, baseDir, outDir, stageFilter, keepDir=None, retention=KEEP_NEVER, prefix='modeller_'):
+        self.baseDir, self.outDir, self.stageFilter = baseDir, outDir, stageFilter
+        self.keepDir, self.retention, self.prefix = keepDir, retention, prefix
+        self.path = None
+
+    def __enter__(self):
+        os.makedirs(self.baseDir, exist_ok=True)
+        self.path = tempfile.mkdtemp(prefix=self.prefix, dir=self.baseDir)
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        try:
+            failed = excType is not None
+            staged = self.stageOut()
+            if self.keepDir and (self.retention == KEEP_ALWAYS or (failed and self.retention == KEEP_ON_FAILURE)):
+                self.keepIntermediates(staged)
+        finally:
+            shutil.rmtree(self.path, ignore_errors=True)
+        return False
+
+    def stageOut(self):
+        """ Moves the result files of the scratch directory to the output directory. Returns their names """
+        os.makedirs(self.outDir, exist_ok=True)
+        staged = []
+        for fileName in os.listdir(self.path):
+            if os.path.isfile(os.path.join(self.path, fileName)) and self.stageFilter(fileName):
+                shutil.move(os.path.join(self.path, fileName), os.path.join(self.outDir, fileName))
+                staged.append(fileName)
+        return staged
+
+    def keepIntermediates(self, staged=()):
+        os.makedirs(self.keepDir, exist_ok=True)
+        for fileName in os.listdir(self.path):
+            if fileName not in staged:
+                src = os.path.join(self.path, fileName)
+                if os.path.isdir(src):
+                    shutil.copytree(src, os.path.join(self.keepDir, fileName), dirs_exist_ok=True)
+                else:
+                    shutil.copy(src, self.keepDir)
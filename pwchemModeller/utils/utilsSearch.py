@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors: Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Offline template search: a local k-mer index of the protein chains of a directory of PDB/mmCIF files (or of a
+SEQRES dump), incrementally updated and queried with the target sequence to rank candidate template chains.
+"""
+
+import os, json, gzip
+
+import numpy as np
+from Bio.Align import PairwiseAligner, substitution_matrices
+from Bio.SeqUtils import seq1
+
+from .utilsTemplates import readStructure, getStructureCode, parseTemplateLine, findInMirror, downloadStructure
+
+INDEX_VERSION = 1
+AA_ALPHABET = 'ACDEFGHIKLMNPQRSTVWY'
+STRUCT_EXTENSIONS = ('.pdb', '.ent', '.cif', '.pdb.gz', '.ent.gz', '.cif.gz')
+CHAINS_FILE, POSTINGS_FILE = 'chains.json.gz', 'postings.npz'
+
+
+def encodeKmers(seq, k):
+    """ Sorted unique integer codes (base 20) of the k-mers of a sequence, skipping those with non standard residues """
+    lut = np.full(256, -1, dtype=np.int64)
+    lut[np.frombuffer(AA_ALPHABET.encode(), dtype=np.uint8)] = np.arange(len(AA_ALPHABET))
+    values = lut[np.frombuffer(seq.upper().encode(), dtype=np.uint8)]
+    if len(values) < k:
+        return np.empty(0, dtype=np.uint32)
+    windows = np.lib.stride_tricks.sliding_window_view(values, k)
+    windows = windows[(windows >= 0).all(axis=1)]
+    return np.unique(windows @ (len(AA_ALPHABET) ** np.arange(k - 1, -1, -1))).astype(np.uint32)
+
+
+def readStructureChains(structFile):
+    """ List of (chain, sequence, residueNumbers) of the protein chains of the first model of a structure. All the
+    standard residue records are kept, also those without C-alpha and the non-standard ones (as X), so the sequence
+    positions map exactly onto the residue numbers """
+    chains = []
+    for chain in readStructure(structFile).child_list[0]:
+        residues = [res for res in chain if res.id[0] == ' ']
+        if any(['CA' in res for res in residues]):
+            chains.append((chain.id, ''.join([seq1(res.get_resname()) for res in residues]),
+                           [res.id[1] for res in residues]))
+    return chains
+
+
+def readSeqresChains(seqresFile):
+    """ List of (code, chain, sequence) of the protein chains of a SEQRES dump (pdb_seqres.txt format:
+    >101m_A mol:protein length:154  MYOGLOBIN), maybe gzip compressed """
+    chains, header = [], None
+    with (gzip.open(seqresFile, 'rt') if seqresFile.endswith('.gz') else open(seqresFile)) as f:
+        for line in f:
+            if line.startswith('>'):
+                header = line[1:].split()
+            elif header and line.strip() and (len(header) < 2 or header[1] == 'mol:protein'):
+                code, chain = header[0].rsplit('_', 1)
+                chains.append((code.lower(), chain, line.strip()))
+    return chains
+
+
+def isSeqresFile(fileName):
+    return not fileName.endswith(STRUCT_EXTENSIONS)
+
+
+def getAligner():
+    aligner = PairwiseAligner(mode='local', open_gap_score=-10, extend_gap_score=-0.5)
+    aligner.substitution_matrix = substitution_matrices.load('BLOSUM62')
+    return aligner
+
+
+def alignToChain(targetSeq, chainSeq, aligner=None):
+    """ Local alignment of the target with a template chain. Returns the identity (over the aligned positions),
+    the target coverage and the first and last aligned positions of the chain, None if they do not align """
+    aligner = aligner if aligner else getAligner()
+    try:
+        alignment = aligner.align(targetSeq, chainSeq)[0]
+    except (IndexError, ValueError):
+        return None
+    tBlocks, cBlocks = alignment.aligned
+    if len(tBlocks) == 0:
+        return None
+    nAligned = sum([end - ini for ini, end in tBlocks])
+    nIdentical = sum([targetSeq[tIni + i] == chainSeq[cIni + i]
+                      for (tIni, tEnd), (cIni, _) in zip(tBlocks, cBlocks) for i in range(tEnd - tIni)])
+    return nIdentical / nAligned, nAligned / len(targetSeq), int(cBlocks[0][0]), int(cBlocks[-1][1]) - 1
+
+
+class TemplateIndex:
+    """ On disk k-mer index of template chains. The postings (k-mer code, chain) are stored as two arrays sorted by
+    k-mer, so the chains sharing k-mers with a query are counted with binary searches. Source files are tracked by
+    their modification time and size, so updates only parse the new or modified files """
+    def __init__(self, indexDir, k=5):
+        self.indexDir, self.k = indexDir, k
+        self.sources, self.chains = {}, []
+        self.kmers, self.chainIdx = np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.uint32)
+        if os.path.exists(os.path.join(indexDir, CHAINS_FILE)):
+            self.load()
+
+    def __len__(self):
+        return len(self.chains)
+
+    def load(self):
+        with gzip.open(os.path.join(self.indexDir, CHAINS_FILE), 'rt') as f:
+            indexDic = json.load(f)
+        if indexDic.get('version') != INDEX_VERSION:
+            return
+        self.k, self.sources, self.chains = indexDic['k'], indexDic['sources'], indexDic['chains']
+        postings = np.load(os.path.join(self.indexDir, POSTINGS_FILE))
+        self.kmers, self.chainIdx = postings['kmers'], postings['chainIdx']
+
+    def write(self):
+        """ Writes the index files atomically (temporary files, then renamed) """
+        os.makedirs(self.indexDir, exist_ok=True)
+        postingsFile, chainsFile = os.path.join(self.indexDir, POSTINGS_FILE), os.path.join(self.indexDir, CHAINS_FILE)
+        tmpPostings = '{}.{}.tmp.npz'.format(postingsFile, os.getpid())
+        tmpChains = '{}.{}.tmp'.format(chainsFile, os.getpid())
+        np.savez(tmpPostings, kmers=self.kmers, chainIdx=self.chainIdx)
+        with gzip.open(tmpChains, 'wt') as f:
+            json.dump({'version': INDEX_VERSION, 'k': self.k, 'sources': self.sources, 'chains': self.chains}, f)
+        os.replace(tmpPostings, postingsFile)
+        os.replace(tmpChains, chainsFile)
+
+    @staticmethod
+    def getSourceFiles(source):
+        """ Structure files of a directory (recursively) or the single source file """
+        if not os.path.isdir(source):
+            return [os.path.abspath(source)]
+        sourceFiles = []
+        for root, _, files in os.walk(source):
+            sourceFiles += [os.path.abspath(os.path.join(root, file)) for file in files
+                            if file.lower().endswith(STRUCT_EXTENSIONS)]
+        return sorted(sourceFiles)
+
+    def update(self, source):
+        """ Indexes the new or modified files of a source (directory of structures or SEQRES dump) and removes the
+        chains of its files which were modified or deleted. Returns (nAddedFiles, nRemovedFiles, errors) """
+        source = os.path.abspath(source)
+        stamps = {}
+        for sourceFile in self.getSourceFiles(source):
+            stat = os.stat(sourceFile)
+            stamps[sourceFile] = [stat.st_mtime, stat.st_size]
+
+        inSource = [sourceFile for sourceFile in self.sources
+                    if sourceFile == source or sourceFile.startswith(source + os.sep)]
+        removed = [sourceFile for sourceFile in inSource if self.sources[sourceFile] != stamps.get(sourceFile)]
+        added = [sourceFile for sourceFile in stamps if self.sources.get(sourceFile) != stamps[sourceFile]]
+        self.removeSources(removed)
+
+        newChains, errors = [], {}
+        for sourceFile in added:
+            try:
+                newChains += self.parseSource(sourceFile)
+            except Exception as e:
+                errors[sourceFile] = '{}: {}'.format(type(e).__name__, e)
+            self.sources[sourceFile] = stamps[sourceFile]
+        self.addChains(newChains)
+        return len(added), len(removed), errors
+
+    def parseSource(self, sourceFile):
+        if isSeqresFile(sourceFile):
+            return [{'source': sourceFile, 'code': code, 'chain': chain, 'seq': seq, 'resNums': None}
+                    for code, chain, seq in readSeqresChains(sourceFile)]
+        code = getStructureCode(sourceFile)
+        return [{'source': sourceFile, 'code': code, 'chain': chain, 'seq': seq, 'resNums': resNums}
+                for chain, seq, resNums in readStructureChains(sourceFile)]
+
+    def removeSources(self, sourceFiles):
+        sourceFiles = set(sourceFiles)
+        if not sourceFiles:
+            return
+        keepChains = [i for i, chain in enumerate(self.chains) if chain['source'] not in sourceFiles]
+        remap = np.full(len(self.chains), -1, dtype=np.int64)
+        remap[keepChains] = np.arange(len(keepChains))
+        newIdx = remap[self.chainIdx]
+        self.kmers, self.chainIdx = self.kmers[newIdx >= 0], newIdx[newIdx >= 0].astype(np.uint32)
+        self.chains = [self.chains[i] for i in keepChains]
+        for sourceFile in sourceFiles:
+            self.sources.pop(sourceFile, None)
+
+    def addChains(self, chains):
+        if not chains:
+            return
+        kmers, chainIdx = [self.kmers], [self.chainIdx]
+        for i, chain in enumerate(chains):
+            codes = encodeKmers(chain['seq'], self.k)
+            kmers.append(codes), chainIdx.append(np.full(len(codes), len(self.chains) + i, dtype=np.uint32))
+        self.chains += chains
+        kmers, chainIdx = np.concatenate(kmers), np.concatenate(chainIdx)
+        order = np.argsort(kmers, kind='stable')
+        self.kmers, self.chainIdx = kmers[order], chainIdx[order]
+
+    def countSharedKmers(self, targetSeq):
+        """ Number of k-mers of the target shared by each indexed chain """
+        targetKmers = encodeKmers(targetSeq, self.k)
+        los = np.searchsorted(self.kmers, targetKmers, side='left')
+        lens = np.searchsorted(self.kmers, targetKmers, side='right') - los
+        los, lens = los[lens > 0], lens[lens > 0]
+        # Positions of all the postings of the matched k-mers, without a python loop
+        positions = np.repeat(los - (np.cumsum(lens) - lens), lens) + np.arange(lens.sum())
+        return np.bincount(self.chainIdx[positions], minlength=len(self.chains))
+
+    def search(self, targetSeq, maxHits=10, minIdentity=0.3, minCoverage=0.2, nCandidates=200):
+        """ Ranks the template chains for a target sequence: the chains sharing most k-mers with the target are
+        aligned to it and ranked by identity x coverage. Returns a list of dictionaries with the code, chain, source
+        file, first and last residue numbers (sequence positions for SEQRES chains), sequence of the range,
+        identity and coverage of each hit. Identical chains of the same entry are reported once """
+        if not self.chains:
+            return []
+        counts = self.countSharedKmers(targetSeq)
+        candidates = [idx for idx in np.argsort(-counts, kind='stable')[:nCandidates] if counts[idx] > 0]
+
+        hits, aligner = [], getAligner()
+        for idx in candidates:
+            chain = self.chains[idx]
+            alignRes = alignToChain(targetSeq, chain['seq'], aligner)
+            if alignRes is None or alignRes[0] < minIdentity or alignRes[1] < minCoverage:
+                continue
+            identity, coverage, ini, end = alignRes
+            resNums = chain['resNums'] if chain['resNums'] else list(range(1, len(chain['seq']) + 1))
+            hits.append({'code': chain['code'], 'chain': chain['chain'], 'source': chain['source'],
+                         'seqres': chain['resNums'] is None, 'first': resNums[ini], 'last': resNums[end],
+                         'sequence': chain['seq'][ini:end + 1], 'identity': identity, 'coverage': coverage,
+                         'sharedKmers': int(counts[idx])})
+
+        hits.sort(key=lambda hit: -hit['identity'] * hit['coverage'])
+        uniqueHits, seen = [], set()
+        for hit in hits:
+            if (hit['code'], hit['sequence']) not in seen:
+                seen.add((hit['code'], hit['sequence']))
+                uniqueHits.append(hit)
+        return uniqueHits[:maxHits]
+
+
+def locateHit(hit, structFile):
+    """ Maps a hit (i.e: found in a SEQRES dump) onto the resolved residues of its chain in a structure file.
+    Returns the hit updated with the structure file and the residue numbers and sequence of the resolved range """
+    for chain, seq, resNums in readStructureChains(structFile):
+        if chain == hit['chain']:
+            alignRes = alignToChain(hit['sequence'], seq)
+            if alignRes is not None:
+                _, _, ini, end = alignRes
+                return dict(hit, source=structFile, seqres=False, first=resNums[ini], last=resNums[end],
+                            sequence=seq[ini:end + 1])
+    return None
+
+
+def resolveHit(hit, mirrorDir=None, downloadDir='.'):
+    """ Locates a hit of a SEQRES dump in its structure, taken from the local mirror or downloaded into downloadDir.
+    Returns the located hit (None if its chain is not found) and whether the structure file is a mirror one """
+    mirrorFile = findInMirror(hit['code'], mirrorDir)
+    structFile = mirrorFile if mirrorFile else downloadStructure(hit['code'], downloadDir)
+    return locateHit(hit, structFile), bool(mirrorFile)
+
+
+def normalizeTemplateCode(name):
+    """ Lowercase code of a template given by its PDB code or its structure file, removing the pdb prefix of the
+    PDB archive files (i.e: /mirror/ab/pdb1abc.ent.gz -> 1abc) """
+    code = getStructureCode(name)
+    return code[3:] if len(code) == 7 and code.startswith('pdb') else code
+
+
+def getTemplateKeys(templateListStr):
+    """ Set of normalized (code, chain) of the templates of a templateList text, both from their PDB names and
+    their structure files """
+    keys = set()
+    for tempLine in templateListStr.split('\n'):
+        if not tempLine.strip():
+            continue
+        tempJson = parseTemplateLine(tempLine)
+        if 'chain' in tempJson:
+            chains = [tempJson['chain']]
+        else:
+            chains = [modelChain.strip().split('-')[-1] for modelChain in tempJson['chains'].split(',')]
+        names = [name for name in [tempJson.get('pdbName'), tempJson.get('pdbFile')] if name]
+        keys.update([(normalizeTemplateCode(name), chain.upper()) for name in names for chain in chains])
+    return keys
+
+
+def getHitKeys(hit):
+    """ Normalized (code, chain) of a search hit, from its code and its structure file """
+    names = [hit['code']] + ([hit['source']] if not hit['seqres'] else [])
+    return {(normalizeTemplateCode(name), hit['chain'].upper()) for name in names}
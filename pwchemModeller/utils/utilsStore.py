@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors: Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Content-addressed store of the results of the modeller scripts, keyed by a hash of their normalized inputs, so
+runs with identical inputs reuse the stored structures and scores instead of repeating the work.
+"""
+
+import os, json, glob, shutil, hashlib
+
+from .utilsTemplates import getFileHash
+
+STORE_VERSION = 1
+ENTRY_FILE = 'entry.json'
+
+
+def isNumber(value):
+    try:
+        float(value)
+        return True
+    except ValueError:
+        return False
+
+
+def normalizeArgs(args, ignore=()):
+    """ Dictionary {flag: value} of a list of script arguments, without the ignored flags. Values which are existing
+    files are replaced by the hash of their content, so the same inputs in other paths give the same options """
+    options, flag = {}, None
+    for arg in map(str, args):
+        if arg.startswith('-') and not isNumber(arg):
+            flag = arg
+            if flag not in ignore:
+                options[flag] = True
+        elif flag is not None and flag not in ignore:
+            options[flag] = getFileHash(arg) if os.path.isfile(arg) else arg
+    return options
+
+
+class ResultStore:
+    """ Directory of result entries, one per key: <storeDir>/<key[:2]>/<key>/ with the result files and an
+    entry.json describing them. Entries are written atomically and, when the store grows over maxSize bytes, the
+    least recently used ones are evicted """
+    def __init__(self, storeDir, maxSize=None):
+        self.storeDir, self.maxSize = storeDir, maxSize
+        os.makedirs(storeDir, exist_ok=True)
+
+    @staticmethod
+    def getKey(**inputs):
+        """ Key of a result: hash of its normalized inputs (json serializable) """
+        keyStr = json.dumps({'version': STORE_VERSION, 'inputs': inputs}, sort_keys=True)
+        return hashlib.sha256(keyStr.encode()).hexdigest()
+
+    def getEntryDir(self, key):
+        return os.path.join(self.storeDir, key[:2], key)
+
+    def fetch(self, key):
+        """ Returns a dictionary {name: storedFile} with the files of the entry, None if not stored.
+        The entry is marked as recently used """
+        entryFile = os.path.join(self.getEntryDir(key), ENTRY_FILE)
+        if not os.path.exists(entryFile):
+            return None
+        with open(entryFile) as f:
+            entry = json.load(f)
+        storedFiles = {name: os.path.join(self.getEntryDir(key), name) for name in entry['files']}
+        if not all([os.path.exists(storedFile) for storedFile in storedFiles.values()]):
+            return None
+        os.utime(entryFile)
+        return storedFiles
+
+    def restore(self, key, outDir):
+        """ Copies the files of a stored entry into outDir. Returns the restored files, None if not stored """
+        storedFiles = self.fetch(key)
+        if storedFiles is None:
+            return None
+        os.makedirs(outDir, exist_ok=True)
+        return [shutil.copy(storedFile, os.path.join(outDir, name)) for name, storedFile in storedFiles.items()]
+
+    def put(self, key, files, metadata=None):
+        """ Stores the files {name: file} of a result. The entry is first written in a temporary directory and then
+        renamed, so concurrent readers never see incomplete entries """
+        entryDir = self.getEntryDir(key)
+        if os.path.exists(os.path.join(entryDir, ENTRY_FILE)):
+            return entryDir
+
+        tmpDir = '{}.{}.tmp'.format(entryDir, os.getpid())
+        os.makedirs(tmpDir, exist_ok=True)
+        size = 0
+        for name, inFile in files.items():
+            shutil.copy(inFile, os.path.join(tmpDir, name))
+            size += os.path.getsize(inFile)
+        with open(os.path.join(tmpDir, ENTRY_FILE), 'w') as f:
+            json.dump({'key': key, 'files': sorted(files), 'size': size, 'metadata': metadata or {}}, f, indent=2)
+
+        try:
+            os.rename(tmpDir, entryDir)
+        except OSError:
+            # Stored meanwhile by another process
+            shutil.rmtree(tmpDir, ignore_errors=True)
+        self.evict()
+        return entryDir
+
+    def getEntries(self):
+        """ List of (lastUsed, size, entryDir) of the stored entries """
+        entries = []
+        for entryFile in glob.glob(os.path.join(self.storeDir, '*', '*', ENTRY_FILE)):
+            try:
+                with open(entryFile) as f:
+                    size = json.load(f)['size']
+                entries.append((os.path.getmtime(entryFile), size, os.path.dirname(entryFile)))
+            except (OSError, ValueError, KeyError):
+                continue
+        return entries
+
+    def getSize(self):
+        return sum([size for _, size, _ in self.getEntries()])
+
+    def evict(self, maxSize=None):
+        """ Removes the least recently used entries until the store is not larger than maxSize bytes.
+        Returns the number of evicted entries """
+        maxSize = maxSize if maxSize is not None else self.maxSize
+        if maxSize is None:
+            return 0
+        entries = sorted(self.getEntries())
+        totalSize, nEvicted = sum([size for _, size, _ in entries]), 0
+        for _, size, entryDir in entries:
+            if totalSize <= maxSize:
+                break
+            shutil.rmtree(entryDir, ignore_errors=True)
+            totalSize -= size
+            nEvicted += 1
+        return nEvicted
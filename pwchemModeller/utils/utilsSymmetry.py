@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors: Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Utilities to define the symmetry restraints of homo-oligomers as groups of equivalent chains, and to build
+homo-oligomers from a single modelled protomer and the symmetry operators of a multi-chain template.
+"""
+
+from itertools import combinations
+import numpy as np
+
+from Bio.Align import PairwiseAligner
+from Bio.PDB import NeighborSearch
+from Bio.PDB.Structure import Structure
+from Bio.PDB.Model import Model
+from Bio.SeqUtils import seq1
+
+from .utilsTemplates import readStructure, writeStructure
+
+REFERENCE, RING, ALL_PAIRS = 'Reference', 'Ring', 'All pairs'
+SYM_TOPOLOGIES = [REFERENCE, RING, ALL_PAIRS]
+
+
+def parseSymmetryGroups(groupsStr):
+    """ Parses the symmetry groups: chains separated by commas, groups separated by semicolons. i.e: A,B,C,D;E,F """
+    groups = []
+    for groupStr in groupsStr.split(';'):
+        chains = [chain.strip() for chain in groupStr.split(',') if chain.strip()]
+        if chains:
+            groups.append(chains)
+    return groups
+
+
+def getSymmetryPairs(groups, topology=REFERENCE):
+    """ Chain pairs restrained by symmetry for each group, depending on the topology:
+    Reference: every chain with the first one (n-1 pairs)
+    Ring: every chain with the next one, closing the ring (n pairs)
+    All pairs: every pair of chains (n(n-1)/2 pairs) """
+    pairs = []
+    for chains in groups:
+        if topology == REFERENCE:
+            pairs += [(chains[0], chain) for chain in chains[1:]]
+        elif topology == RING:
+            pairs += [(chains[i], chains[i + 1]) for i in range(len(chains) - 1)]
+            if len(chains) > 2:
+                pairs.append((chains[-1], chains[0]))
+        else:
+            pairs += list(combinations(chains, 2))
+    return pairs
+
+
+def parseResidueRanges(rangesStr):
+    """ Parses comma separated residue ranges (i.e: 10-120, 150-200) into a list of (first, last) tuples """
+    ranges = []
+    for rangeStr in rangesStr.split(','):
+        if rangeStr.strip():
+            first, last = rangeStr.strip().split('-')
+            ranges.append((int(first), int(last)))
+    return ranges
+
+
+# Protomer plus symmetry: the assembly is built by placing copies of a single modelled chain
+def kabsch(mobile, target):
+    """ Rotation and translation (rot, trans) minimizing the RMSD of mobile @ rot.T + trans to target (nAtoms, 3) """
+    mobCenter, tarCenter = mobile.mean(axis=0), target.mean(axis=0)
+    cov = (mobile - mobCenter).T @ (target - tarCenter)
+    u, _, vt = np.linalg.svd(cov)
+    sign = np.sign(np.linalg.det(vt.T @ u.T))
+    rot = vt.T @ np.diag([1, 1, sign]) @ u.T
+    return rot, tarCenter - mobCenter @ rot.T
+
+
+def getChainResidues(chain):
+    """ Standard residues of a chain with C-alpha atom """
+    return [res for res in chain if res.id[0] == ' ' and 'CA' in res]
+
+
+def matchResidues(residues1, residues2):
+    """ Pairs of equivalent residues of two chains, matched by a global alignment of their sequences """
+    seq1Str = ''.join([seq1(res.get_resname()) for res in residues1])
+    seq2Str = ''.join([seq1(res.get_resname()) for res in residues2])
+    aligner = PairwiseAligner(mode='global', open_gap_score=-10, extend_gap_score=-0.5)
+    alignment = aligner.align(seq1Str, seq2Str)[0]
+
+    pairs = []
+    for (ini1, end1), (ini2, end2) in zip(*alignment.aligned):
+        pairs += list(zip(residues1[ini1:end1], residues2[ini2:end2]))
+    return pairs
+
+
+def getSymmetryOperators(templateStructure, chains):
+    """ Operators (rot, trans) placing the first chain of the template on each of the chains (identity included),
+    computed by superposition of their equivalent C-alpha atoms """
+    model = templateStructure.child_list[0]
+    refResidues = getChainResidues(model[chains[0]])
+    operators = []
+    for chain in chains:
+        pairs = matchResidues(refResidues, getChainResidues(model[chain]))
+        mobile = np.array([res1['CA'].get_coord() for res1, _ in pairs], dtype=np.float64)
+        target = np.array([res2['CA'].get_coord() for _, res2 in pairs], dtype=np.float64)
+        operators.append(kabsch(mobile, target))
+    return operators
+
+
+def getLongChainIds(chains):
+    """ Chain ids which do not fit in the PDB format (more than one character) """
+    return [chain for chain in chains if len(chain) > 1]
+
+
+def isCIFFile(fileName):
+    return fileName.lower().endswith(('.cif', '.cif.gz'))
+
+
+def getAssemblyChains(templateFile, chains=None):
+    """ Chains of the assembly template the protomer copies are placed on: the given ones or all of them """
+    return list(chains) if chains else [chain.id for chain in readStructure(templateFile, 'template').child_list[0]]
+
+
+def buildSymmetricOligomer(protomerFile, templateFile, chains=None, outFile=None):
+    """ Builds a homo-oligomer placing copies of the (single chain) protomer model on the chains of the template
+    assembly: the protomer is fitted on the first chain and then transformed by the symmetry operators of the
+    template. The copies are named as the template chains. Returns the oligomer structure (written to outFile).
+    Chain ids longer than one character (i.e: large assemblies) can only be written as mmCIF """
+    template = readStructure(templateFile, 'template')
+    chains = list(chains) if chains else [chain.id for chain in template.child_list[0]]
+    longChains = getLongChainIds(chains)
+    if outFile and longChains and not isCIFFile(outFile):
+        raise ValueError('Chain ids {} do not fit in the PDB format, the oligomer must be written as mmCIF'.
+                         format(', '.join(longChains)))
+    protomer = readStructure(protomerFile, 'protomer')
+    protChain = protomer.child_list[0].child_list[0]
+
+    pairs = matchResidues(getChainResidues(protChain), getChainResidues(template.child_list[0][chains[0]]))
+    fitRot, fitTrans = kabsch(np.array([res1['CA'].get_coord() for res1, _ in pairs], dtype=np.float64),
+                              np.array([res2['CA'].get_coord() for _, res2 in pairs], dtype=np.float64))
+
+    oligomer, oliModel = Structure('oligomer'), Model(0)
+    oligomer.add(oliModel)
+    for chainId, (rot, trans) in zip(chains, getSymmetryOperators(template, chains)):
+        copyChain = protChain.copy()
+        copyChain.id = chainId
+        for atom in copyChain.get_atoms():
+            coord = atom.get_coord().astype(np.float64) @ fitRot.T + fitTrans
+            atom.set_coord((coord @ rot.T + trans).astype(np.float32))
+        oliModel.add(copyChain)
+
+    if outFile:
+        writeStructure(oligomer, outFile)
+    return oligomer
+
+
+def getInterfaceResidues(structure, cutoff=6.0):
+    """ Residues (resNumber, chainId) with any atom closer than cutoff to an atom of another chain """
+    atoms = list(structure.child_list[0].get_atoms())
+    interface = set()
+    for atom1, atom2 in NeighborSearch(atoms).search_all(cutoff, level='A'):
+        res1, res2 = atom1.get_parent(), atom2.get_parent()
+        if res1.get_parent().id != res2.get_parent().id:
+            interface.add((res1.id[1], res1.get_parent().id))
+            interface.add((res2.id[1], res2.get_parent().id))
+    return sorted(interface, key=lambda res: (res[1], res[0]))
@@ -0,0 +1,391 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors: Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Utilities to compile the free text list of templates of the comparative modelling protocol into a template manifest,
+so the rest of the steps do not need to parse it again.
+"""
+
+import os, json, glob, gzip, shutil, hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+from Bio.PDB import PDBParser, MMCIFParser, PDBIO, MMCIFIO, Select, parse_pdb_header
+from Bio.PDB.MMCIF2Dict import MMCIF2Dict
+
+import pwem.convert as emconv
+
+MANIFEST_VERSION = 1
+MIRROR_EXTENSIONS = ['.cif', '.cif.gz', '.pdb', '.pdb.gz', '.ent', '.ent.gz']
+# mmCIF fields with the resolution of X-ray and EM structures, in order of preference
+CIF_RESOLUTION_KEYS = ['_refine.ls_d_res_high', '_reflns.d_resolution_high', '_em_3d_reconstruction.resolution']
+
+
+def getFileHash(fileName, blockSize=2 ** 20):
+    """ Returns the sha256 hexdigest of the content of a file. The modeller scripts use a copy of it
+    (scripts/model_output.py), as they cannot import the plugin """
+    sha = hashlib.sha256()
+    with open(fileName, 'rb') as f:
+        for block in iter(lambda: f.read(blockSize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def getStructureCode(structFile):
+    """ Name of a structure file without its (maybe compressed) extension """
+    baseName = os.path.basename(structFile)
+    baseName = baseName[:-3] if baseName.endswith('.gz') else baseName
+    return os.path.splitext(baseName)[0].lower()
+
+
+def parseTemplateLine(tempLine):
+    """ Parses a line of the templateList text: '<n>) {json}' """
+    return json.loads(tempLine.split(')', 1)[1].strip())
+
+
+def parseRangeFromSeqFile(seqFile):
+    """ Returns the [first, last] range stored in the name of the fasta files written by the template wizard:
+    <name>_<id>_<chain>_<first>-<last>.fa """
+    return os.path.splitext(os.path.basename(seqFile))[0].split('_')[-1].split('-')
+
+
+class TemplateEntry:
+    """ Template used in a comparative modelling: PDB code, chains and ranges used, resolved sequence and structure
+    files and their content hashes """
+    def __init__(self, code, chains, ranges, seqFiles, structFile='', multiChain=False,
+                 seqHashes=None, structHash='', atomFile='', resolution=None):
+        self.code = code
+        self.atomFile = atomFile if atomFile else code
+        self.chains = chains
+        self.ranges = ranges
+        self.seqFiles = seqFiles
+        self.structFile = structFile
+        self.multiChain = multiChain
+        self.seqHashes = seqHashes if seqHashes is not None else [getFileHash(seqFile) for seqFile in seqFiles]
+        self.structHash = structHash
+        self.resolution = resolution
+        if not structHash and structFile and os.path.exists(structFile):
+            self.structHash = getFileHash(structFile)
+
+    @classmethod
+    def fromTemplateJson(cls, tempJson):
+        """ Builds the entry from the json stored in a line of the templateList """
+        code, structFile = tempJson['pdbName'], tempJson.get('pdbFile', '')
+        if 'chains' not in tempJson:
+            chains, ranges = [tempJson['chain']], [tempJson['index'].split('-')]
+            seqFiles = [tempJson['seqFile']]
+            multiChain = False
+        else:
+            chains, ranges, seqFiles = [], [], []
+            for modelChain in tempJson['chains'].split(','):
+                chainId = modelChain.strip().split('-')[1]
+                seqFile = glob.glob(tempJson['seqFiles'].replace('_*_*', '_{}_*'.format(chainId)))[0]
+                chains.append(chainId), seqFiles.append(seqFile), ranges.append(parseRangeFromSeqFile(seqFile))
+            multiChain = True
+        return cls(code, chains, ranges, seqFiles, structFile, multiChain)
+
+    @classmethod
+    def fromDict(cls, entryDic):
+        return cls(**entryDic)
+
+    def toDict(self):
+        return {'code': self.code, 'chains': self.chains, 'ranges': self.ranges, 'seqFiles': self.seqFiles,
+                'structFile': self.structFile, 'multiChain': self.multiChain,
+                'seqHashes': self.seqHashes, 'structHash': self.structHash, 'atomFile': self.atomFile,
+                'resolution': self.resolution}
+
+    def setStructFile(self, structFile):
+        self.structFile = structFile
+        self.structHash = getFileHash(structFile)
+
+
+class TemplateManifest:
+    """ Typed list of the templates to use in a comparative modelling, compiled once from the templateList text
+    and stored as a json file """
+    def __init__(self, entries=None):
+        self.entries = entries if entries else []
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, item):
+        return self.entries[item]
+
+    @classmethod
+    def fromTemplateList(cls, templateListStr):
+        entries = []
+        for tempLine in templateListStr.split('\n'):
+            if tempLine.strip():
+                entries.append(TemplateEntry.fromTemplateJson(parseTemplateLine(tempLine)))
+        return cls(entries)
+
+    @classmethod
+    def load(cls, manifestFile):
+        with open(manifestFile) as f:
+            manDic = json.load(f)
+        return cls([TemplateEntry.fromDict(entryDic) for entryDic in manDic['templates']])
+
+    def write(self, manifestFile):
+        with open(manifestFile, 'w') as f:
+            json.dump({'version': MANIFEST_VERSION, 'templates': [entry.toDict() for entry in self.entries]},
+                      f, indent=2)
+        return manifestFile
+
+    def getCodes(self):
+        return [entry.code for entry in self.entries]
+
+    def getEntry(self, code):
+        for entry in self.entries:
+            if entry.code == code:
+                return entry
+
+    def getKey(self):
+        """ Stable key of the template set: hash of the codes, chains, ranges and contents of the templates """
+        keyStr = json.dumps([[entry.code, entry.chains, entry.ranges, entry.seqHashes, entry.structHash]
+                             for entry in self.entries], sort_keys=True)
+        return hashlib.sha256(keyStr.encode()).hexdigest()
+
+
+def findInMirror(code, mirrorDir):
+    """ Looks for the structure file of a PDB code in a local mirror directory. Both flat directories and the
+    divided layout of the PDB archive (<mirror>/<2 middle characters>/[pdb]<code>.<ext>) are searched """
+    if not mirrorDir:
+        return None
+    for name in [code.lower(), code.upper(), 'pdb' + code.lower()]:
+        for subDir in ['', code.lower()[1:3]]:
+            for ext in MIRROR_EXTENSIONS:
+                mirrorFile = os.path.join(mirrorDir, subDir, name + ext)
+                if os.path.exists(mirrorFile):
+                    return mirrorFile
+
+
+def downloadStructure(code, outDir):
+    """ Downloads the mmCIF file of a PDB code into outDir. Returns the downloaded file """
+    return emconv.AtomicStructHandler().readFromPDBDatabase(code, type='mmCif', dir=outDir)
+
+
+def copyDecompressed(inFile, outDir, outBase):
+    """ Copies a (possibly gzip compressed) structure file into outDir, decompressed and named as outBase with
+    its original structure extension """
+    inName = os.path.basename(inFile)
+    isGzip = inName.lower().endswith('.gz')
+    ext = os.path.splitext(inName[:-3] if isGzip else inName)[1].lower()
+    ext = '.pdb' if ext == '.ent' else ext
+    outFile = os.path.join(outDir, outBase + ext)
+
+    if isGzip:
+        with gzip.open(inFile, 'rb') as fIn, open(outFile, 'wb') as fOut:
+            shutil.copyfileobj(fIn, fOut)
+    else:
+        shutil.copy(inFile, outFile)
+    return outFile
+
+
+class ChainRangesSelect(Select):
+    """ Biopython selection of the residues of a model in the specified ranges of each chain """
+    def __init__(self, chainRanges, modelId=0):
+        self.chainRanges, self.modelId = chainRanges, modelId
+
+    def accept_model(self, model):
+        return model.id == self.modelId
+
+    def accept_chain(self, chain):
+        return chain.id in self.chainRanges
+
+    def accept_residue(self, residue):
+        hetField, resIdx, _ = residue.get_id()
+        if hetField == 'W':
+            return False
+        first, last = self.chainRanges[residue.get_parent().id]
+        return (first == 'FIRST' or resIdx >= int(first)) and (last == 'LAST' or resIdx <= int(last))
+
+
+def getStructureResolution(structFile):
+    """ Resolution (A) reported in the header of a PDB or mmCIF file. None if not reported (i.e: NMR structures) """
+    try:
+        if structFile.endswith('.cif'):
+            cifDic = MMCIF2Dict(structFile)
+            for key in CIF_RESOLUTION_KEYS:
+                values = [value for value in cifDic.get(key, []) if value not in ['?', '.']]
+                if values:
+                    return float(values[0])
+        else:
+            return parse_pdb_header(structFile).get('resolution')
+    except ValueError:
+        return None
+
+
+def readStructure(structFile, structId='template'):
+    """ Reads a PDB or mmCIF file (maybe gzip compressed) with Biopython """
+    isCif = structFile.endswith(('.cif', '.cif.gz'))
+    parser = MMCIFParser(QUIET=True) if isCif else PDBParser(QUIET=True)
+    if structFile.endswith('.gz'):
+        with gzip.open(structFile, 'rt') as f:
+            return parser.get_structure(structId, f)
+    return parser.get_structure(structId, structFile)
+
+
+def writeStructure(structure, outFile):
+    """ Writes a Biopython structure as PDB or mmCIF (maybe gzip compressed) depending on the outFile extension """
+    io = MMCIFIO() if outFile.endswith(('.cif', '.cif.gz')) else PDBIO()
+    io.set_structure(structure)
+    if outFile.endswith('.gz'):
+        with gzip.open(outFile, 'wt') as f:
+            io.save(f)
+    else:
+        io.save(outFile)
+    return outFile
+
+
+def getTrimKey(entry):
+    """ Cache key of a trimmed template: hash of the source structure and the selected chains and ranges """
+    selStr = json.dumps([entry.structHash, entry.chains, entry.ranges])
+    return hashlib.sha256(selStr.encode()).hexdigest()
+
+
+def trimTemplate(entry, outDir, cacheDir=None):
+    """ Writes a structure file containing only the chains and ranges of the template used in the alignment.
+    The trimmed files are stored in cacheDir, keyed by the hash of the source file and the selection.
+    Returns the trimmed file in outDir """
+    trimKey = getTrimKey(entry)
+    atomFile = '{}_{}'.format(entry.code.lower(), trimKey[:10])
+    longChains = any([len(chain) > 1 for chain in entry.chains])
+    ext = '.cif' if longChains else '.pdb'
+    outFile = os.path.join(outDir, atomFile + ext)
+
+    cachedFile = os.path.join(cacheDir, trimKey + ext) if cacheDir else None
+    if cachedFile and os.path.exists(cachedFile):
+        shutil.copy(cachedFile, outFile)
+    else:
+        structure = readStructure(entry.structFile, entry.code)
+        io = MMCIFIO() if longChains else PDBIO()
+        io.set_structure(structure)
+        chainRanges = {chain: tuple(cRange) for chain, cRange in zip(entry.chains, entry.ranges)}
+        io.save(outFile, ChainRangesSelect(chainRanges, modelId=structure.child_list[0].id))
+
+        if cachedFile:
+            tmpFile = '{}.{}.tmp'.format(cachedFile, os.getpid())
+            shutil.copy(outFile, tmpFile)
+            os.replace(tmpFile, cachedFile)
+    entry.atomFile = atomFile
+    return outFile
+
+
+def fetchTemplate(entry, outDir, mirrorDir=None):
+    """ Acquires the full structure file of a template into outDir: from its local file, the local mirror or, if not
+    found there, downloading it from the PDB. Returns the local structure file """
+    if entry.structFile:
+        return copyDecompressed(entry.structFile, outDir, getStructureCode(entry.structFile))
+    mirrorFile = findInMirror(entry.code, mirrorDir)
+    if mirrorFile:
+        return copyDecompressed(mirrorFile, outDir, entry.code.lower())
+    return downloadStructure(entry.code, outDir)
+
+
+def getSourceKey(entry):
+    """ Templates with the same key (structure file or PDB code) are acquired from the same source """
+    return os.path.abspath(entry.structFile) if entry.structFile else entry.code.lower()
+
+
+def finishTemplate(entry, localFile, outDir, trim=False, cacheDir=None):
+    """ Trims the acquired structure of a template to its chains and ranges if trim. The full file is kept, as it may
+    be shared by other templates. Returns the structure file of the template """
+    if not trim:
+        return os.path.abspath(localFile)
+    entry.setStructFile(os.path.abspath(localFile))
+    return os.path.abspath(trimTemplate(entry, outDir, cacheDir))
+
+
+def prepareTemplate(entry, outDir, mirrorDir=None, trim=False, cacheDir=None):
+    """ Acquires the structure file of a template into outDir and, if trim, trims it to the chains and ranges used.
+    Returns the local structure file """
+    localFile = fetchTemplate(entry, outDir, mirrorDir)
+    # The header is lost when trimming
+    entry.resolution = getStructureResolution(localFile)
+    structFile = finishTemplate(entry, localFile, outDir, trim, cacheDir)
+    if trim:
+        os.remove(localFile)
+    return structFile
+
+
+def prepareTemplates(manifest, outDir, mirrorDir=None, nThreads=4, trim=False, cacheDir=None):
+    """ Prepares all the templates of a manifest concurrently, updating their structure files. Each distinct source
+    (structure file or PDB code) is acquired once, and the templates sharing it are then trimmed from that file.
+    Returns a dictionary {code: errorMessage} with the templates which failed """
+    sources = {}
+    for entry in manifest:
+        sources.setdefault(getSourceKey(entry), []).append(entry)
+
+    errors, localFiles = {}, {}
+    with ThreadPoolExecutor(max_workers=max(1, nThreads)) as executor:
+        fetched = {key: executor.submit(fetchTemplate, entries[0], outDir, mirrorDir)
+                   for key, entries in sources.items()}
+        finished = {}
+        for key, future in fetched.items():
+            try:
+                localFile = future.result()
+            except Exception as e:
+                errors.update({entry.code: '{}: {}'.format(type(e).__name__, e) for entry in sources[key]})
+                continue
+            resolution = getStructureResolution(localFile)
+            for entry in sources[key]:
+                entry.resolution = resolution
+                finished[id(entry)] = (entry, executor.submit(finishTemplate, entry, localFile, outDir, trim, cacheDir))
+            localFiles[key] = localFile
+
+        for entry, future in finished.values():
+            try:
+                entry.setStructFile(future.result())
+            except Exception as e:
+                errors[entry.code] = '{}: {}'.format(type(e).__name__, e)
+
+    # The full files are only removed once all the templates sharing them are trimmed
+    if trim:
+        for localFile in localFiles.values():
+            os.remove(localFile)
+    return errors
+
+
+def rewritePIRAtomFiles(pirFile, manifest):
+    """ Rewrites the atom file field of the structure headers of a PIR alignment so they point to the
+    (maybe trimmed) atom files of the templates in the manifest """
+    atomFiles = {entry.code: entry.atomFile for entry in manifest}
+    with open(pirFile) as f:
+        lines = f.read().split('\n')
+
+    for i, line in enumerate(lines):
+        if line.startswith('structure'):
+            fields = line.split(':')
+            if fields[1] in atomFiles:
+                fields[1] = atomFiles[fields[1]]
+                lines[i] = ':'.join(fields)
+
+    with open(pirFile, 'w') as f:
+        f.write('\n'.join(lines))
+    return pirFile
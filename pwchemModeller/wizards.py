@@ -30,11 +30,13 @@ from .protocols import ModellerMutateResidue, ProtModellerComparativeModelling
 from pwem.wizards import SelectChainWizard, SelectResidueWizard, EmWizard, VariableWizard
 import pwem.objects as emobj
 import pwem.convert as emconv
+from pwem.constants import RESIDUES3TO1
 
 from pwchem.utils import downloadPDB
 from pwchem.wizards import SelectChainWizardQT, SelectResidueWizardQT, SelectMultiChainWizard
 
 from .constants import AA_LIST
+from .utils import TemplateIndex, resolveHit, getTemplateKeys, getHitKeys
 
 SelectChainWizardQT().addTarget(protocol=ModellerMutateResidue,
                               targets=['mutChain'],
@@ -71,18 +73,7 @@ class AddStructSequenceWizard(SelectResidueWizard):
          {"model": %d, "chain": "%s", "residues": %d} (modelsLength)
          (2) list with residues, position and chain (modelsFirstResidue)"""
       structureHandler = emconv.AtomicStructHandler()
-      if type(inputObj) == str:
-        if os.path.exists(inputObj):
-          fileName = inputObj
-        else:
-          fileName = downloadPDB(inputObj)
-
-      elif str(type(inputObj).__name__) == 'SchrodingerAtomStruct':
-        fileName = os.path.abspath(inputObj.convert2PDB())
-      else:
-        fileName = os.path.abspath(inputObj.getFileName())
-
-      structureHandler.read(fileName)
+      structureHandler.read(self.getStructureFile(inputObj))
       structureHandler.getStructure()
       return structureHandler.getModelsChains()
 
@@ -121,6 +112,55 @@ class AddStructSequenceWizard(SelectResidueWizard):
             finalResiduesList.append(emobj.String(i))
       return finalResiduesList
 
+    def getStructureFile(self, inputObj):
+      """ Returns the structure file of the input template (AtomStruct, PDB file or PDB code) """
+      if type(inputObj) == str:
+        if os.path.exists(inputObj):
+          fileName = inputObj
+        else:
+          fileName = downloadPDB(inputObj)
+
+      elif str(type(inputObj).__name__) == 'SchrodingerAtomStruct':
+        fileName = os.path.abspath(inputObj.convert2PDB())
+      else:
+        fileName = os.path.abspath(inputObj.getFileName())
+      return fileName
+
+    def parseMultiPositions(self, posStr, nChains):
+      """ Parses the multi positions string ("1-30, 4-35, ...") into a list of [first, last] for each chain.
+      None is used for chains with no positions specified """
+      posIdxs = [None] * nChains
+      if posStr and posStr.strip():
+        for i, chainPos in enumerate(posStr.split(',')[:nChains]):
+          if chainPos.strip():
+            posIdxs[i] = [int(idx) for idx in chainPos.strip().split('-')]
+      return posIdxs
+
+    def yieldChainsSequences(self, inputObj, modelChains, posIdxs=None):
+      """ Reads the structure only once and yields, for each of the selected "model-chain",
+      its chain ID, sequence and [first, last] residue indexes """
+      structureHandler = emconv.AtomicStructHandler()
+      structureHandler.read(self.getStructureFile(inputObj))
+      structure = structureHandler.getStructure()
+      posIdxs = posIdxs if posIdxs else [None] * len(modelChains)
+
+      for modelChain, chainIdxs in zip(modelChains, posIdxs):
+        model, chainId = modelChain.split('-')
+        chainRes = [(res.get_id()[1], res.get_resname()) for res in structure[int(model)][chainId]
+                    if res.get_resname() in RESIDUES3TO1]
+        if not chainIdxs:
+          chainIdxs = [chainRes[0][0], chainRes[-1][0]]
+
+        seq = ''.join([RESIDUES3TO1[resName] for resIdx, resName in chainRes
+                       if chainIdxs[0] <= resIdx <= chainIdxs[-1]])
+        yield chainId, seq, chainIdxs
+
+    def writeSequenceFiles(self, seqFiles):
+      """ Writes in bulk the fasta files from a dictionary {seqFile: fastaStr} """
+      for seqFile, fastaStr in seqFiles.items():
+        with open(seqFile, 'w') as f:
+          f.write(fastaStr)
+
     def show(self, form, *params):
         protocol = form.protocol
         pseudoProtId = random.randint(0, 1000)  #we cannot obtain prot Id because it might not be launched yet
@@ -173,25 +213,20 @@ class AddStructSequenceWizard(SelectResidueWizard):
         else:
             # Chain
             chainsList = json.loads(getattr(protocol, inputParams[1]).get())['model-chain']
-            for i, chainStr in enumerate(chainsList.split(',')):
-                chain = chainStr.split('-')[1]
+            modelChains = [chainStr.strip() for chainStr in chainsList.split(',')]
 
-                # Positions
-                finalResiduesList = self.getResidues(form, inputTemplate, chainStr)
-                posStr = getattr(protocol, inputParams[2]).get()
-                if posStr:
-                    posIdxs = posStr.split(',').strip()
-                else:
-                    posIdxs = [json.loads(finalResiduesList[0].get())['index'],
-                               json.loads(finalResiduesList[-1].get())['index']]
-
-                seq = self.getSequence(finalResiduesList, posIdxs)
+            # Positions
+            posStr = getattr(protocol, inputParams[2]).get()
+            posIdxs = self.parseMultiPositions(posStr, len(modelChains))
 
-                posIdxStr = '-'.join(list(map(str, posIdxs)))
+            # Single pass over the structure for all the selected chains
+            seqFiles = {}
+            for chain, seq, chainIdxs in self.yieldChainsSequences(inputTemplate, modelChains, posIdxs):
+                posIdxStr = '-'.join(list(map(str, chainIdxs)))
                 seqFile = protocol.getProject().getTmpPath('{}_{}_{}_{}.fa'.format(outName, pseudoProtId, chain,
                                                                                    posIdxStr))
-                with open(seqFile, 'w') as f:
-                    f.write('>{}_{}\n{}\n'.format(outName, chain, seq))
+                seqFiles[seqFile] = '>{}_{}\n{}\n'.format(outName, chain, seq)
+            self.writeSequenceFiles(seqFiles)
 
             seqFileTemplate = seqFile = protocol.getProject().getTmpPath('{}_{}_*_*.fa'.format(outName, pseudoProtId))
 
@@ -216,6 +251,67 @@ AddStructSequenceWizard().addTarget(protocol=ProtModellerComparativeModelling,
                                             {'multiChain': ['tempPositions', 'tempMPositions']}],
                                     outputs=['templateList'])
 
+class SearchTemplatesWizard(EmWizard):
+    """ Searches the local template index with the target sequence and adds the best chains and ranges found to
+    the list of templates """
+    _targets = [(ProtModellerComparativeModelling, ['searchTemplates'])]
+
+    def getHitStructure(self, protocol, hit):
+        """ Locates a hit of a SEQRES dump in the local mirror or downloads it into the project tmp directory.
+        Returns the hit mapped onto the resolved residues of the structure and whether the structure file must be
+        used as template file """
+        return resolveHit(hit, protocol.templatesMirror.get(), protocol.getProject().getTmpPath())
+
+    def show(self, form, *params):
+        protocol = form.protocol
+        if not protocol.hasTargetInput() or not protocol.searchIndexDir.get():
+            print('Define the target sequence and the template index directory to search templates')
+            return
+
+        index = TemplateIndex(protocol.searchIndexDir.get())
+        if protocol.searchSource.get():
+            nAdded, nRemoved, errors = index.update(protocol.searchSource.get())
+            index.write()
+            print('Template index updated: {} files indexed, {} removed, {} chains'.format(nAdded, nRemoved,
+                                                                                           len(index)))
+            for sourceFile, error in errors.items():
+                print('Could not index {}: {}'.format(sourceFile, error))
+
+        hits = index.search(protocol.getTargetSequence(), maxHits=protocol.searchMaxHits.get(),
+                            minIdentity=protocol.searchMinIdentity.get())
+        pseudoProtId = random.randint(0, 1000)
+
+        prevStr = protocol.templateList.get() or ''
+        prevKeys = getTemplateKeys(prevStr)
+        lenPrev = len(prevStr.strip().split('\n')) if prevStr.strip() else 0
+        if prevStr.strip() and not prevStr.endswith('\n'):
+            prevStr += '\n'
+
+        for hit in hits:
+            useFile = not hit['seqres']
+            if hit['seqres']:
+                hit, useFile = self.getHitStructure(protocol, hit)
+                if hit is None:
+                    continue
+            if getHitKeys(hit) & prevKeys:
+                continue
+            prevKeys.update(getHitKeys(hit))
+
+            print('Template {} chain {} ({}-{}): identity {:.0f}%, coverage {:.0f}%'.
+                  format(hit['code'], hit['chain'], hit['first'], hit['last'], 100 * hit['identity'],
+                         100 * hit['coverage']))
+            posIdxs = '{}-{}'.format(hit['first'], hit['last'])
+            faName = '{}_{}_{}_{}'.format(hit['code'], pseudoProtId, hit['chain'], posIdxs)
+            seqFile = protocol.getProject().getTmpPath(faName + '.fa')
+            with open(seqFile, 'w') as f:
+                f.write('>{}\n{}\n'.format(faName, hit['sequence']))
+
+            lenPrev += 1
+            pdbStr = ', "pdbFile": "{}"'.format(hit['source']) if useFile else ''
+            prevStr += '%s) {"pdbName": "%s", "chain": "%s", "index": "%s", "seqFile": "%s"%s}\n' % \
+                       (lenPrev, hit['code'], hit['chain'], posIdxs, seqFile, pdbStr)
+        form.setVar('templateList', prevStr)
+
 SelectChainWizardQT().addTarget(protocol=ProtModellerComparativeModelling,
                                 targets=['tempChain'],
                                 inputs=[{'templateOrigin': ['inputAtomStruct', 'pdbTemplate']}],